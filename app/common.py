@@ -34,10 +34,11 @@ from docarray import Document
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 
-from sqlalchemy import Column, Integer, String, BigInteger, Boolean, ForeignKey, Text, Index, JSON, Enum, UniqueConstraint, DateTime, func, ARRAY, UUID, Table
-from sqlalchemy.orm import relationship, backref, joinedload, Session   
+from sqlalchemy import Column, Integer, String, BigInteger, Boolean, ForeignKey, Text, Index, JSON, Enum, UniqueConstraint, DateTime, func, ARRAY, UUID, Table, insert, select, update, delete, LargeBinary, Float, Computed, tuple_, or_, and_, union_all, literal, null
+from sqlalchemy.orm import relationship, backref, joinedload, selectinload, deferred
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, insert as pg_insert
 
 from sklearn.decomposition import PCA
 from scipy.spatial.distance import cosine
@@ -48,6 +49,11 @@ from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 
 from .database import SessionLocal, Base, milvus_client
+from .vectorstore import SearchFilter, fuse
+from .pagination import keyset, page, page_size
+from .encoding import EncodeDispatcher, EncoderBusy, create_backend
+from .embedding_cache import EmbeddingCache
+from .storage import SpooledUpload, spool_upload, encode_image_file, file_sha256, TMP_DIR
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token",auto_error=False)
 
@@ -77,14 +83,12 @@ async def get_uid(token:str|None = Depends(oauth2_scheme)):
         return None
 
 async def get_db():
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
     
 async def encode_image(image:bytes):
     return base64.b64encode(image).decode('utf-8')
 
-clip = Client('grpc://localhost:51000')
+clip_backend = create_backend()
+encoder = EncodeDispatcher(clip_backend, cache=EmbeddingCache(model_id=clip_backend.model_id))
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from .vectorstore import VectorStore, LocalVectorStore, SearchFilter, FIELDS, normalize
+
+class Projection:
+    ''' PCA basis shared by both vector fields, which live in the same CLIP space.
+
+    Vectors are projected without centering: x @ components.T keeps inner products
+    between unit vectors far better than centred coordinates, which add a per-item
+    offset to every score. '''
+
+    def __init__(self, components: np.ndarray, explained: float, rows: int):
+        self.components = components.astype(np.float32)
+        self.explained = explained
+        # Catalog size at fit time, which the refit policy compares against
+        self.rows = rows
+
+    @property
+    def dimension(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, sample: np.ndarray, dimension: int, rows: int) -> "Projection":
+        pca = PCA(n_components=dimension, svd_solver="randomized", random_state=0).fit(normalize(sample))
+        return cls(pca.components_, float(pca.explained_variance_ratio_.sum()), rows)
+
+    def transform(self, vectors) -> np.ndarray:
+        return normalize(normalize(vectors) @ self.components.T)
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, components=self.components, explained=self.explained, rows=self.rows)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Projection":
+        data = np.load(path)
+        return cls(data["components"], float(data["explained"]), int(data["rows"]))
+
+class CompactTier(VectorStore):
+    ''' Two-stage retrieval in front of a full-precision vector store.
+
+    Every row is also kept in a local store as a PCA-reduced, int8 or float16 code.
+    Searches take `rerank` times the requested page from the compact codes, with the
+    same filters, then re-score those candidates against the full vectors fetched from
+    `primary` in one call. Everything else goes straight to `primary`, which stays the
+    source of truth: the tier can be dropped and rebuilt from it at any time.
+
+    Each fit lives in its own versioned directory and current.json names the live one.
+    A refit builds the next version from the primary while writes go to both, then
+    switches over. Until the first fit, searches fall through to `primary`. '''
+
+    def __init__(self, primary: VectorStore, directory: str, dimension: int = 256, dtype: str = "int8",
+                 nlist: int = 128, nprobe: int = 32, rerank: int = 4, min_rows: int = 10000, sample: int = 50000):
+        self.primary = primary
+        self.directory = directory
+        self.dimension = dimension
+        self.dtype = dtype
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.min_rows = min_rows
+        self.sample = sample
+        self.pointer_path = os.path.join(directory, "current.json")
+        self.version = 0
+        # (projection, store) pairs written to: the live tier, plus the next one during a refit
+        self.tiers: list[tuple[Projection, LocalVectorStore]] = []
+        self.refitting = asyncio.Lock()
+
+    def open(self, version: int) -> tuple[Projection, LocalVectorStore]:
+        path = os.path.join(self.directory, f"v{version}")
+        store = LocalVectorStore(path, dimension=self.dimension, dtype=self.dtype, nlist=self.nlist, nprobe=self.nprobe)
+        store.setup_collection()
+        return Projection.load(os.path.join(path, "projection.npz")), store
+
+    def setup_collection(self):
+        self.primary.setup_collection()
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.pointer_path):
+            with open(self.pointer_path) as f:
+                self.version = json.load(f)["version"]
+            self.tiers = [self.open(self.version)]
+            print(f"Loaded compact tier v{self.version} ({self.dimension}-dim {self.dtype})")
+
+    def project(self, projection: Projection, data: list[dict]) -> list[dict]:
+        return [dict(row, **{field: projection.transform(row[field]) for field in FIELDS}) for row in data]
+
+    async def mirror(self, data: list[dict]):
+        for projection, store in list(self.tiers):
+            await store.upsert_batch(self.project(projection, data))
+
+    async def insert_batch(self, data: list[dict]):
+        await self.primary.insert_batch(data)
+        await self.mirror(data)
+
+    async def upsert_batch(self, data: list[dict]):
+        await self.primary.upsert_batch(data)
+        await self.mirror(data)
+
+    async def delete(self, ids: list):
+        await self.primary.delete(ids)
+        for _, store in list(self.tiers):
+            await store.delete(ids)
+
+    async def search(self, image_embed: list=None, text_embed: list=None, limit: int = 128, offset: int = 0,
+                     filter: SearchFilter = None, exclude: list = None) -> list[dict]:
+        if not self.tiers:
+            return await self.primary.search(image_embed, text_embed, limit, offset, filter, exclude)
+        if image_embed is not None:
+            query, field = image_embed, "image_embed"
+        else:
+            query, field = text_embed, "text_embed"
+
+        projection, store = self.tiers[0]
+        candidates = await store.search(
+            **{field: projection.transform(query)},
+            limit=self.rerank * (offset + limit),
+            filter=filter,
+            exclude=exclude
+        )
+        if not candidates:
+            return []
+        # Ids deleted from the primary since they were copied simply drop out here
+        rows = await self.primary.get_vectors([hit["id"] for hit in candidates])
+        ids = [hit["id"] for hit in candidates if hit["id"] in rows]
+        if not ids:
+            return []
+        scores = normalize([rows[id][field] for id in ids]) @ normalize(query)
+        order = np.argsort(-scores)[offset:offset + limit]
+        return [{"id": ids[i], "distance": float(scores[i])} for i in order]
+
+    async def get_embedding(self, id: int):
+        return await self.primary.get_embedding(id)
+
+    async def get_vectors(self, ids: list) -> dict:
+        return await self.primary.get_vectors(ids)
+
+    async def list_ids(self) -> set[str]:
+        return await self.primary.list_ids()
+
+    async def list_stale_ids(self) -> set[str]:
+        return await self.primary.list_stale_ids()
+
+    def shadow(self, name: str, dimension: int) -> VectorStore:
+        return self.primary.shadow(name, dimension)
+
+    def promote(self, shadow: VectorStore):
+        self.primary.promote(shadow)
+        # Codes projected from the old vectors are meaningless now; search the primary until the next fit
+        if os.path.exists(self.pointer_path):
+            os.remove(self.pointer_path)
+        self.tiers = []
+
+    async def rows(self, ids: list, batch: int = 1000):
+        for i in range(0, len(ids), batch):
+            yield await self.primary.get_vectors(ids[i:i + batch])
+
+    async def refit(self, force: bool = False) -> dict | None:
+        ''' Fits a new projection on a sample of the primary and rebuilds the codes from it.
+        Without `force` this only happens once the catalog reaches `min_rows` and then each
+        time it has doubled since the last fit, the same policy as IVF retraining. '''
+        async with self.refitting:
+            ids = list(await self.primary.list_ids())
+            fitted = self.tiers[0][0].rows if self.tiers else 0
+            if not force and (len(ids) < self.min_rows or (fitted and len(ids) < 2 * fitted)):
+                return None
+
+            start = time.perf_counter()
+            sample = random.Random(len(ids)).sample(ids, min(len(ids), self.sample))
+            vectors = []
+            async for rows in self.rows(sample):
+                vectors.extend(row[field] for row in rows.values() for field in FIELDS)
+            projection = await asyncio.to_thread(Projection.fit, np.asarray(vectors, dtype=np.float32), self.dimension, len(ids))
+
+            version = self.version + 1
+            path = os.path.join(self.directory, f"v{version}")
+            shutil.rmtree(path, ignore_errors=True)
+            store = LocalVectorStore(path, dimension=self.dimension, dtype=self.dtype, nlist=self.nlist, nprobe=self.nprobe)
+            store.setup_collection()
+            projection.save(os.path.join(path, "projection.npz"))
+
+            # From here on new writes reach the next tier too, so nothing is missed while copying
+            self.tiers.append((projection, store))
+            try:
+                async for rows in self.rows(ids):
+                    await store.upsert_batch(self.project(projection, [dict(row, id=id) for id, row in rows.items()]))
+            except Exception:
+                self.tiers.remove((projection, store))
+                raise
+
+            tmp = f"{self.pointer_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"version": version}, f)
+            os.replace(tmp, self.pointer_path)
+            self.tiers = [(projection, store)]
+            old, self.version = self.version, version
+            shutil.rmtree(os.path.join(self.directory, f"v{old}"), ignore_errors=True)
+
+            report = {
+                "version": version,
+                "rows": len(ids),
+                "sample": len(sample),
+                "dimension": self.dimension,
+                "dtype": self.dtype,
+                "explained_variance": projection.explained,
+                "seconds": time.perf_counter() - start,
+            }
+            print(f"Refitted compact tier: {report}")
+            return report
+
+    async def run(self, interval: float):
+        while True:
+            try:
+                await self.refit()
+            except Exception as e:
+                print(f"Compact tier refit failed: {str(e)}")
+            await asyncio.sleep(interval)
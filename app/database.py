@@ -1,29 +1,47 @@
-from sqlalchemy import create_engine
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import os
-from pymilvus import MilvusClient, DataType
+from pymilvus import MilvusClient, DataType, AnnSearchRequest, RRFRanker, WeightedRanker, Collection, connections
 from typing import Optional
 from dataclasses import dataclass
 import asyncio
-from numpy import ndarray
+import json
+from .vectorstore import VectorStore, LocalVectorStore, SearchFilter, MAX_TAGS, FIELDS
+from .compact import CompactTier
 
 @dataclass
 class MilvusConfig:
-    dimension: int = 1024
+    dimension: int = int(os.getenv("VECTOR_DIMENSION", 1024))
     index_type: str = "IVF_FLAT"
     metric_type: str = "COSINE"
     nlist: int = 128
     collection_name: str = "embeddings"
+    # Reads and writes go through the alias so a rebuilt collection can be swapped in atomically
+    alias: Optional[str] = "embeddings_live"
 
-class MilvusSetup:
-    def __init__(self, uri: Optional[str] = None):
+class MilvusSetup(VectorStore):
+    def __init__(self, uri: Optional[str] = None, config: Optional[MilvusConfig] = None):
         self.uri = uri or os.getenv("MILVUS_URI")
         if not self.uri:
             raise ValueError("Milvus URI not provided")
         
         self.client = MilvusClient(uri=self.uri)
-        self.config = MilvusConfig()
+        self.config = config or MilvusConfig()
+        self.name = self.config.alias or self.config.collection_name
+        # MilvusClient 2.4 has no iterators or hybrid search, so those go through an ORM connection
+        self.using = f"orm-{self.uri}"
+        if not connections.has_connection(self.using):
+            connections.connect(alias=self.using, uri=self.uri)
+        self._collection = None
+
+    @property
+    def collection(self) -> Collection:
+        # Opened on first use; the alias is resolved by the server on every request
+        if self._collection is None:
+            self._collection = Collection(self.name, using=self.using)
+        return self._collection
 
     def create_schema(self):
         schema = self.client.create_schema(
@@ -41,6 +59,11 @@ class MilvusSetup:
             datatype=DataType.FLOAT_VECTOR, 
             dim=self.config.dimension
         )        
+        # Scalars for SearchFilter, so filtering happens inside the ANN query
+        schema.add_field(field_name="uid", datatype=DataType.VARCHAR, max_length=255)
+        schema.add_field(field_name="is_nsfw", datatype=DataType.BOOL)
+        schema.add_field(field_name="is_public", datatype=DataType.BOOL)
+        schema.add_field(field_name="tids", datatype=DataType.ARRAY, element_type=DataType.INT64, max_capacity=MAX_TAGS)
         return schema
 
     def create_index_params(self):
@@ -55,6 +78,12 @@ class MilvusSetup:
                 index_name=f"{field_name}_index",
                 params={"nlist": self.config.nlist}
             )
+        for field_name in ["uid", "tids"]:
+            index_params.add_index(
+                field_name=field_name,
+                index_type="INVERTED",
+                index_name=f"{field_name}_index"
+            )
         
         return index_params
 
@@ -77,37 +106,58 @@ class MilvusSetup:
 
     def setup_collection(self):
         try:
+            if self.config.alias:
+                try:
+                    target = self.client.describe_alias(alias=self.config.alias)["collection_name"]
+                    print(f"Alias '{self.config.alias}' points to '{target}'. Loading...")
+                    self.client.load_collection(target)
+                    return
+                except Exception:
+                    # First start with aliases: adopt the existing collection below
+                    pass
+
             if self.config.collection_name in self.client.list_collections():
                 print(f"Collection '{self.config.collection_name}' exists. Loading...")
                 self.client.load_collection(self.config.collection_name)
             else:
                 print(f"Creating new collection '{self.config.collection_name}'...")
                 self.create_collection()
+            if self.config.alias:
+                self.client.create_alias(collection_name=self.config.collection_name, alias=self.config.alias)
                 
         except Exception as e:
             print(f"Collection setup failed: {str(e)}")
             raise
 
-    async def insert_data(self, id: int, image_embed: list, text_embed: list):
+    async def insert_batch(self, data: list[dict]):
+        # One round-trip for the whole batch instead of one insert per row
         try:
-            data = [{
-                    "id": id,
-                    "image_embed": image_embed,
-                    "text_embed": text_embed
-                }]
             await asyncio.to_thread(
                 self.client.insert,
-                collection_name=self.config.collection_name,
+                collection_name=self.name,
                 data=data
             )
-            print(f"Data inserted successfully")
+            print(f"Inserted {len(data)} rows successfully")
         except Exception as e:
             print(f"Failed to insert data: {str(e)}")
             raise
 
-    async def search(self, image_embed: list=None, text_embed: list=None, limit: int = 128) -> dict:
+    async def upsert_batch(self, data: list[dict]):
+        try:
+            await asyncio.to_thread(
+                self.client.upsert,
+                collection_name=self.name,
+                data=data
+            )
+            print(f"Upserted {len(data)} rows successfully")
+        except Exception as e:
+            print(f"Failed to upsert data: {str(e)}")
+            raise
+
+    async def search(self, image_embed: list=None, text_embed: list=None, limit: int = 128, offset: int = 0,
+                     filter: SearchFilter = None, exclude: list = None) -> list[dict]:
         try:
-            if isinstance(image_embed, ndarray):
+            if image_embed is not None:
                 embedding = image_embed
                 field = "image_embed"
             else:
@@ -117,50 +167,169 @@ class MilvusSetup:
             search_params = {
                 "metric_type": "COSINE",
                 "params": {"nprobe": 32},  # Increased nprobe for better accuracy
+                "offset": offset,
             }
+            expression = [filter.expression()] if filter else []
+            if exclude:
+                expression.append(f"id not in {json.dumps([str(id) for id in exclude])}")
 
             search_results = await asyncio.to_thread(
                 self.client.search,
-                collection_name=self.config.collection_name,
+                collection_name=self.name,
                 data=[embedding],
+                filter=' and '.join(expression),
                 limit=limit,
                 search_params=search_params,
                 anns_field=field
             )
-            mids = []
-            identical = []
-            for hit in search_results[0]:
-                if hit["distance"] < 0.01:  # Threshold for identical images
-                    identical.append(hit['id'])
-                else:
-                    mids.append(hit['id'])
-            if mids:
-                mids.pop(0)  # pop the first result as it is the query image
-
-            if field == "image_embed":
-                return {"similar": mids, "identical": identical}
-            
-            mids.extend(identical)
-            return {"similar": mids}
+            return [{"id": hit["id"], "distance": hit["distance"]} for hit in search_results[0]]
 
         except Exception as e:
             print(f"Failed to search data: {str(e)}")
             raise
 
+    async def hybrid_search(self, embedding: list, limit: int = 128, offset: int = 0, filter: SearchFilter = None,
+                            exclude: list = None, weights: tuple = (1.0, 1.0), method: str = "rrf",
+                            depth: int = 4, rrf_k: int = 60) -> list[dict]:
+        # Both ANN requests and the fusion run inside Milvus in one round-trip.
+        # Milvus' RRF ranker is unweighted; weights apply to the "weighted" method.
+        try:
+            expression = [filter.expression()] if filter else []
+            if exclude:
+                expression.append(f"id not in {json.dumps([str(id) for id in exclude])}")
+            requests = [
+                AnnSearchRequest(
+                    data=[embedding],
+                    anns_field=field,
+                    param={"metric_type": "COSINE", "params": {"nprobe": 32}},
+                    limit=depth * (offset + limit),
+                    expr=' and '.join(expression) or None
+                )
+                for field in FIELDS
+            ]
+            ranker = RRFRanker(rrf_k) if method == "rrf" else WeightedRanker(*weights)
+            # MilvusClient 2.4 has no hybrid_search; the ORM collection does
+            search_results = await asyncio.to_thread(
+                self.collection.hybrid_search,
+                reqs=requests,
+                rerank=ranker,
+                limit=offset + limit
+            )
+            hits = [{"id": hit.id, "distance": hit.distance} for hit in search_results[0]]
+            return hits[offset:]
+
+        except Exception as e:
+            print(f"Failed to run hybrid search: {str(e)}")
+            raise
+
     async def get_embedding(self, id: int):
         try:
             result = await asyncio.to_thread(
-                self.client.get_entity_by_id,
-                collection_name=self.config.collection_name,
-                ids=[id]
+                self.client.get,
+                collection_name=self.name,
+                ids=[str(id)],
+                output_fields=["image_embed"]
             )
+            if not result:
+                raise KeyError(f"No embedding for {id}")
             return result[0]["image_embed"]
         except Exception as e:
             print(f"Failed to get embedding: {str(e)}")
             raise
 
-# Milvus setup
-milvus_client = MilvusSetup()
+    async def get_vectors(self, ids: list) -> dict:
+        try:
+            result = await asyncio.to_thread(
+                self.client.get,
+                collection_name=self.name,
+                ids=[str(id) for id in ids],
+                output_fields=["image_embed", "text_embed", "uid", "is_nsfw", "is_public", "tids"]
+            )
+            return {row["id"]: row for row in result}
+        except Exception as e:
+            print(f"Failed to get vectors: {str(e)}")
+            raise
+
+    async def delete(self, ids: list):
+        try:
+            await asyncio.to_thread(
+                self.client.delete,
+                collection_name=self.name,
+                ids=ids
+            )
+        except Exception as e:
+            print(f"Failed to delete data: {str(e)}")
+            raise
+
+    def shadow(self, name: str, dimension: int) -> "MilvusSetup":
+        return MilvusSetup(self.uri, MilvusConfig(dimension=dimension, collection_name=name, alias=None))
+
+    def promote(self, shadow: "MilvusSetup"):
+        # Every client resolves the alias per request, so all workers switch at once
+        previous = self.client.describe_alias(alias=self.config.alias)["collection_name"]
+        self.client.alter_alias(collection_name=shadow.config.collection_name, alias=self.config.alias)
+        # The cached ORM handle holds the old collection's schema
+        self._collection = None
+        print(f"Alias '{self.config.alias}' now points to '{shadow.config.collection_name}' (was '{previous}', kept for rollback)")
+
+    def scan(self, output_fields: list, batch_size: int = 10000):
+        # query() caps offset + limit, so page through with an iterator instead
+        iterator = self.collection.query_iterator(
+            batch_size=batch_size,
+            expr='id != ""',
+            output_fields=output_fields
+        )
+        try:
+            while True:
+                page = iterator.next()
+                if not page:
+                    return
+                yield from page
+        finally:
+            iterator.close()
+
+    async def list_ids(self) -> set[str]:
+        try:
+            return await asyncio.to_thread(lambda: {row["id"] for row in self.scan(["id"])})
+        except Exception as e:
+            print(f"Failed to list ids: {str(e)}")
+            raise
+
+    async def list_stale_ids(self) -> set[str]:
+        # Rows from before the scalar fields existed keep them out of the dynamic field entirely
+        try:
+            return await asyncio.to_thread(lambda: {row["id"] for row in self.scan(["id", "is_public"]) if row.get("is_public") is None})
+        except Exception as e:
+            print(f"Failed to list stale ids: {str(e)}")
+            raise
+
+# Vector store setup: Milvus, or the embedded engine with VECTOR_BACKEND=local
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "milvus")
+if VECTOR_BACKEND == "local":
+    VECTOR_DIR = os.getenv("VECTOR_DIR", os.path.join(os.getenv("STORAGE_DIR"), "vectors"))
+    milvus_client = LocalVectorStore(
+        directory=LocalVectorStore.current(VECTOR_DIR),
+        root=VECTOR_DIR,
+        dimension=MilvusConfig.dimension,
+        dtype=os.getenv("VECTOR_DTYPE", "float16"),
+        nlist=MilvusConfig.nlist,
+        nprobe=int(os.getenv("VECTOR_NPROBE", 32)),
+    )
+else:
+    milvus_client = MilvusSetup()
+
+# Optional compact first-stage tier in front of either backend
+if os.getenv("VECTOR_COMPACT", "false").lower() == "true":
+    milvus_client = CompactTier(
+        milvus_client,
+        directory=os.getenv("VECTOR_COMPACT_DIR", os.path.join(os.getenv("STORAGE_DIR"), "vectors", "compact")),
+        dimension=int(os.getenv("VECTOR_COMPACT_DIM", 256)),
+        dtype=os.getenv("VECTOR_COMPACT_DTYPE", "int8"),
+        nlist=MilvusConfig.nlist,
+        nprobe=int(os.getenv("VECTOR_NPROBE", 32)),
+        rerank=int(os.getenv("VECTOR_RERANK_FACTOR", 4)),
+        min_rows=int(os.getenv("VECTOR_COMPACT_MIN_ROWS", 10000)),
+    )
 milvus_client.setup_collection()
 
 # Database setup
@@ -168,8 +337,55 @@ database_url = os.getenv("DATABASE_URL")
 if not database_url:
     raise ValueError("Database URL not provided")
 
+# Connection pool, shared by every request and background worker of the process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 30 * 60))
+DB_PRE_PING = os.getenv("DB_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Prepared statements kept per connection; set to 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 100))
+
+def async_url(url: str) -> str:
+    # DATABASE_URL keeps working in its plain postgresql:// form
+    scheme, rest = url.split("://", 1)
+    return f"postgresql+asyncpg://{rest}" if scheme.split("+")[0] in ("postgres", "postgresql") else url
+
 # Create database engine and session
-engine = create_engine(database_url)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    async_url(database_url),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_PRE_PING,
+    connect_args={
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE,
+        "statement_cache_size": DB_STATEMENT_CACHE,
+    },
+)
+# Loaded attributes stay usable after commit: reloading them lazily would need I/O outside an await
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+def sync_schema(conn):
+    ''' create_all skips tables that already exist, so columns and indexes added to a model
+    later are created here. New columns must be nullable or have a server default. '''
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}"))
+                print(f"Added column {table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+async def create_tables():
+    async with engine.begin() as conn:
+        # Trigram indexes on usernames and collection names
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(sync_schema)
+
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+STORAGE_DIR = os.getenv("STORAGE_DIR")
+EMBED_CACHE_MEMORY_MB = float(os.getenv("EMBED_CACHE_MEMORY_MB", 64))
+EMBED_CACHE_DISK_ROWS = int(os.getenv("EMBED_CACHE_DISK_ROWS", 200_000))
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", os.path.join(STORAGE_DIR, "cache", "embeddings"))
+# Cosine similarity below which a probe embedding counts as coming from another model
+EMBED_CACHE_PROBE_TOLERANCE = float(os.getenv("EMBED_CACHE_PROBE_TOLERANCE", 0.999))
+
+KEY_BYTES = 32
+
+class MemoryTier:
+    ''' LRU bounded by the total size of the cached vectors '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key: bytes):
+        vector = self.entries.get(key)
+        if vector is not None:
+            self.entries.move_to_end(key)
+        return vector
+
+    def put(self, key: bytes, vector: np.ndarray):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key).nbytes
+        self.entries[key] = vector
+        self.bytes += vector.nbytes
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+class DiskTier:
+    ''' Fixed-capacity ring of vectors in memory-mapped files.
+
+    keys.bin holds one 32-byte key per row and vectors.bin the matching float32 row.
+    The key -> row map is rebuilt from keys.bin on start, and once the ring is full
+    the oldest row is overwritten. The files are created on the first put, when the
+    dimension is known. meta.json also keeps the probe embedding of the model that
+    wrote the rows. '''
+
+    def __init__(self, directory: str, capacity: int):
+        self.directory = directory
+        self.capacity = capacity
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.rows: dict[bytes, int] = {}
+        self.keys = None
+        self.vectors = None
+        self.dim = None
+        self.cursor = 0
+        self.probe = None
+        self.load()
+
+    def open(self, dim: int, mode: str):
+        self.dim = dim
+        self.keys = np.memmap(os.path.join(self.directory, "keys.bin"), dtype=np.uint8, mode=mode, shape=(self.capacity, KEY_BYTES))
+        self.vectors = np.memmap(os.path.join(self.directory, "vectors.bin"), dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+
+    def load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if meta.get("capacity") != self.capacity:
+            # Resized cache: start over rather than reinterpret the old files
+            return
+        self.open(meta["dim"], "r+")
+        self.cursor = meta["cursor"]
+        if meta.get("probe") is not None:
+            self.probe = np.asarray(meta["probe"], dtype=np.float32)
+        for row in np.flatnonzero(self.keys.any(axis=1)):
+            self.rows[self.keys[row].tobytes()] = int(row)
+
+    def get(self, key: bytes):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return np.array(self.vectors[row])
+
+    def clear(self):
+        self.rows = {}
+        self.cursor = 0
+        if self.keys is not None:
+            self.keys[:] = 0
+
+    def reset(self, dim: int):
+        os.makedirs(self.directory, exist_ok=True)
+        self.rows = {}
+        self.cursor = 0
+        self.open(dim, "w+")
+
+    def put(self, key: bytes, vector: np.ndarray):
+        if self.vectors is None or vector.shape[-1] != self.dim:
+            # First write, or a model with a different dimension
+            self.reset(vector.shape[-1])
+        if key in self.rows:
+            return
+        row = self.cursor
+        old = self.keys[row].tobytes()
+        self.rows.pop(old, None)
+        self.keys[row] = np.frombuffer(key, dtype=np.uint8)
+        self.vectors[row] = vector
+        self.rows[key] = row
+        self.cursor = (row + 1) % self.capacity
+
+    def flush(self):
+        if self.vectors is None:
+            return
+        self.keys.flush()
+        self.vectors.flush()
+        tmp = f"{self.meta_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "dim": self.dim,
+                "capacity": self.capacity,
+                "cursor": self.cursor,
+                "probe": self.probe.tolist() if self.probe is not None else None,
+            }, f)
+        os.replace(tmp, self.meta_path)
+
+class EmbeddingCache:
+    ''' Two-tier cache of CLIP outputs keyed by sha256(model id + input).
+
+    Text queries are keyed on the text. Images are keyed on the sha256 of the uploaded
+    file, so a hit skips decoding and resizing it; images encoded from a data URI
+    without a known digest are keyed on the URI. The model id is part of the key so
+    switching models never returns stale vectors, and verify() catches a remote server
+    that changed its model under the same configured id. '''
+
+    def __init__(self, model_id: str, memory_mb: float = EMBED_CACHE_MEMORY_MB,
+                 disk_rows: int = EMBED_CACHE_DISK_ROWS, directory: str = EMBED_CACHE_DIR):
+        self.model_id = model_id
+        self.memory = MemoryTier(int(memory_mb * 1024 * 1024))
+        self.disk = DiskTier(directory, disk_rows) if disk_rows > 0 else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, item: str) -> bytes:
+        return hashlib.sha256(f"{self.model_id}\0{item}".encode('utf-8')).digest()
+
+    def image_key(self, digest: str) -> bytes:
+        # A different separator keeps file digests apart from texts
+        return hashlib.sha256(f"{self.model_id}\1{digest}".encode('utf-8')).digest()
+
+    def verify(self, probe: np.ndarray, tolerance: float = EMBED_CACHE_PROBE_TOLERANCE):
+        ''' Drops the disk tier unless it was written by the model that embeds the probe as
+        `probe` does now. Rows from before probes were stored are dropped as well. '''
+        if self.disk is None:
+            return
+        probe = np.asarray(probe, dtype=np.float32)
+        probe = probe / max(float(np.linalg.norm(probe)), 1e-12)
+        stored = self.disk.probe
+        if self.disk.rows and (stored is None or stored.shape != probe.shape or float(stored @ probe) < tolerance):
+            print(f"Embedding cache was written by another model than '{self.model_id}', clearing it")
+            self.disk.clear()
+        self.disk.probe = probe
+
+    def disable_disk(self):
+        self.disk = None
+
+    def get(self, key: bytes):
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.memory_hits += 1
+            return vector
+        if self.disk is not None:
+            vector = self.disk.get(key)
+            if vector is not None:
+                self.disk_hits += 1
+                self.memory.put(key, vector)
+                return vector
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        self.memory.put(key, vector)
+        if self.disk is not None:
+            self.disk.put(key, vector)
+
+    def flush(self):
+        if self.disk is not None:
+            self.disk.flush()
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+            "memory_entries": len(self.memory.entries),
+            "memory_bytes": self.memory.bytes,
+            "disk_entries": len(self.disk.rows) if self.disk is not None else 0,
+        }
@@ -0,0 +1,345 @@
+import os
+import time
+import base64
+import asyncio
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .storage import encode_image_file
+
+CLIP_BATCH_WINDOW_MS = float(os.getenv("CLIP_BATCH_WINDOW_MS", 5))
+CLIP_MAX_BATCH = int(os.getenv("CLIP_MAX_BATCH", 64))
+CLIP_MAX_PENDING = int(os.getenv("CLIP_MAX_PENDING", 1024))
+CLIP_MAX_INFLIGHT = int(os.getenv("CLIP_MAX_INFLIGHT", 4))
+CLIP_ENQUEUE_TIMEOUT = float(os.getenv("CLIP_ENQUEUE_TIMEOUT", 10))
+
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "remote")
+CLIP_SERVER = os.getenv("CLIP_SERVER", "grpc://localhost:51000")
+CLIP_MODEL_ID = os.getenv("CLIP_MODEL_ID", "ViT-H-14::laion2b-s32b-b79k")
+# RN50x64 is the openai model whose 1024-dim output matches MilvusConfig.dimension
+CLIP_LOCAL_MODEL = os.getenv("CLIP_LOCAL_MODEL", "RN50x64")
+CLIP_LOCAL_BATCH = int(os.getenv("CLIP_LOCAL_BATCH", 32))
+CLIP_TORCH_THREADS = int(os.getenv("CLIP_TORCH_THREADS", 0))
+CLIP_QUANTIZE = os.getenv("CLIP_QUANTIZE", "false").lower() in ("1", "true", "yes")
+# Embedded at startup to check which model actually answers for CLIP_MODEL_ID
+CLIP_PROBE_TEXT = "a photograph of a lighthouse at dusk"
+
+class EncoderBusy(Exception):
+    ''' Raised when the dispatcher queue stays full for longer than the enqueue timeout '''
+
+class EncoderBackend:
+    ''' Turns a list of texts and image data URIs into one embedding row per input '''
+
+    model_id: str
+
+    async def aencode(self, inputs: list) -> np.ndarray:
+        raise NotImplementedError
+
+    async def warmup(self):
+        pass
+
+class RemoteClipBackend(EncoderBackend):
+    ''' The clip-server over gRPC '''
+
+    def __init__(self, server: str = CLIP_SERVER, model_id: str = CLIP_MODEL_ID):
+        from clip_client import Client
+        self.client = Client(server)
+        self.model_id = model_id
+
+    async def aencode(self, inputs: list) -> np.ndarray:
+        return await self.client.aencode(inputs)
+
+class LocalClipBackend(EncoderBackend):
+    ''' Runs an openai CLIP model in-process on CPU.
+
+    Inference runs on a single dedicated thread; torch parallelises inside each batch
+    with CLIP_TORCH_THREADS intra-op threads. With CLIP_QUANTIZE the Linear layers are
+    dynamically quantized to int8, which mostly speeds up the text tower and the ViT
+    attention/MLP blocks. '''
+
+    def __init__(self, model_name: str = CLIP_LOCAL_MODEL, batch_size: int = CLIP_LOCAL_BATCH,
+                 threads: int = CLIP_TORCH_THREADS, quantize: bool = CLIP_QUANTIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.quantize = quantize
+        self.model_id = f"openai/{model_name}" + ("/int8" if quantize else "")
+        self.model = None
+        self.preprocess = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip")
+
+    def load(self):
+        if self.model is not None:
+            return
+        import torch
+        import clip as openai_clip
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        model, preprocess = openai_clip.load(self.model_name, device="cpu", jit=False)
+        model = model.float().eval()
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model, self.preprocess = model, preprocess
+
+    def decode(self, uri: str):
+        from PIL import Image
+        data = base64.b64decode(uri.split(",", 1)[1])
+        return Image.open(BytesIO(data)).convert("RGB")
+
+    def encode(self, inputs: list) -> np.ndarray:
+        import torch
+        import clip as openai_clip
+        self.load()
+        images = [i for i, item in enumerate(inputs) if item.startswith("data:image")]
+        texts = [i for i, item in enumerate(inputs) if not item.startswith("data:image")]
+        output = [None] * len(inputs)
+        with torch.inference_mode():
+            for start in range(0, len(images), self.batch_size):
+                chunk = images[start:start + self.batch_size]
+                pixels = torch.stack([self.preprocess(self.decode(inputs[i])) for i in chunk])
+                for i, row in zip(chunk, self.model.encode_image(pixels).float().numpy()):
+                    output[i] = row
+            for start in range(0, len(texts), self.batch_size):
+                chunk = texts[start:start + self.batch_size]
+                tokens = openai_clip.tokenize([inputs[i] for i in chunk], truncate=True)
+                for i, row in zip(chunk, self.model.encode_text(tokens).float().numpy()):
+                    output[i] = row
+        return np.stack(output).astype(np.float32)
+
+    async def aencode(self, inputs: list) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.encode, inputs)
+
+    async def warmup(self):
+        # Load weights and run one image and one text through both towers before serving
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new("RGB", (224, 224)).save(buffer, format="JPEG")
+        sample = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode('utf-8')
+        vectors = await self.aencode([sample, "warm up"])
+        print(f"Local CLIP '{self.model_name}' ready, {vectors.shape[1]}-dim embeddings")
+
+def create_backend(kind: str = CLIP_BACKEND) -> EncoderBackend:
+    if kind == "remote":
+        return RemoteClipBackend()
+    if kind == "local":
+        return LocalClipBackend()
+    raise ValueError(f"Unknown CLIP backend: {kind}")
+
+@dataclass
+class EncodeRequest:
+    inputs: list
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class EncoderMetrics:
+    requests: int = 0
+    batches: int = 0
+    items: int = 0
+    max_batch: int = 0
+    cancelled: int = 0
+    rejected: int = 0
+    failed_batches: int = 0
+    waits: int = 0
+    queue_wait_total: float = 0.0
+    queue_wait_max: float = 0.0
+    batch_sizes: dict = field(default_factory=lambda: {bound: 0 for bound in (1, 2, 4, 8, 16, 32, 64, 128, float("inf"))})
+
+    def record_batch(self, size: int, waits: list[float]):
+        self.batches += 1
+        self.items += size
+        self.max_batch = max(self.max_batch, size)
+        self.waits += len(waits)
+        self.queue_wait_total += sum(waits)
+        self.queue_wait_max = max([self.queue_wait_max, *waits])
+        for bound in self.batch_sizes:
+            if size <= bound:
+                self.batch_sizes[bound] += 1
+                break
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": self.items / self.batches if self.batches else 0,
+            "max_batch": self.max_batch,
+            "batch_size_histogram": {("inf" if bound == float("inf") else str(bound)): count for bound, count in self.batch_sizes.items()},
+            "avg_queue_wait_ms": 1000 * self.queue_wait_total / self.waits if self.waits else 0,
+            "max_queue_wait_ms": 1000 * self.queue_wait_max,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "failed_batches": self.failed_batches,
+        }
+
+class EncodeDispatcher:
+    ''' Coalesces concurrent encode calls into batched CLIP requests.
+
+    Callers await encode() as they would clip.aencode(). Requests collected within
+    window_ms, or until max_batch inputs are queued, go out as one call and each caller
+    gets back its own rows. The pending queue is bounded so a slow encoder pushes back
+    on callers instead of growing without limit, and at most max_inflight batches are
+    sent at once. A request cancelled before its batch is sent is dropped from it. '''
+
+    def __init__(self, backend, cache=None, window_ms: float = CLIP_BATCH_WINDOW_MS, max_batch: int = CLIP_MAX_BATCH,
+                 max_pending: int = CLIP_MAX_PENDING, max_inflight: int = CLIP_MAX_INFLIGHT,
+                 enqueue_timeout: float = CLIP_ENQUEUE_TIMEOUT):
+        self.backend = backend
+        self.cache = cache
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.enqueue_timeout = enqueue_timeout
+        self.metrics = EncoderMetrics()
+        self.queue: asyncio.Queue | None = None
+        self.inflight: asyncio.Semaphore | None = None
+        self.runner: asyncio.Task | None = None
+        self.carry: EncodeRequest | None = None
+        self.batches: set[asyncio.Task] = set()
+
+    def start(self):
+        # Created lazily so the queue belongs to the loop that serves requests
+        if self.runner is None or self.runner.done():
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+            self.inflight = asyncio.Semaphore(self.max_inflight)
+            self.runner = asyncio.create_task(self.run(), name="CLIP Dispatcher")
+
+    async def stop(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+            self.runner = None
+        pending = [self.carry] if self.carry else []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for request in pending:
+            if not request.future.done():
+                request.future.set_exception(EncoderBusy("Encoder is shutting down"))
+        self.carry = None
+        if self.cache is not None:
+            self.cache.flush()
+
+    async def warmup(self):
+        await self.backend.warmup()
+        if self.cache is None:
+            return
+        # A remote model id is only configuration; check the persisted vectors against
+        # what the server returns now
+        try:
+            probe = await self.backend.aencode([CLIP_PROBE_TEXT])
+        except Exception as e:
+            print(f"Could not verify the CLIP model, disk embedding cache disabled: {str(e)}")
+            self.cache.disable_disk()
+            return
+        self.cache.verify(probe[0])
+
+    async def encode(self, inputs: list) -> np.ndarray:
+        inputs = list(inputs)
+        if not inputs:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.cache is None:
+            return await self.submit(inputs)
+        keys = [self.cache.key(item) for item in inputs]
+        return await self.cached(keys, lambda missing: self.submit([inputs[i] for i in missing]))
+
+    async def encode_images(self, files: list[tuple[str, str]]) -> np.ndarray:
+        ''' Embeddings of image files given as (path, sha256 of the contents). The file is
+        only downscaled into a data URI when its digest is not cached. '''
+        files = list(files)
+        if not files:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        async def encode(indices: list) -> np.ndarray:
+            uris = await asyncio.gather(*(encode_image_file(files[i][0]) for i in indices))
+            return await self.submit(list(uris))
+
+        if self.cache is None:
+            return await encode(range(len(files)))
+        keys = [self.cache.image_key(digest) for _, digest in files]
+        return await self.cached(keys, encode)
+
+    async def cached(self, keys: list, encode) -> np.ndarray:
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, await encode(missing)):
+                vectors[i] = vector
+                self.cache.put(keys[i], vector)
+        return np.stack(vectors)
+
+    async def submit(self, inputs: list) -> np.ndarray:
+        self.start()
+        request = EncodeRequest(inputs, asyncio.get_running_loop().create_future())
+        self.metrics.requests += 1
+        try:
+            await asyncio.wait_for(self.queue.put(request), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.rejected += 1
+            raise EncoderBusy("Encoder queue is full")
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            self.metrics.cancelled += 1
+            request.future.cancel()
+            raise
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.inflight.acquire()
+            first = self.carry or await self.queue.get()
+            self.carry = None
+            batch, size = [first], len(first.inputs)
+            deadline = loop.time() + self.window
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(request.inputs) > self.max_batch:
+                    # Keep it for the next batch rather than overshooting this one
+                    self.carry = request
+                    break
+                batch.append(request)
+                size += len(request.inputs)
+            task = asyncio.create_task(self.dispatch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def dispatch(self, batch: list[EncodeRequest]):
+        live = [request for request in batch if not request.future.done()]
+        try:
+            if not live:
+                return
+            inputs = [item for request in live for item in request.inputs]
+            now = time.monotonic()
+            self.metrics.record_batch(len(inputs), [now - request.enqueued_at for request in live])
+            vectors = await self.backend.aencode(inputs)
+            offset = 0
+            for request in live:
+                n = len(request.inputs)
+                if not request.future.done():
+                    request.future.set_result(vectors[offset:offset + n])
+                offset += n
+        except Exception as e:
+            self.metrics.failed_batches += 1
+            for request in live:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self.inflight.release()
+
+    def stats(self) -> dict:
+        stats = self.metrics.as_dict()
+        stats["pending"] = self.queue.qsize() if self.queue is not None else 0
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,88 @@
+import os
+import base64
+import asyncio
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+from imagehash import phash
+
+# "process" keeps decode/phash off the GIL of the event loop, "thread" is the old behaviour
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "process")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 2))
+
+# These functions run inside the pool, so they take paths and return plain data only.
+
+def inspect_image(path: str) -> dict:
+    ''' Format detection, metadata and phash for one file.
+
+    For animated images only the first and last frames are converted; the frames in
+    between are never copied out of the decoder the way list(ImageSequence.Iterator())
+    did. GIF compositing still makes Pillow walk them when seeking to the last frame. '''
+    with Image.open(path) as image:
+        frames = getattr(image, "n_frames", 1)
+        meta = {
+            "format": image.format,
+            "width": image.width,
+            "height": image.height,
+            "frames": frames,
+            "duration": image.info.get("duration"),
+        }
+        if image.format == 'GIF':
+            image.seek(0)
+            first_frame_hash = phash(image.convert("RGB"))
+            if frames > 1:
+                image.seek(frames - 1)
+                last_frame_hash = phash(image.convert("RGB"))
+            else:
+                last_frame_hash = first_frame_hash
+            meta["hash"] = f"{first_frame_hash}{last_frame_hash}"
+        else:
+            meta["hash"] = str(phash(image))
+    return meta
+
+def thumbnail_data_uri(path: str, size: int) -> str:
+    ''' Downscaled RGB JPEG of the first frame as a data URI '''
+    with Image.open(path) as image:
+        # draft() lets the JPEG decoder downscale while decoding instead of after
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+class ImageEngine:
+    def __init__(self, kind: str = IMAGE_EXECUTOR, workers: int = IMAGE_WORKERS):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown image executor: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.executor: Executor | None = None
+
+    def start(self) -> Executor:
+        if self.executor is None:
+            if self.kind == "process":
+                # spawn, not fork: the server process already runs threads and an event loop
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.start(), fn, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+image_engine = ImageEngine()
+
+async def process_image(path: str) -> dict:
+    return await image_engine.run(inspect_image, path)
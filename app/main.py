@@ -7,32 +7,83 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from .database import Base, engine
+from .database import Base, engine, milvus_client, create_tables, SessionLocal
+from .compact import CompactTier
 from .routes.users.route import router as users_router
 from .routes.images.route import router as images_router
+from .routes.search.route import router as search_router
 import os
 # from .routes.users.crud import create_admin_user
 from .routes.users.utils import get_db
 from .routes.images.crud import update_tags_from_list
+from .routes.users.crud import update_follow_counts
 from .routes.images.utils import sync_dir
+from .routes.images.ingest import ingest_queue
+from .routes.images.outbox import vector_outbox
+from .routes.images.neighbours import neighbour_lists
+from .routes.images.events import event_buffer
+from .routes.images.trending import trending
+from .routes.images.recommend import recommender
+from .routes.images.feed import timelines
+from .routes.images.backfill import promote_backfill
+from .imaging import image_engine
+from .routes.images.dedup import phash_index
+from .routes.images.tagger import tag_store
+from .routes.images.tagcache import tag_cache
+from .common import encoder, clip_backend
 import asyncio  
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
-    db = await anext(get_db())
+    await encoder.warmup()
+    await create_tables()
+    db = SessionLocal()
+    await phash_index.load(db)
+    await tag_cache.load(db)
+    await trending.load(db)
+    # Swap in a finished re-embedding built with the model this process serves
+    await promote_backfill(db, clip_backend.model_id)
     task = asyncio.create_task(update_tags_from_list(db), name="Update Tags")
+    tag_sync = asyncio.create_task(tag_store.refresh(), name="Sync Tag Embeddings")
+    follow_counts = asyncio.create_task(update_follow_counts(), name="Reconcile Follow Counts")
+    await ingest_queue.start()
+    await vector_outbox.start()
+    await neighbour_lists.start()
+    await event_buffer.start()
+    await trending.start()
+    await timelines.start()
+    compact_refit = None
+    if isinstance(milvus_client, CompactTier):
+        interval = float(os.getenv("VECTOR_COMPACT_REFIT_INTERVAL", 60 * 60))
+        compact_refit = asyncio.create_task(milvus_client.run(interval), name="Refit Compact Tier")
 
     yield
     # Shutdown logic
-    task.cancel()
-    await task
+    loops = [task, tag_sync, follow_counts] + ([compact_refit] if compact_refit else [])
+    for loop in loops:
+        loop.cancel()
+    # Cancelled loops re-raise CancelledError when awaited; collect them so shutdown carries on
+    await asyncio.gather(*loops, return_exceptions=True)
+    await ingest_queue.stop()
+    await vector_outbox.stop()
+    await neighbour_lists.stop()
+    # Drained before the engine is disposed
+    await event_buffer.stop()
+    # After the buffer, so its last batch is in the final snapshot
+    await trending.stop()
+    await timelines.stop()
+    await encoder.stop()
+    image_engine.shutdown()
+    await db.close()
+    await engine.dispose()
     
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(router=users_router)
 app.include_router(router=images_router)
+app.include_router(router=search_router)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -45,13 +96,13 @@ STORAGE_DIR = os.getenv("STORAGE_DIR")
 os.makedirs(f"{STORAGE_DIR}/avatar", exist_ok=True)
 os.makedirs(f"{STORAGE_DIR}/images", exist_ok=True)
 os.makedirs(f"{STORAGE_DIR}/clips", exist_ok=True)
+os.makedirs(f"{STORAGE_DIR}/incoming", exist_ok=True)
+os.makedirs(f"{STORAGE_DIR}/tmp", exist_ok=True)
 
 app.mount("/avatar", StaticFiles(directory=f"{STORAGE_DIR}/avatar"), name="avatar")
 app.mount("/images", StaticFiles(directory=f"{STORAGE_DIR}/images"), name="images")
 app.mount("/gifs", StaticFiles(directory=f"{STORAGE_DIR}/clips"), name="clips")
 
-Base.metadata.create_all(bind=engine)
-
 templates = Jinja2Templates(directory="app/templates")
 
 
@@ -60,6 +111,10 @@ templates = Jinja2Templates(directory="app/templates")
 async def home():
     return RedirectResponse(url="/docs")
 
+@app.get("/metrics")
+async def metrics():
+    return {"encoder": encoder.stats(), "vector_outbox": await vector_outbox.stats(), "neighbours": neighbour_lists.stats(), "events": event_buffer.stats(), "trending": trending.stats(), "recommend": recommender.stats(), "feed": timelines.stats()}
+
 @app.exception_handler(404)
 async def custom_404_handler(request, __):
     return templates.TemplateResponse("404.html", {"request": request})
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import json
+import base64
+import datetime
+
+from sqlalchemy import tuple_
+
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 200))
+
+def page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(created_at: datetime.datetime, key) -> str:
+    raw = json.dumps([created_at.isoformat(), key])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.datetime.fromisoformat(created_at), key
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def keyset(query, created_at, key, cursor: str | None, limit: int):
+    ''' Newest first, starting after `cursor`. One extra row is fetched to tell whether
+    another page follows; (created_at, key) must be indexed for this to stay a range scan. '''
+    if cursor:
+        query = query.where(tuple_(created_at, key) < decode_cursor(cursor))
+    return query.order_by(created_at.desc(), key.desc()).limit(limit + 1)
+
+def page(rows: list, limit: int, created_at: str, key: str) -> dict:
+    items = [dict(row._mapping) for row in rows[:limit]]
+    next_cursor = encode_cursor(items[-1][created_at], items[-1][key]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,197 @@
+import heapq
+from bisect import bisect_left, insort
+
+ALL = "all"
+
+class Leaderboard:
+    ''' The `capacity` highest scores of one group, as (score, key) in ascending order.
+
+    Updates are a bisect and a short list move. Only members are tracked, so an item whose
+    score drops may stay ahead of an outsider that now beats it until the next rebuild. '''
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: list[tuple[float, str]] = []
+        self.scores: dict[str, float] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, key: str, score: float):
+        self.remove(key)
+        if len(self.entries) < self.capacity or score > self.entries[0][0]:
+            insort(self.entries, (score, key))
+            self.scores[key] = score
+            if len(self.entries) > self.capacity:
+                _, evicted = self.entries.pop(0)
+                del self.scores[evicted]
+
+    def remove(self, key: str):
+        score = self.scores.pop(key, None)
+        if score is not None:
+            del self.entries[bisect_left(self.entries, (score, key))]
+
+    def top(self, n: int, offset: int = 0) -> list[tuple[str, float]]:
+        end = len(self.entries) - offset
+        return [(key, score) for score, key in reversed(self.entries[max(0, end - n):max(0, end)])]
+
+    def fill(self, scores):
+        ''' Replaces the board with the best of (key, score) pairs '''
+        self.entries = sorted((score, key) for key, score in heapq.nlargest(self.capacity, scores, key=lambda item: item[1]))
+        self.scores = {key: score for score, key in self.entries}
+
+class Trending:
+    ''' Exponentially decayed popularity, updated one event at a time.
+
+    Scores use forward decay: an event of weight w at time t adds w * 2^((t - landmark) /
+    half_life). Every score would be multiplied by the same 2^(-(now - landmark) / half_life)
+    to decay it to `now`, so ranking never touches the scores and an event costs O(1) plus
+    the boards of its groups. rebase() applies that factor and moves the landmark before the
+    exponent can overflow, dropping items that have decayed below `floor`.
+
+    Each item is ranked on the ALL board and on the board of every group it belongs to
+    (e.g. its tags and collections), each keeping the top `capacity` items.
+
+    The weight added since the last snapshot() is kept apart as `pending`, so several
+    processes can add their own deltas to a shared score and merge() the total back. '''
+
+    def __init__(self, half_life: float, capacity: int, landmark: float, floor: float = 1e-3, horizon: float = 32):
+        self.half_life = half_life
+        self.capacity = capacity
+        self.landmark = landmark
+        self.floor = floor
+        # Rebase after this many half-lives, far below float overflow
+        self.horizon = horizon
+        self.scores: dict[str, float] = {}
+        self.groups: dict[str, tuple] = {}
+        self.boards: dict[str, Leaderboard] = {ALL: Leaderboard(capacity)}
+        # Forward-decayed weight added since the last snapshot, by key
+        self.pending: dict[str, float] = {}
+        self.events = 0
+
+    def __len__(self):
+        return len(self.scores)
+
+    def growth(self, at: float) -> float:
+        return 2.0 ** ((at - self.landmark) / self.half_life)
+
+    def board(self, group: str) -> Leaderboard:
+        board = self.boards.get(group)
+        if board is None:
+            board = self.boards[group] = Leaderboard(self.capacity)
+        return board
+
+    def add(self, key: str, weight: float, at: float):
+        if at - self.landmark > self.horizon * self.half_life:
+            self.rebase(at)
+        weight *= self.growth(at)
+        self.pending[key] = self.pending.get(key, 0.0) + weight
+        self.events += 1
+        self.set_score(key, self.scores.get(key, 0.0) + weight)
+
+    def set_score(self, key: str, score: float):
+        self.scores[key] = score
+        self.boards[ALL].update(key, score)
+        for group in self.groups.get(key, ()):
+            self.board(group).update(key, score)
+
+    def set_groups(self, key: str, groups):
+        ''' Moves `key` to the boards of `groups`, e.g. after it was tagged or collected '''
+        groups = tuple(groups)
+        old = self.groups.get(key, ())
+        for group in set(old) - set(groups):
+            board = self.boards.get(group)
+            if board is not None:
+                board.remove(key)
+        self.groups[key] = groups
+        score = self.scores.get(key)
+        if score is not None:
+            for group in groups:
+                self.board(group).update(key, score)
+
+    def remove(self, key: str):
+        self.scores.pop(key, None)
+        self.pending.pop(key, None)
+        self.boards[ALL].remove(key)
+        for group in self.groups.pop(key, ()):
+            board = self.boards.get(group)
+            if board is not None:
+                board.remove(key)
+
+    def load(self, key: str, score: float, scored_at: float, groups=()):
+        ''' Restores a score decayed to `scored_at`, as written by snapshot(); call rebuild() after '''
+        self.scores[key] = score * self.growth(scored_at)
+        self.groups[key] = tuple(groups)
+
+    def merge(self, key: str, score: float, scored_at: float):
+        ''' Replaces the score of `key` with a shared one decayed to `scored_at`, keeping the
+        weight added here since the last snapshot on top '''
+        self.set_score(key, score * self.growth(scored_at) + self.pending.get(key, 0.0))
+
+    def score(self, key: str, now: float) -> float:
+        return self.scores.get(key, 0.0) / self.growth(now)
+
+    def top(self, n: int, now: float, group: str = ALL, offset: int = 0) -> list[tuple[str, float]]:
+        board = self.boards.get(group)
+        if board is None:
+            return []
+        decay = 1.0 / self.growth(now)
+        return [(key, score * decay) for key, score in board.top(n, offset)]
+
+    def rebase(self, now: float) -> list[str]:
+        ''' Decays every score to `now`, makes `now` the landmark and drops items below `floor`.
+        Returns the dropped keys. '''
+        decay = 1.0 / self.growth(now)
+        self.landmark = now
+        dropped = []
+        for key, score in self.scores.items():
+            score *= decay
+            if abs(score) < self.floor:
+                dropped.append(key)
+            else:
+                self.scores[key] = score
+        for key in self.pending:
+            self.pending[key] *= decay
+        for key in dropped:
+            del self.scores[key]
+            self.groups.pop(key, None)
+            self.pending.pop(key, None)
+        self.rebuild()
+        return dropped
+
+    def rebuild(self):
+        ''' Refills every board from the scores, which also corrects drift from falling scores '''
+        members: dict[str, list] = {}
+        for key, groups in self.groups.items():
+            score = self.scores.get(key)
+            if score is None:
+                continue
+            for group in groups:
+                members.setdefault(group, []).append((key, score))
+        self.boards = {ALL: Leaderboard(self.capacity)}
+        self.boards[ALL].fill(self.scores.items())
+        for group, scores in members.items():
+            self.board(group).fill(scores)
+
+    def snapshot(self, now: float) -> list[tuple[str, float]]:
+        ''' (key, weight added since the last snapshot, decayed to `now`) of every changed item '''
+        decay = 1.0 / self.growth(now)
+        rows = [(key, weight * decay) for key, weight in self.pending.items() if key in self.scores]
+        self.pending = {}
+        return rows
+
+    def restore(self, rows: list[tuple[str, float]], now: float):
+        ''' Puts back the deltas of a snapshot that could not be written '''
+        growth = self.growth(now)
+        for key, weight in rows:
+            if key in self.scores:
+                self.pending[key] = self.pending.get(key, 0.0) + weight * growth
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self.scores),
+            "boards": len(self.boards),
+            "events": self.events,
+            "pending": len(self.pending),
+            "landmark": self.landmark,
+        }
@@ -0,0 +1,121 @@
+from ...common import *
+from .crud import get_media_after, get_vector_attrs, create_backfill, get_backfill, update_backfill, requeue_backfill_changes, clear_neighbours
+from .models import BackfillJobs
+
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", 64))
+BACKFILL_RATE = float(os.getenv("BACKFILL_RATE", 20))  # images per second
+
+class Backfill:
+    ''' Re-embeds the whole catalog into a shadow collection, then swaps it in.
+
+    Media rows are streamed in (created_at, mid) order, their files encoded in batches
+    with `backend`, and written to a shadow store named after the job. The last key
+    written is checkpointed in `backfill_jobs` after every batch, so an interrupted run
+    picks up where it stopped. A token bucket caps the rate at `rate` images per second
+    to leave CLIP and the vector store to live traffic. Uploads that land while the job
+    runs sort after the cursor and are picked up too.
+
+    Once the cursor reaches the end the job is 'done'. It is swapped in at the next
+    startup of a server whose encoder matches the job's model (see promote_backfill):
+    a running server still encodes queries with its own model, possibly of another
+    dimension, so it must never search the shadow. Until then the vector outbox records
+    the media it flushes to the live store, and their scalars are refreshed in the
+    shadow on promotion. '''
+
+    def __init__(self, backend, batch_size: int = BACKFILL_BATCH, rate: float = BACKFILL_RATE):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.rate = rate
+        self.next_at = 0.0
+
+    async def throttle(self, n: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.next_at > now:
+            await asyncio.sleep(self.next_at - now)
+        self.next_at = max(now, self.next_at) + n / self.rate
+
+    async def embed(self, db: AsyncSession, medias: list) -> tuple[list[dict], int]:
+        encoded = await asyncio.gather(
+            *(encode_image_file(os.path.join(STORAGE_DIR, media.url)) for media in medias),
+            return_exceptions=True
+        )
+        found = []
+        for media, image in zip(medias, encoded):
+            if isinstance(image, Exception):
+                print(f"Backfill skipped {media.mid}: {str(image)}")
+                continue
+            found.append((media, image))
+        if not found:
+            return [], len(medias)
+
+        texts = [media.title + (media.desc or "") + ' '.join(tag.name for tag in media.tags) for media, _ in found]
+        # One encoder call per batch: images first, then their texts
+        embeddings = await self.backend.aencode([image for _, image in found] + texts)
+        img_embeds, text_embeds = embeddings[:len(found)], embeddings[len(found):]
+        attrs = await get_vector_attrs(db, [media.mid for media, _ in found])
+        rows = [
+            {"id": media.mid, "image_embed": img_embed.tolist(), "text_embed": text_embed.tolist(), **attrs.get(media.mid, {})}
+            for (media, _), img_embed, text_embed in zip(found, img_embeds, text_embeds)
+        ]
+        return rows, len(medias) - len(found)
+
+    async def run(self, db: AsyncSession, restart: bool = False) -> BackfillJobs:
+        job = await get_backfill(db, ['running', 'done'])
+        if job and (restart or job.model_id != self.backend.model_id):
+            if not restart:
+                raise Exception(f"Backfill {job.bid} for {job.model_id} is unfinished; pass restart to abandon it")
+            await update_backfill(db, job.bid, status='failed', error="Abandoned")
+            job = None
+        if job is None:
+            dimension = len((await self.backend.aencode(["dimension probe"]))[0])
+            job = await create_backfill(db, f"embeddings_{int(datetime.datetime.now().timestamp())}", self.backend.model_id, dimension)
+            print(f"Started backfill {job.bid} with {job.model_id} ({dimension}-dim)")
+        else:
+            print(f"Resuming backfill {job.bid} after {job.processed} rows")
+
+        shadow = milvus_client.shadow(job.bid, job.dimension)
+        await asyncio.to_thread(shadow.setup_collection)
+        bid, processed, skipped = job.bid, job.processed, job.skipped
+        cursor = (job.cursor_created_at, job.cursor_mid)
+
+        while job.status == 'running':
+            medias = await get_media_after(db, *cursor, self.batch_size)
+            if not medias:
+                await update_backfill(db, bid, status='done')
+                break
+            await self.throttle(len(medias))
+            try:
+                rows, missing = await self.embed(db, medias)
+                if rows:
+                    await shadow.upsert_batch(rows)
+            except Exception as e:
+                await db.rollback()
+                await update_backfill(db, bid, error=str(e))
+                raise
+            cursor = (medias[-1].created_at, medias[-1].mid)
+            processed, skipped = processed + len(rows), skipped + missing
+            await update_backfill(db, bid, cursor_created_at=cursor[0], cursor_mid=cursor[1], processed=processed, skipped=skipped, error=None)
+            print(f"Backfill {bid}: {processed} rows written, {skipped} skipped")
+
+        return await get_backfill(db, ['running', 'done'])
+
+async def promote(db: AsyncSession, bid: str, shadow):
+    milvus_client.promote(shadow)
+    await update_backfill(db, bid, status='swapped')
+    # Neighbour lists were ranked with the old vectors and are rebuilt from the new ones
+    await clear_neighbours(db)
+
+async def promote_backfill(db: AsyncSession, model_id: str) -> bool:
+    ''' Called at startup: swaps in a finished backfill built with the model now being served '''
+    job = await get_backfill(db, ['done'])
+    if job is None or job.model_id != model_id:
+        return False
+    shadow = milvus_client.shadow(job.bid, job.dimension)
+    await asyncio.to_thread(shadow.setup_collection)
+    await promote(db, job.bid, shadow)
+    # After the swap: changes flushed until the job left 'done' are recorded, later ones
+    # already reach the new collection through the alias
+    dropped, refreshed = await requeue_backfill_changes(db, job.bid)
+    print(f"Promoted backfill {job.bid}, dropped {dropped} queued vectors from the previous model, refreshing {refreshed} changed media")
+    return True
@@ -1,45 +1,64 @@
 from ...common import *
-from .models import Media, Tags, MediaTags, CollectionTags, Collections, CollectionMedia, Preferences, Activity, CollectionAccessList, CollectionAccessRequest
+from .models import Media, Tags, MediaTags, CollectionTags, Collections, CollectionMedia, Preferences, Activity, CollectionAccessList, CollectionAccessRequest, IngestJobs, VectorOutbox, BackfillJobs, BackfillChanges, MediaNeighbours, MediaScores, UserTastes
 from ..users.models import Users
-
-async def add_tags(db: Session, tags: list):
-    tids = []
-    for tag in tags:
-        new_tag = Tags(name=tag)
-        db.add(new_tag)
-        tids.append(new_tag.tid)
-    db.commit()
+from .dedup import phash_index
+from .tagger import tag_store, TAG_TOP_K, TAG_MIN_SCORE
+from .tagcache import tag_cache
+from .feed import timelines
+
+async def upsert_tags(db: AsyncSession, names: list) -> dict[str, int]:
+    ''' Creates the missing tags in one statement and returns the tid of every name.
+    Not committed, and not cached until the caller commits. '''
+    names = list(dict.fromkeys(name for name in names if name))
+    tids = await tag_cache.resolve(db, names)
+    missing = [name for name in names if name not in tids]
+    if missing:
+        created = await db.execute(
+            pg_insert(Tags).values([{"name": name} for name in missing])
+            .on_conflict_do_nothing(index_elements=[Tags.name])
+            .returning(Tags.name, Tags.tid)
+        )
+        tids.update(created.all())
+        # Names inserted concurrently by another transaction come back from neither statement
+        raced = [name for name in missing if name not in tids]
+        if raced:
+            tids.update((await db.execute(select(Tags.name, Tags.tid).where(Tags.name.in_(raced)))).all())
     return tids
 
-async def add_collection(db: Session, **kwargs) -> int:
+async def add_tags(db: AsyncSession, tags: list):
+    tids = await upsert_tags(db, tags)
+    await db.commit()
+    tag_cache.add(tids)
+    await tag_store.add(tags)
+    return [tids[tag] for tag in tags if tag in tids]
+
+async def add_collection(db: AsyncSession, **kwargs) -> int:
     user_id = kwargs.get('uid')
     tags_data = kwargs.pop('tags', [])
-    user = db.query(Users).filter(Users.uid == user_id).first()
+    user = await db.scalar(select(Users.uid).where(Users.uid == user_id))
     
     if not user:
         raise ValueError("User not found.")
 
     collection = Collections(**kwargs)
-
-    for tag_name in tags_data:
-        tag = db.query(Tags).filter(Tags.name == tag_name).first()
-        if not tag:
-            tag = Tags(name=tag_name)
-            db.add(tag) 
-        collection.tags.append(tag)  
-    user.collections.append(collection)
-    
     db.add(collection)
-    db.commit()
-    db.refresh(collection)
+    tids = await upsert_tags(db, tags_data)
+    await db.flush()
+    # The owner is on the access list of their own collections
+    db.add(CollectionAccessList(cid=collection.cid, uid=user_id))
+    if tids:
+        await db.execute(insert(CollectionTags), [{"cid": collection.cid, "tid": tid} for tid in set(tids.values())])
+    await db.commit()
+    tag_cache.add(tids)
+    await tag_store.add(tags_data)
 
     return collection.cid
 
 
-async def get_collection_images(db: Session, cid: int, uid: int = None):
-    collection = db.query(Collections).filter(Collections.cid == cid).options(
+async def get_collection_images(db: AsyncSession, cid: int, uid: int = None):
+    collection = (await db.execute(select(Collections).where(Collections.cid == cid).options(
         joinedload(Collections.access_list)
-    ).first()
+    ))).unique().scalars().first()
 
     if not collection:
         return []
@@ -48,57 +67,54 @@ async def get_collection_images(db: Session, cid: int, uid: int = None):
     if collection.scope == 'private' and not priviledged:
         return []
 
-    images = db.query(CollectionMedia).filter(CollectionMedia.cid == cid).options(
+    images = (await db.execute(select(CollectionMedia).where(CollectionMedia.cid == cid).options(
         joinedload(CollectionMedia.media).options(joinedload(Media.tags), joinedload(Media.collections))
-    ).all()
+    ))).unique().scalars().all()
 
     return images
 
-async def grant_access(db:Session, cid:int, uids:list):
+async def grant_access(db: AsyncSession, cid:int, uids:list):
     for uid in uids:
         # Check if user already has access
-        isgranted =  db.query(CollectionAccessList).filter(CollectionAccessList.cid == cid, CollectionAccessList.uid == uid).first()
+        isgranted = await db.scalar(select(CollectionAccessList).where(CollectionAccessList.cid == cid, CollectionAccessList.uid == uid))
         if not isgranted:
             new_access = CollectionAccessList(cid=cid, uid=uid)
             db.add(new_access)
             # delete request
-            db.query(CollectionAccessRequest).filter(CollectionAccessRequest.cid == cid, CollectionAccessRequest.uid == uid).delete()
-    db.commit()
+            await db.execute(delete(CollectionAccessRequest).where(CollectionAccessRequest.cid == cid, CollectionAccessRequest.uid == uid))
+    await db.commit()
 
-async def request_access(db:Session, cid:int, uid:str):
+async def request_access(db: AsyncSession, cid:int, uid:str):
     new_request = CollectionAccessRequest(cid=cid, uid=uid)
     db.add(new_request)
-    db.commit()
+    await db.commit()
 
-async def get_collection_info(db: Session, cid: int):
-    collection = db.query(Collections).filter(Collections.cid == cid).first()
+async def get_collection_info(db: AsyncSession, cid: int):
+    collection = await db.scalar(select(Collections).where(Collections.cid == cid))
     if not collection:
         return None
     
     return collection
 
-async def get_collections(db:Session) -> list:
-    collections = db.query(Collections).options(
-        joinedload(Collections.tags),
-        joinedload(Collections.media)
-    ).all()
-
-    # return only public collections
-    return [collection for collection in collections if collection.scope == 'public']
-
-async def get_collections_by_user(db:Session, uid:str) -> list:
-    collections = db.query(Collections).filter(Collections.uid == uid).options(
-        joinedload(Collections.tags),
-        joinedload(Collections.media)
-    ).all()
-    return [collection for collection in collections if collection.scope == 'public']
-
-async def get_images(db: Session, mid: int, uid: str = None):
+async def get_collection_cards(db: AsyncSession, limit: int, cursor: str = None, uid: str = None, owner: str = None) -> dict:
+    ''' A page of public collections (plus the viewer's own), newest first, without loading their media '''
+    limit = page_size(limit)
+    media_count = select(func.count(CollectionMedia.mid)).where(CollectionMedia.cid == Collections.cid).scalar_subquery()
+    query = select(
+        Collections.cid, Collections.name, Collections.desc, Collections.scope, Collections.uid, Collections.created_at,
+        media_count.label('media_count')
+    ).where(or_(Collections.scope == 'public', Collections.uid == uid) if uid else Collections.scope == 'public')
+    if owner:
+        query = query.where(Collections.uid == owner)
+    rows = (await db.execute(keyset(query, Collections.created_at, Collections.cid, cursor, limit))).all()
+    return page(rows, limit, 'created_at', 'cid')
+
+async def get_images(db: AsyncSession, mid: int, uid: str = None):
     # Fetch the media with its collections and tags
-    image = db.query(Media).options(
+    image = (await db.execute(select(Media).options(
         joinedload(Media.collections),
         joinedload(Media.tags)
-    ).filter(Media.mid == mid).first()
+    ).where(Media.mid == mid))).unique().scalars().first()
     
     if image is None:
         return None
@@ -111,93 +127,462 @@ async def get_images(db: Session, mid: int, uid: str = None):
     # Return the image if it has collections or if the requester is the owner
     return image if image.collections or uid == image.uid else []
 
-async def add_media(db: Session, **kwargs) -> int:
-    user_id = kwargs.get('uid')
-    tags_data = kwargs.pop('tags', [])
-    collections_data = kwargs.pop('collections', [])
-
-    user = db.query(Users).filter(Users.uid == user_id).first()
+def outbox_upsert(mid: str, image_embed, text_embed) -> VectorOutbox:
+    return VectorOutbox(
+        mid=mid,
+        op='upsert',
+        image_embed=np.asarray(image_embed, dtype=np.float32).tobytes(),
+        text_embed=np.asarray(text_embed, dtype=np.float32).tobytes()
+    )
+
+async def add_media(db: AsyncSession, **kwargs) -> int:
+    ''' Single-item add_media_batch: the same fixed number of round-trips whatever the tag count '''
+    uid = kwargs.pop('uid')
+    [result] = await add_media_batch(db, uid, [kwargs])
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+async def add_media_batch(db: AsyncSession, uid: str, items: list[dict]) -> list:
+    ''' Inserts every valid item in one transaction. Returns a mid or the validation error for each item. '''
+    user = await db.scalar(select(Users.uid).where(Users.uid == uid))
     if not user:
         raise ValueError("User not found.")
-    
-    media = Media(**kwargs)
-
-    for tag_name in tags_data:
-        tag = db.query(Tags).filter(Tags.name == tag_name).first()
-        if not tag:
-            raise Exception("Tag not found.")
-        media.tags.append(tag)  # Use relationship to add tag to media
-
-    for collection_data in collections_data:
-        collection = db.query(Collections).filter(Collections.name == collection_data).options(
-            joinedload(Collections.access_list.and_(CollectionAccessList.uid == user_id))
-        ).first()
-        if not collection:
-            raise Exception("Collection not found.")
-        if collection.scope == 'private' and not any([access.uid == user_id for access in collection.access_list]):
-            raise Exception("User does not have access to this collection.")
-        
-        media.collections.append(collection)  # Use relationship to add collection to media
-
-    user.media.append(media)  # Attach media to user
-
-    db.add(media)
-    db.commit()
-    db.refresh(media)
-    
-    return media.mid
 
-async def get_images(db:Session):
-    images = db.query(Media).options(
-        joinedload(Media.tags),
-        joinedload(Media.collections.and_(Collections.scope == 'public'))
-    ).all()
-    return images
-
-
-async def add_preference(db:Session, uid:str, mid:int, attr:str):
-    new_preference = Preferences(uid=uid, mid=mid, attr=attr)
-    db.add(new_preference)
-    db.commit()
+    tag_names = {name for item in items for name in item.get('tags', [])}
+    collection_names = {name for item in items for name in item.get('collections', [])}
 
-async def add_view(db:Session, uid:str, mid:int):
-    new_view = Activity(uid=uid, mid=mid)
-    db.add(new_view)
-    db.commit()
+    tags = await tag_cache.resolve(db, list(tag_names))
 
-async def is_duplicate_image(db:Session, hash:str):
-    return db.query(Media).filter(Media.hash == hash).first()
+    collections = {}
+    if collection_names:
+        rows = (await db.execute(select(Collections).where(Collections.name.in_(collection_names)).options(
+            joinedload(Collections.access_list.and_(CollectionAccessList.uid == uid))
+        ).order_by(Collections.cid))).unique().scalars().all()
+        for collection in rows:
+            collections.setdefault(collection.name, collection)
 
-async def update_tags_from_list(db)-> None:
-    print("Task 0 started")
-    return
+    results, medias, media_tags, collection_media, outbox = [], [], [], [], []
+    for item in items:
+        item = dict(item)
+        image_embed = item.pop('image_embed', None)
+        text_embed = item.pop('text_embed', None)
+        try:
+            tids = set()
+            for tag_name in item.pop('tags', []):
+                if tag_name not in tags:
+                    raise Exception("Tag not found.")
+                tids.add(tags[tag_name])
+
+            cids = set()
+            for collection_name in item.pop('collections', []):
+                collection = collections.get(collection_name)
+                if not collection:
+                    raise Exception("Collection not found.")
+                if collection.scope == 'private' and not any([access.uid == uid for access in collection.access_list]):
+                    raise Exception("User does not have access to this collection.")
+                cids.add(collection.cid)
+        except Exception as e:
+            results.append(e)
+            continue
+
+        media = Media(uid=uid, **item)
+        medias.append(media)
+        results.append(media.mid)
+        if image_embed is not None:
+            outbox.append(outbox_upsert(media.mid, image_embed, text_embed))
+        media_tags.extend({"mid": media.mid, "tid": tid} for tid in tids)
+        collection_media.extend({"cid": cid, "mid": media.mid} for cid in cids)
+
+    if not medias:
+        return results
+
+    try:
+        db.add_all(medias)
+        await db.flush()
+        db.add_all(outbox)
+        if media_tags:
+            await db.execute(insert(MediaTags), media_tags)
+        if collection_media:
+            await db.execute(insert(CollectionMedia), collection_media)
+        await timelines.fan_out(db, [media.mid for media in medias])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+    for media in medias:
+        phash_index.add(media.mid, media.hash)
+    return results
+
+async def delete_media(db: AsyncSession, mids: list):
+    await db.execute(delete(Media).where(Media.mid.in_(mids)).execution_options(synchronize_session=False))
+    db.add_all([VectorOutbox(mid=mid, op='delete') for mid in mids])
+    await db.commit()
+    for mid in mids:
+        phash_index.remove(mid)
+
+async def get_media_cards(db: AsyncSession, limit: int, cursor: str = None, uid: str = None, owner: str = None, nsfw: bool = False) -> dict:
+    ''' A page of the media visible to `uid` with only the columns a grid needs, newest first '''
+    limit = page_size(limit)
+    public = select(CollectionMedia.mid).join(Collections, Collections.cid == CollectionMedia.cid).where(
+        CollectionMedia.mid == Media.mid, Collections.scope == 'public'
+    ).exists()
+    query = select(
+        Media.mid, Media.url, Media.title, Media.span, Media.color, Media.isNSFW, Media.uid, Media.created_at
+    ).where(or_(public, Media.uid == uid) if uid else public)
+    if owner:
+        query = query.where(Media.uid == owner)
+    if not nsfw:
+        query = query.where(Media.isNSFW.isnot(True))
+    rows = (await db.execute(keyset(query, Media.created_at, Media.mid, cursor, limit))).all()
+    return page(rows, limit, 'created_at', 'mid')
+
+async def get_media_cards_by_mids(db: AsyncSession, mids: list, uid: str = None, nsfw: bool = False) -> dict:
+    ''' Grid cards of the given media that `uid` may see, by mid '''
+    if not mids:
+        return {}
+    public = select(CollectionMedia.mid).join(Collections, Collections.cid == CollectionMedia.cid).where(
+        CollectionMedia.mid == Media.mid, Collections.scope == 'public'
+    ).exists()
+    query = select(
+        Media.mid, Media.url, Media.title, Media.span, Media.color, Media.isNSFW, Media.uid, Media.created_at
+    ).where(Media.mid.in_(mids), or_(public, Media.uid == uid) if uid else public)
+    if not nsfw:
+        query = query.where(Media.isNSFW.isnot(True))
+    return {row.mid: dict(row._mapping) for row in await db.execute(query)}
+
+async def upsert_preferences(db: AsyncSession, rows: list[dict]) -> None:
+    ''' rows: {"uid", "mid", "attr"}, unique per (uid, mid); a later preference replaces the earlier one '''
+    stmt = pg_insert(Preferences).values(rows)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[Preferences.uid, Preferences.mid],
+        set_={"attr": stmt.excluded.attr},
+    ))
+
+async def upsert_views(db: AsyncSession, rows: list[dict]) -> None:
+    ''' rows: {"uid", "mid", "viewed_at"}, unique per (uid, mid); a repeat view refreshes viewed_at '''
+    stmt = pg_insert(Activity).values(rows)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[Activity.uid, Activity.mid],
+        set_={"viewed_at": func.greatest(Activity.viewed_at, stmt.excluded.viewed_at)},
+    ))
+
+async def get_media_groups(db: AsyncSession, mids: list) -> dict[str, list]:
+    ''' Trending groups of each media item: its tags and collections '''
+    groups = {mid: [] for mid in mids}
+    for mid, tid in await db.execute(select(MediaTags.mid, MediaTags.tid).where(MediaTags.mid.in_(mids))):
+        groups[mid].append(f"tag:{tid}")
+    for mid, cid in await db.execute(select(CollectionMedia.mid, CollectionMedia.cid).where(CollectionMedia.mid.in_(mids))):
+        groups[mid].append(f"collection:{cid}")
+    return groups
+
+async def get_media_scores(db: AsyncSession, since: datetime.datetime = None):
+    ''' Streams (mid, score, scored_at) of the shared trending scores, or of those written since `since` '''
+    query = select(MediaScores.mid, MediaScores.score, MediaScores.scored_at)
+    if since is not None:
+        query = query.where(MediaScores.scored_at >= since)
+    return await db.stream(query.execution_options(yield_per=5000))
+
+def decayed_score(scored_at, half_life: float):
+    # The stored score decayed from its scored_at to `scored_at`
+    return MediaScores.score * func.power(2.0, -func.extract('epoch', scored_at - MediaScores.scored_at) / half_life)
+
+async def add_media_scores(db: AsyncSession, rows: list[dict], half_life: float) -> None:
+    ''' rows: {"mid", "score", "scored_at"}, each score the weight one process added since its
+    last snapshot. Added to the stored score decayed to the new scored_at, so every process's
+    events count once whichever writes first. '''
+    stmt = pg_insert(MediaScores).values(rows)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[MediaScores.mid],
+        set_={"score": decayed_score(stmt.excluded.scored_at, half_life) + stmt.excluded.score, "scored_at": stmt.excluded.scored_at},
+    ))
+
+async def delete_media_scores(db: AsyncSession, mids: list, at: datetime.datetime, half_life: float, floor: float) -> None:
+    ''' Drops the scores that have faded below `floor` by `at`; one another process has just
+    added to is kept '''
+    await db.execute(delete(MediaScores).where(
+        MediaScores.mid.in_(mids),
+        func.abs(decayed_score(at, half_life)) < floor
+    ))
+
+async def get_preference_attrs(db: AsyncSession, pairs: list) -> dict[tuple, str]:
+    ''' Current preference of each (uid, mid) pair that has one '''
+    rows = await db.execute(select(Preferences.uid, Preferences.mid, Preferences.attr).where(
+        tuple_(Preferences.uid, Preferences.mid).in_(pairs)
+    ))
+    return {(uid, mid): attr for uid, mid, attr in rows}
+
+async def get_user_preferences(db: AsyncSession, uid: str) -> list[tuple[str, str]]:
+    return (await db.execute(select(Preferences.mid, Preferences.attr).where(Preferences.uid == uid))).all()
+
+async def get_seen_mids(db: AsyncSession, uid: str) -> set:
+    ''' Media the user has viewed or rated '''
+    viewed = select(Activity.mid).where(Activity.uid == uid)
+    rated = select(Preferences.mid).where(Preferences.uid == uid)
+    return set(await db.scalars(viewed.union(rated)))
+
+async def get_user_taste(db: AsyncSession, uid: str) -> UserTastes:
+    return await db.scalar(select(UserTastes).where(UserTastes.uid == uid))
+
+async def lock_user_tastes(db: AsyncSession, uids: list) -> dict[str, UserTastes]:
+    ''' Locks the taste rows of `uids`, creating an unbuilt placeholder (no model_id) for users
+    without one, so every profile write and rebuild for a user is serialised on its row '''
+    uids = sorted(set(uids))
+    if not uids:
+        return {}
+    await db.execute(pg_insert(UserTastes).values([{"uid": uid, "model_id": ""} for uid in uids]).on_conflict_do_nothing(index_elements=[UserTastes.uid]))
+    rows = await db.scalars(
+        select(UserTastes).where(UserTastes.uid.in_(uids)).order_by(UserTastes.uid).with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    return {row.uid: row for row in rows}
+
+async def get_existing_mids(db: AsyncSession, mids: list) -> set:
+    return set(await db.scalars(select(Media.mid).where(Media.mid.in_(mids))))
+
+async def get_existing_keys(db: AsyncSession, uids: list, mids: list) -> tuple[set, set]:
+    users = await db.scalars(select(Users.uid).where(Users.uid.in_(uids)))
+    media = await db.scalars(select(Media.mid).where(Media.mid.in_(mids)))
+    return set(users), set(media)
+
+async def is_duplicate_image(db: AsyncSession, hash:str):
+    # Near-duplicates come from the in-memory index, exact matches are still checked in
+    # the database so uploads through other workers are caught too
+    if phash_index.loaded and phash_index.query(hash):
+        return True
+    return await db.scalar(select(Media).where(Media.hash == hash))
+
+async def create_job(db: AsyncSession, jid: str, uid: str, path: str, payload: dict) -> IngestJobs:
+    job = IngestJobs(jid=jid, uid=uid, path=path, payload=payload)
+    db.add(job)
+    await db.commit()
+    return job
+
+async def get_job(db: AsyncSession, jid: str) -> IngestJobs:
+    return await db.scalar(select(IngestJobs).where(IngestJobs.jid == jid))
+
+async def claim_job(db: AsyncSession, jid: str, lease: float) -> IngestJobs | None:
+    ''' Marks a job running and returns it, or None when it is finished or another worker holds it.
+    A running job whose row has not been touched for `lease` seconds is taken over. '''
+    stale = func.now() - datetime.timedelta(seconds=lease)
+    job = await db.scalar(update(IngestJobs).where(
+        IngestJobs.jid == jid,
+        or_(IngestJobs.status == 'queued', and_(IngestJobs.status == 'running', IngestJobs.updated_at < stale))
+    ).values(status='running').returning(IngestJobs).execution_options(synchronize_session=False))
+    await db.commit()
+    return job
+
+async def update_job(db: AsyncSession, jid: str, **kwargs) -> None:
+    await db.execute(update(IngestJobs).where(IngestJobs.jid == jid).values(**kwargs).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def get_pending_jobs(db: AsyncSession) -> list:
+    return (await db.execute(select(IngestJobs.jid).where(
+        IngestJobs.status.in_(['queued', 'running'])
+    ).order_by(IngestJobs.created_at))).all()
+
+async def get_outbox_batch(db: AsyncSession, limit: int, max_attempts: int) -> list:
+    # Row locks keep concurrent flushers (one per worker process) off the same entries
+    return (await db.scalars(select(VectorOutbox).where(VectorOutbox.attempts < max_attempts).order_by(
+        VectorOutbox.oid
+    ).limit(limit).with_for_update(skip_locked=True))).all()
+
+async def retry_outbox(db: AsyncSession, oids: list, error: str) -> None:
+    await db.execute(update(VectorOutbox).where(VectorOutbox.oid.in_(oids)).values(
+        attempts=VectorOutbox.attempts + 1, error=error
+    ).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def requeue_outbox(db: AsyncSession, max_attempts: int) -> int:
+    result = await db.execute(update(VectorOutbox).where(VectorOutbox.attempts >= max_attempts).values(
+        attempts=0
+    ).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount
+
+async def get_outbox_stats(db: AsyncSession, max_attempts: int) -> dict:
+    pending, parked, oldest = (await db.execute(select(
+        func.count(VectorOutbox.oid),
+        func.count(VectorOutbox.oid).filter(VectorOutbox.attempts >= max_attempts),
+        func.min(VectorOutbox.created_at)
+    ))).one()
+    return {"pending": pending, "parked": parked, "oldest": oldest}
+
+async def get_outbox_mids(db: AsyncSession) -> set:
+    return set(await db.scalars(select(VectorOutbox.mid).distinct()))
+
+async def get_all_mids(db: AsyncSession) -> set:
+    # Streamed with a server-side cursor instead of loading every row at once
+    result = await db.stream_scalars(select(Media.mid).execution_options(yield_per=10000))
+    return {mid async for mid in result}
+
+async def get_media_by_mids(db: AsyncSession, mids: list) -> list:
+    return (await db.execute(select(Media).options(joinedload(Media.tags)).where(Media.mid.in_(mids)))).unique().scalars().all()
+
+async def enqueue_vectors(db: AsyncSession, upserts: list[tuple], deletes: list, refreshes: list = ()) -> None:
+    ''' refreshes: mids whose stored vectors are rewritten with current scalars '''
+    db.add_all([outbox_upsert(mid, image_embed, text_embed) for mid, image_embed, text_embed in upserts])
+    db.add_all([VectorOutbox(mid=mid, op='delete') for mid in deletes])
+    db.add_all([VectorOutbox(mid=mid, op='upsert') for mid in refreshes])
+    await db.commit()
+
+async def get_vector_attrs(db: AsyncSession, mids: list) -> dict:
+    ''' The scalars stored next to each vector for filtered search, by mid '''
+    attrs = {
+        row.mid: {"uid": row.uid, "is_nsfw": bool(row.isNSFW), "is_public": False, "tids": []}
+        for row in await db.execute(select(Media.mid, Media.uid, Media.isNSFW).where(Media.mid.in_(mids)))
+    }
+    public = select(CollectionMedia.mid).join(Collections, Collections.cid == CollectionMedia.cid).where(
+        CollectionMedia.mid.in_(mids), Collections.scope == 'public'
+    ).distinct()
+    for mid in await db.scalars(public):
+        attrs[mid]["is_public"] = True
+    for mid, tid in await db.execute(select(MediaTags.mid, MediaTags.tid).where(MediaTags.mid.in_(mids))):
+        attrs[mid]["tids"].append(tid)
+    return attrs
+
+async def get_media_after(db: AsyncSession, created_at, mid: str, limit: int) -> list:
+    ''' Next page of media in (created_at, mid) order, starting after the given key '''
+    query = select(Media).options(selectinload(Media.tags))
+    if created_at is not None:
+        query = query.where(tuple_(Media.created_at, Media.mid) > (created_at, mid))
+    return (await db.scalars(query.order_by(Media.created_at, Media.mid).limit(limit))).all()
+
+async def create_backfill(db: AsyncSession, bid: str, model_id: str, dimension: int) -> BackfillJobs:
+    job = BackfillJobs(bid=bid, model_id=model_id, dimension=dimension)
+    db.add(job)
+    await db.commit()
+    return job
+
+async def get_backfill(db: AsyncSession, statuses: list) -> BackfillJobs:
+    return await db.scalar(select(BackfillJobs).where(BackfillJobs.status.in_(statuses)).order_by(BackfillJobs.created_at.desc()).limit(1))
+
+async def update_backfill(db: AsyncSession, bid: str, **kwargs) -> None:
+    # Synchronized, so a job object already loaded in the session sees the new values
+    await db.execute(update(BackfillJobs).where(BackfillJobs.bid == bid).values(**kwargs))
+    await db.commit()
+
+async def record_backfill_changes(db: AsyncSession, bid: str, mids: list) -> None:
+    ''' Not committed, so it lands with the outbox flush it records '''
+    if mids:
+        await db.execute(pg_insert(BackfillChanges).values([{"bid": bid, "mid": mid} for mid in mids]).on_conflict_do_nothing())
+
+async def requeue_backfill_changes(db: AsyncSession, bid: str) -> tuple[int, int]:
+    ''' Turns queued upserts into scalar refreshes and queues one for every media item changed
+    while backfill `bid` ran. The queued vectors came from the previous model; media the new
+    store lacks are re-embedded by reconciliation. Returns (vectors dropped, refreshes queued). '''
+    dropped = (await db.scalars(delete(VectorOutbox).where(
+        VectorOutbox.op == 'upsert', VectorOutbox.image_embed.is_not(None)
+    ).returning(VectorOutbox.mid).execution_options(synchronize_session=False))).all()
+    changed = (await db.scalars(delete(BackfillChanges).where(BackfillChanges.bid == bid).returning(
+        BackfillChanges.mid
+    ).execution_options(synchronize_session=False))).all()
+    mids = set(dropped) | set(changed)
+    db.add_all([VectorOutbox(mid=mid, op='upsert') for mid in mids])
+    await db.commit()
+    return len(dropped), len(mids)
+
+async def get_neighbours(db: AsyncSession, mid: str) -> list | None:
+    return await db.scalar(select(MediaNeighbours.neighbours).where(MediaNeighbours.mid == mid))
+
+async def get_unlisted_mids(db: AsyncSession, limit: int) -> list:
+    ''' Newest media without a neighbour list whose vector has already been flushed '''
+    rows = await db.scalars(select(Media.mid).outerjoin(MediaNeighbours, MediaNeighbours.mid == Media.mid).where(
+        MediaNeighbours.mid.is_(None),
+        ~Media.mid.in_(select(VectorOutbox.mid))
+    ).order_by(Media.created_at.desc()).limit(limit))
+    return rows.all()
+
+async def get_stale_neighbour_mids(db: AsyncSession, before: datetime.datetime, retry_before: datetime.datetime, limit: int) -> list:
+    ''' Lists last built before `before`, and markers for missing vectors last tried before `retry_before` '''
+    rows = await db.scalars(select(MediaNeighbours.mid).where(or_(
+        MediaNeighbours.updated_at < before,
+        and_(MediaNeighbours.neighbours.is_(None), MediaNeighbours.updated_at < retry_before)
+    )).order_by(MediaNeighbours.updated_at).limit(limit))
+    return rows.all()
+
+async def lock_neighbours(db: AsyncSession, mids: list) -> dict:
+    # Locked in key order, so concurrent builders overlapping on some lists can't deadlock
+    rows = await db.scalars(select(MediaNeighbours).where(MediaNeighbours.mid.in_(mids)).order_by(MediaNeighbours.mid).with_for_update())
+    return {row.mid: row for row in rows}
+
+async def clear_neighbours(db: AsyncSession) -> int:
+    result = await db.execute(delete(MediaNeighbours).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount
+
+async def get_duplicate_hashes(db: AsyncSession, hashes:list) -> set:
+    if not hashes:
+        return set()
+    duplicates = set(await db.scalars(select(Media.hash).where(Media.hash.in_(hashes))))
+    if phash_index.loaded:
+        duplicates.update(hash for hash in hashes if phash_index.query(hash))
+    return duplicates
+
+async def update_tags_from_list(db, path: str = 'app/config/tags.txt', batch_size: int = 1000)-> None:
+    ''' Ingests the tag names listed in `path`, one per line, then empties the file '''
     while True:
         try:
-            tags = open('app/config/tags.txt').read().splitlines()
-            tags = list(set(tags))
-            await create_tags(db, tags)
-            open('app/config/tags.txt', 'w').write('')
+            if os.path.exists(path):
+                tags = list(dict.fromkeys(line.strip() for line in open(path).read().splitlines() if line.strip()))
+                for i in range(0, len(tags), batch_size):
+                    await add_tags(db, tags[i:i + batch_size])
+                if tags:
+                    print(f"Ingested {len(tags)} tags from {path}")
+                    open(path, 'w').write('')
         except Exception as e:
+            await db.rollback()
             print(e)
         await asyncio.sleep(6 * 60 * 60)  # Sleep for 6 hours
 
-async def classify_image(db:Session, image:bytes) -> list[str]:
-    tags = await get_tags(db)
-    r = await clip.arank([
-            Document(
-                blob=image,
-                matches=[Document(text=tag.name) for tag in tags],
-            )])
-
-    results = [match.text for match in r[0].matches] #if match.scores['clip_score'].value > 0.5]
-    return results[:7]
+async def classify_image(db: AsyncSession, image_embed, k:int = None, min_score:float = None) -> list[str]:
+    ''' image_embed: the image's CLIP embedding, e.g. from encoder.encode_images '''
+    if not tag_store.loaded:
+        await tag_store.sync(db)
+    return tag_store.classify(image_embed, k or TAG_TOP_K, min_score if min_score is not None else TAG_MIN_SCORE)
 
     
-async def get_image_by_mid(db: Session, mid: str, uid: str = None):
-    image = db.query(Media).options(
+async def rank_text(db: AsyncSession, query: str, mids: list) -> list[dict]:
+    ''' Postgres full-text rank of `query` against title and description, limited to `mids` '''
+    if not mids:
+        return []
+    tsquery = func.plainto_tsquery('english', query)
+    rank = func.ts_rank(Media.search_vector, tsquery).label('rank')
+    rows = await db.execute(select(Media.mid, rank).where(Media.mid.in_(mids), Media.search_vector.op('@@')(tsquery)).order_by(rank.desc()))
+    return [{"id": row.mid, "distance": float(row.rank)} for row in rows]
+
+async def get_tag_ids(db: AsyncSession, names: list) -> list[int]:
+    return list((await tag_cache.resolve(db, names)).values())
+
+async def get_images_by_mids(db: AsyncSession, mids: list, uid: str = None) -> list:
+    ''' Bulk version of get_image_by_mid: a fixed number of queries per page, results in the order of `mids` '''
+    if not mids:
+        return []
+    images = await db.scalars(select(Media).options(
+        selectinload(Media.tags),
+        selectinload(Media.collections)
+    ).where(Media.mid.in_(mids)))
+    images = {image.mid: image for image in images}
+
+    results = []
+    for mid in mids:
+        image = images.get(mid)
+        if image is None:
+            continue
+        if uid != image.uid:
+            # Detach first so trimming the list is never flushed as a membership change
+            db.expunge(image)
+            image.collections = [col for col in image.collections if col.scope == 'public']
+        if image.collections or uid == image.uid:
+            results.append(image)
+    return results
+
+async def get_image_by_mid(db: AsyncSession, mid: str, uid: str = None):
+    image = (await db.execute(select(Media).options(
         joinedload(Media.tags),
         joinedload(Media.collections)
-    ).filter(Media.mid == mid).first()
+    ).where(Media.mid == mid))).unique().scalars().first()
 
     if image is None:
         return None
@@ -207,84 +592,12 @@ async def get_image_by_mid(db: Session, mid: str, uid: str = None):
 
     return image if image.collections or uid == image.uid else []
 
-# def get_user_preferences(db: Session, user_id: str):
-#     return db.query(UserPreferences).filter(UserPreferences.user_id == user_id).all()
-
-# Filter unseen media by recent 'created_at' to reduce processing load
-# async def get_recent_unseen_media(db: Session, user_id: str, days_limit: int = 30):
-#     viewed_media_ids = db.query(UserViewedMedia.media_id).filter(UserViewedMedia.user_id == user_id).subquery()
-#     time_limit = datetime.datetime.now() - datetime.timedelta(days=days_limit)
-#     return db.query(Media).filter(~Media.id.in_(viewed_media_ids), Media.created_at > time_limit).all()
-
-# Fetch embeddings in batches to avoid overload
-# async def get_media_embeddings(media_ids, batch_size=1000):
-#     embeddings = {}
-#     for i in range(0, len(media_ids), batch_size):
-#         batch_ids = media_ids[i:i+batch_size]
-#         results = client.get("embeddings", ids=batch_ids)
-#         embeddings.update({result["id"]: result["embed"] for result in results})
-#     return embeddings
-
-async def recommend_media(db: Session, user_id: str, days_limit: int = 30):
-    # Retrieve user preferences
-    preferences = get_user_preferences(db, user_id)
-    liked_media_ids = [pref.media_id for pref in preferences if pref.preference == 'like']
-    disliked_media_ids = [pref.media_id for pref in preferences if pref.preference == 'dislike']
-
-    # Get unseen media filtered by created_at (last 30 days by default)
-    unseen_media = get_recent_unseen_media(db, user_id, days_limit)
-    unseen_media_ids = [media.id for media in unseen_media]
-
-    # Fetch embeddings in optimized batches
-    liked_embeddings = get_media_embeddings(liked_media_ids) if liked_media_ids else {}
-    disliked_embeddings = get_media_embeddings(disliked_media_ids) if disliked_media_ids else {}
-    unseen_embeddings = get_media_embeddings(unseen_media_ids)
-
-    recommendations = []
-    for media_id, embedding in unseen_embeddings.items():
-        like_similarity = np.mean([np.dot(embedding, liked_embeddings[liked_id]) for liked_id in liked_media_ids]) if liked_media_ids else 0
-        dislike_similarity = np.mean([np.dot(embedding, disliked_embeddings[disliked_id]) for disliked_id in disliked_media_ids]) if disliked_media_ids else 0
-        
-        # Final score: similarity to liked media minus similarity to disliked media
-        final_score = like_similarity - dislike_similarity
-        recommendations.append((media_id, final_score))
-
-    # Sort recommendations by final score
-    recommendations.sort(key=lambda x: x[1], reverse=True)
-    recommended_media_ids = [media_id for media_id, _ in recommendations]
-    return db.query(Media).filter(Media.id.in_(recommended_media_ids)).all()
-
-
-# async def get_user_preferences(session: Session, user_id: str):
-#     preferences = session.query(UserPreferences).filter_by(user_id=user_id).all()
-#     likes = [p.image_id for p in preferences if p.like]
-#     dislikes = [p.image_id for p in preferences if p.dislike]
-#     return likes, dislikes
-
-
-# async def get_user_activity(session: Session, user_id: str):
-#     viewed_images = session.query(UserViewedMedia).filter_by(user_id=user_id).all()
-#     return [vi.image_id for vi in viewed_images]
-
-# async def get_recommendations(session: Session, user_id: str, top_k=10):
-#     # Get user preferences
-#     likes, dislikes = await get_user_preferences(session, user_id)
-#     user_activity = await get_user_activity(session, user_id)
-#     # Get all images
-#     all_images = session.query(Media).limit(1000).all()
-#     # Filter out images that the user has already seen
-#     unseen_images = [image for image in all_images if image.id not in user_activity]
-#     # Filter out images that the user has already liked or disliked
-#     filtered_images = [image for image in unseen_images if image.id not in likes and image.id not in dislikes]
-#     # Get embeddings for filtered images
-#     image_embeddings = [image.embedding for image in filtered_images]
-#     # Search for similar images
-#     recommendations = []
-#     for embed in image_embeddings:
-#         results = await vector_search(session, embed, top_k=top_k)
-#         recommendations.extend(results)
-#     return recommendations
-
-async def get_tags(session: Session):
-    tags = session.query(Tags).all()
+async def get_near_duplicates(db: AsyncSession, mid: str, k: int) -> list[tuple[str, int]]:
+    hash = await db.scalar(select(Media.hash).where(Media.mid == mid))
+    if hash is None:
+        return None
+    return [(match, d) for match, d in phash_index.query(hash, k) if match != mid]
+
+async def get_tags(session: AsyncSession):
+    tags = (await session.scalars(select(Tags))).all()
     return tags
\ No newline at end of file
@@ -0,0 +1,99 @@
+from itertools import combinations
+from ...common import *
+from .models import Media
+
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", 4))
+
+class PhashIndex:
+    ''' Multi-index hash over 64-bit phashes for "any image within Hamming distance k".
+
+    Each hash is split into four 16-bit blocks with one table per block. If two hashes
+    are within k bits, one of their blocks differs in at most k // 4 bits, so a query
+    only probes the block values within that radius and verifies the few candidates.
+    GIF hashes are two phashes back to back; the first frame is indexed and the last
+    frame is also compared when both sides are GIFs. '''
+
+    BLOCKS = 4
+    BLOCK_BITS = 16
+    BLOCK_MASK = (1 << 16) - 1
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.BLOCKS)]
+        self.hashes = {}
+        self.loaded = False
+        self._flips = {}
+
+    @staticmethod
+    def parse(hash: str) -> tuple:
+        return tuple(int(hash[i:i + 16], 16) for i in range(0, len(hash), 16))
+
+    def blocks(self, value: int):
+        for b in range(self.BLOCKS):
+            yield b, (value >> (b * self.BLOCK_BITS)) & self.BLOCK_MASK
+
+    def flips(self, radius: int) -> list:
+        # Every 16-bit mask with at most `radius` bits set
+        if radius not in self._flips:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for bits in combinations(range(self.BLOCK_BITS), r):
+                    masks.append(sum(1 << bit for bit in bits))
+            self._flips[radius] = masks
+        return self._flips[radius]
+
+    def add(self, mid: str, hash: str):
+        if not hash:
+            return
+        parts = self.parse(hash)
+        self.remove(mid)
+        self.hashes[mid] = parts
+        for b, block in self.blocks(parts[0]):
+            self.tables[b].setdefault(block, set()).add(mid)
+
+    def remove(self, mid: str):
+        parts = self.hashes.pop(mid, None)
+        if parts is None:
+            return
+        for b, block in self.blocks(parts[0]):
+            bucket = self.tables[b].get(block)
+            if bucket is not None:
+                bucket.discard(mid)
+                if not bucket:
+                    del self.tables[b][block]
+
+    def distance(self, a: tuple, b: tuple) -> int:
+        if len(a) == len(b):
+            return max((x ^ y).bit_count() for x, y in zip(a, b))
+        return (a[0] ^ b[0]).bit_count()
+
+    def query(self, hash: str, k: int = DUPLICATE_DISTANCE) -> list[tuple[str, int]]:
+        ''' Returns (mid, distance) pairs within distance k, closest first '''
+        parts = self.parse(hash)
+        candidates = set()
+        masks = self.flips(k // self.BLOCKS)
+        for b, block in self.blocks(parts[0]):
+            table = self.tables[b]
+            for mask in masks:
+                bucket = table.get(block ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+
+        matches = []
+        for mid in candidates:
+            d = self.distance(parts, self.hashes[mid])
+            if d <= k:
+                matches.append((mid, d))
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    async def load(self, db: AsyncSession, batch_size: int = 10000):
+        result = await db.stream(select(Media.mid, Media.hash).execution_options(yield_per=batch_size))
+        async for mid, hash in result:
+            self.add(mid, hash)
+        self.loaded = True
+        print(f"Loaded {len(self.hashes)} hashes into the duplicate index")
+
+    def __len__(self):
+        return len(self.hashes)
+
+phash_index = PhashIndex()
@@ -0,0 +1,150 @@
+from ...common import *
+from ...database import SessionLocal
+from .crud import upsert_views, upsert_preferences, get_existing_keys
+from .trending import trending
+from .recommend import recommender
+
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 1000))
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", 2.0))
+EVENT_BUFFER_MAX = int(os.getenv("EVENT_BUFFER_MAX", 100_000))
+
+class EventBuffer:
+    ''' Collects views and preferences in memory and writes them to Postgres in batches.
+
+    Requests only add to the buffer, which is keyed by (uid, mid): a repeat view keeps the
+    latest time and a repeat preference the latest value, so each pair is written once per
+    flush as a multi-row INSERT .. ON CONFLICT DO UPDATE. A flush runs once `batch_size`
+    events are buffered or `interval` seconds have passed. Events from a failed flush go
+    back into the buffer unless newer ones arrived meanwhile. When `max_size` events are
+    waiting, new ones are refused rather than growing without bound. stop() drains it.
+    Taste profiles move in the same transaction as the preferences; committed batches are
+    passed on to the trending scores. '''
+
+    def __init__(self, batch_size: int, interval: float, max_size: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_size = max_size
+        self.views: dict[tuple, datetime.datetime] = {}
+        self.preferences: dict[tuple, str] = {}
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.running = False
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.skipped = 0
+        self.last_error = None
+
+    def __len__(self):
+        return len(self.views) + len(self.preferences)
+
+    def accept(self, events: dict, key: tuple, value) -> bool:
+        if key not in events and len(self) >= self.max_size:
+            self.rejected += 1
+            return False
+        events[key] = value
+        self.accepted += 1
+        if len(self) >= self.batch_size:
+            self.wake.set()
+        return True
+
+    def view(self, uid: str, mid: str) -> bool:
+        return self.accept(self.views, (uid, mid), datetime.datetime.now())
+
+    def preference(self, uid: str, mid: str, attr: str) -> bool:
+        return self.accept(self.preferences, (uid, mid), attr)
+
+    async def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self.run(), name="Event Buffer")
+
+    async def stop(self):
+        # Not cancelled: a flush in progress finishes, then the rest is drained below
+        self.running = False
+        self.wake.set()
+        if self.task:
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Failed to drain {len(self)} buffered events: {str(e)}")
+
+    async def run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Event flush failed: {str(e)}")
+
+    async def flush(self):
+        async with self.lock:
+            views, self.views = self.views, {}
+            preferences, self.preferences = self.preferences, {}
+            if not views and not preferences:
+                return
+            async with SessionLocal() as db:
+                try:
+                    views, preferences, previous = await self.write(db, views, preferences)
+                except Exception:
+                    # Keep whatever arrived while the flush was running, it is newer
+                    self.views = {**views, **self.views}
+                    self.preferences = {**preferences, **self.preferences}
+                    raise
+                recommender.record(views, preferences, previous)
+                # The events are stored either way; a failure here only loses their effect on ranking
+                try:
+                    await trending.record(db, views, preferences, previous)
+                except Exception as e:
+                    print(f"Failed to score {len(views) + len(preferences)} events: {str(e)}")
+
+    async def write(self, db: AsyncSession, views: dict, preferences: dict) -> tuple[dict, dict, dict]:
+        vectors = await recommender.vectors(preferences)
+        try:
+            previous = await self.insert(db, views, preferences, vectors)
+            await db.commit()
+        except IntegrityError:
+            # Media or users deleted since the event was accepted; drop their events and retry once
+            await db.rollback()
+            pairs = [*views, *preferences]
+            uids, mids = await get_existing_keys(db, list({uid for uid, _ in pairs}), list({mid for _, mid in pairs}))
+            kept_views = {(uid, mid): at for (uid, mid), at in views.items() if uid in uids and mid in mids}
+            kept_preferences = {(uid, mid): attr for (uid, mid), attr in preferences.items() if uid in uids and mid in mids}
+            self.skipped += len(views) + len(preferences) - len(kept_views) - len(kept_preferences)
+            views, preferences = kept_views, kept_preferences
+            previous = await self.insert(db, views, preferences, vectors)
+            await db.commit()
+        self.written += len(views) + len(preferences)
+        return views, preferences, previous
+
+    async def insert(self, db: AsyncSession, views: dict, preferences: dict, vectors: dict) -> dict:
+        ''' Writes the batch and moves the taste profiles with it; returns the preferences it replaced '''
+        # Taste rows are locked first, so the replaced preferences are read under the lock
+        previous = await recommender.update(db, preferences, vectors)
+        # Sorted so concurrent flushes from several workers lock rows in the same order
+        view_rows = [{"uid": uid, "mid": mid, "viewed_at": at} for (uid, mid), at in sorted(views.items())]
+        preference_rows = [{"uid": uid, "mid": mid, "attr": attr} for (uid, mid), attr in sorted(preferences.items())]
+        for i in range(0, len(view_rows), self.batch_size):
+            await upsert_views(db, view_rows[i:i + self.batch_size])
+        for i in range(0, len(preference_rows), self.batch_size):
+            await upsert_preferences(db, preference_rows[i:i + self.batch_size])
+        return previous
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "written": self.written,
+            "skipped": self.skipped,
+            "last_error": self.last_error,
+        }
+
+event_buffer = EventBuffer(EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL, EVENT_BUFFER_MAX)
@@ -0,0 +1,139 @@
+from ...common import *
+from ...database import SessionLocal
+from .models import Media, FeedItems
+from ..users.models import Users, UserFollows
+
+FEED_FANOUT_LIMIT = int(os.getenv("FEED_FANOUT_LIMIT", 10_000))
+FEED_MAX_ITEMS = int(os.getenv("FEED_MAX_ITEMS", 500))
+FEED_BACKFILL = int(os.getenv("FEED_BACKFILL", 50))
+FEED_TRIM_INTERVAL = float(os.getenv("FEED_TRIM_INTERVAL", 60 * 60))
+FEED_RECOMMEND_EVERY = int(os.getenv("FEED_RECOMMEND_EVERY", 4))
+
+def encode_feed_cursor(timeline: str | None, done: bool, offset: int) -> str:
+    raw = json.dumps({"timeline": timeline, "done": done, "offset": offset})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_feed_cursor(cursor: str | None) -> tuple[str | None, bool, int]:
+    ''' (timeline cursor, timeline exhausted, recommendations already served) '''
+    if not cursor:
+        return None, False, 0
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return state["timeline"], bool(state["done"]), int(state["offset"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def interleave(timeline: list, recommended: list, every: int) -> list:
+    ''' One recommended item after every `every` timeline items, the rest at the end '''
+    items, recommended = [], list(recommended)
+    for i, item in enumerate(timeline, 1):
+        items.append(item)
+        if i % every == 0 and recommended:
+            items.append(recommended.pop(0))
+    return items + recommended
+
+class Timelines:
+    ''' Home timelines of followed uploads, written at upload time.
+
+    An upload by an author with fewer than `fanout_limit` followers is copied into each
+    follower's `feed_items` by a single INSERT .. SELECT in the upload's transaction.
+    Uploads of larger accounts are not copied: their followers read them from `media`
+    at page time, merged with their pushed rows in the same keyset order. Following an
+    account pushes its latest `backfill` uploads, unfollowing removes them, and timelines
+    are trimmed to the newest `max_items` every `trim_interval` seconds. '''
+
+    def __init__(self, fanout_limit: int, max_items: int, backfill: int, trim_interval: float):
+        self.fanout_limit = fanout_limit
+        self.max_items = max_items
+        self.backfill = backfill
+        self.trim_interval = trim_interval
+        self.wake = asyncio.Event()
+        self.task = None
+        self.running = False
+        self.trimmed = 0
+        self.last_error = None
+
+    async def fan_out(self, db: AsyncSession, mids: list):
+        ''' Pushes newly flushed media to their authors' followers; not committed '''
+        author = select(Users.uid).where(Users.uid == Media.uid, Users.follower_count < self.fanout_limit).exists()
+        rows = select(UserFollows.uid, Media.mid, Media.uid, Media.created_at).join(
+            UserFollows, UserFollows.fid == Media.uid
+        ).where(Media.mid.in_(mids), author)
+        await db.execute(pg_insert(FeedItems).from_select(
+            ["uid", "mid", "author", "created_at"], rows
+        ).on_conflict_do_nothing())
+
+    async def follow(self, db: AsyncSession, uid: str, fid: str):
+        ''' Pushes the recent uploads of a newly followed account; not committed '''
+        author = select(Users.uid).where(Users.uid == fid, Users.follower_count < self.fanout_limit).exists()
+        rows = select(literal(uid), Media.mid, Media.uid, Media.created_at).where(Media.uid == fid, author).order_by(
+            Media.created_at.desc(), Media.mid.desc()
+        ).limit(self.backfill)
+        await db.execute(pg_insert(FeedItems).from_select(
+            ["uid", "mid", "author", "created_at"], rows
+        ).on_conflict_do_nothing())
+
+    async def unfollow(self, db: AsyncSession, uid: str, fid: str):
+        await db.execute(delete(FeedItems).where(FeedItems.uid == uid, FeedItems.author == fid))
+
+    async def page(self, db: AsyncSession, uid: str, limit: int, cursor: str = None) -> dict:
+        ''' Followed uploads newest first: pushed rows plus uploads of large followed accounts '''
+        large = select(UserFollows.fid).join(Users, Users.uid == UserFollows.fid).where(
+            UserFollows.uid == uid, Users.follower_count >= self.fanout_limit
+        )
+        pushed = select(FeedItems.mid, FeedItems.created_at).where(
+            FeedItems.uid == uid, FeedItems.author.notin_(large)
+        )
+        pulled = select(Media.mid, Media.created_at).where(Media.uid.in_(large))
+        timeline = union_all(pushed, pulled).subquery()
+        query = select(timeline.c.mid, timeline.c.created_at)
+        rows = (await db.execute(keyset(query, timeline.c.created_at, timeline.c.mid, cursor, limit))).all()
+        return page(rows, limit, 'created_at', 'mid')
+
+    async def trim(self, db: AsyncSession) -> int:
+        ranked = select(
+            FeedItems.uid, FeedItems.mid,
+            func.row_number().over(
+                partition_by=FeedItems.uid, order_by=(FeedItems.created_at.desc(), FeedItems.mid.desc())
+            ).label("rank")
+        ).subquery()
+        old = select(ranked.c.uid, ranked.c.mid).where(ranked.c.rank > self.max_items)
+        result = await db.execute(
+            delete(FeedItems).where(tuple_(FeedItems.uid, FeedItems.mid).in_(old))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return result.rowcount
+
+    async def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self.run(), name="Trim Timelines")
+
+    async def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.task:
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while self.running:
+            async with SessionLocal() as db:
+                try:
+                    trimmed = await self.trim(db)
+                    self.trimmed += trimmed
+                    if trimmed:
+                        print(f"Trimmed {trimmed} timeline entries")
+                except Exception as e:
+                    await db.rollback()
+                    self.last_error = str(e)
+                    print(f"Timeline trim failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.trim_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {"trimmed": self.trimmed, "last_error": self.last_error}
+
+timelines = Timelines(FEED_FANOUT_LIMIT, FEED_MAX_ITEMS, FEED_BACKFILL, FEED_TRIM_INTERVAL)
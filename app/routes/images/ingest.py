@@ -0,0 +1,222 @@
+from ...common import *
+from ...database import SessionLocal
+from .crud import add_media, is_duplicate_image, classify_image, create_job, claim_job, update_job, get_pending_jobs, get_existing_mids
+from .models import new_mid
+from .utils import generate_url, analyse_image
+from .outbox import vector_outbox
+from ...imaging import process_image
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 4))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 1024))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 3))
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", 0.5))
+# A running job untouched for this long belongs to a dead worker and may be taken over
+INGEST_LEASE = float(os.getenv("INGEST_LEASE", 10 * 60))
+INCOMING_DIR = os.path.join(STORAGE_DIR, "incoming")
+
+class PermanentError(Exception):
+    ''' A stage failure that retrying cannot fix, e.g. a duplicate or an undecodable file. '''
+
+class IngestQueue:
+    ''' Runs uploads through their processing stages on a bounded pool of workers.
+
+    The upload request only stores the raw bytes and an `ingest_jobs` row. Workers pick
+    job ids off an in-memory queue and run each stage with its own retry budget, recording
+    progress on the job row so clients can poll it and restarts can resume pending jobs.
+    A worker only runs a job it claimed on the row, so a job queued twice runs once.
+
+    The file is moved into STORAGE_DIR before the Media row is written, and the row's mid is
+    reserved on the job beforehand, so a committed row always has its file and a resumed
+    job always knows whether its row was written. '''
+
+    def __init__(self, workers: int, maxsize: int, max_retries: int, retry_delay: float, lease: float):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        # Slots held by submissions still spooling their upload
+        self.reserved = 0
+        self.tasks = []
+        self.stages = [
+            ("decode", self.decode),
+            ("dedup", self.dedup),
+            ("classify", self.classify),
+            ("embed", self.embed),
+            ("store", self.store),
+            ("persist", self.persist),
+        ]
+
+    def full(self) -> bool:
+        return self.queue.qsize() + self.reserved >= self.maxsize
+
+    async def submit(self, db: AsyncSession, uid: str, image: UploadFile, payload: dict) -> str:
+        if self.full():
+            raise HTTPException(status_code=503, detail="Ingestion queue is full")
+        self.reserved += 1
+        try:
+            upload = await spool_upload(image, directory=INCOMING_DIR)
+            try:
+                jid = uuid4().hex
+                await create_job(db, jid, uid, upload.path, dict(payload, sha256=upload.sha256))
+            except Exception:
+                upload.discard()
+                raise
+        finally:
+            self.reserved -= 1
+        # Only recovery can take the reserved slot meanwhile, so this waits at most briefly
+        await self.queue.put(jid)
+        return jid
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self.worker(), name=f"Ingest Worker {i}") for i in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.recover(), name="Ingest Recovery"))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def recover(self):
+        # Requeue jobs left queued or half-done by a previous process
+        async with SessionLocal() as db:
+            jobs = await get_pending_jobs(db)
+        for job in jobs:
+            await self.queue.put(job.jid)
+
+    async def worker(self):
+        while True:
+            jid = await self.queue.get()
+            try:
+                async with SessionLocal() as db:
+                    await self.run(db, jid)
+            except Exception as e:
+                print(f"Ingest job {jid} crashed: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self, db: AsyncSession, jid: str):
+        job = await claim_job(db, jid, self.lease)
+        if job is None:
+            return
+
+        ctx = dict(job.payload, jid=jid, uid=job.uid, path=job.path, mid=job.mid)
+        ctx["persisted"] = bool(job.mid) and job.mid in await get_existing_mids(db, [job.mid])
+        if "url" in ctx and not os.path.exists(ctx["path"]):
+            # Interrupted between moving the file and recording its new path
+            ctx["path"] = os.path.join(STORAGE_DIR, ctx["url"])
+        for name, stage in self.stages:
+            await update_job(db, jid, stage=name, attempts=0)
+            attempt = 0
+            while True:
+                try:
+                    await stage(db, ctx)
+                    break
+                except Exception as e:
+                    await db.rollback()
+                    attempt += 1
+                    await update_job(db, jid, attempts=attempt, error=str(e))
+                    if isinstance(e, PermanentError) or attempt > self.max_retries:
+                        await self.fail(db, ctx, e)
+                        return
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+        await update_job(db, jid, status='done', stage=None, error=None, mid=ctx["mid"])
+
+    async def fail(self, db: AsyncSession, ctx: dict, error: Exception):
+        if ctx["persisted"]:
+            # The row owns the file now
+            await update_job(db, ctx["jid"], status='failed', error=str(error))
+            return
+        # Raw or already moved, nothing points at the file
+        if os.path.exists(ctx["path"]):
+            os.remove(ctx["path"])
+        await update_job(db, ctx["jid"], status='failed', error=str(error), mid=None)
+
+    async def decode(self, db: AsyncSession, ctx: dict):
+        try:
+            meta = await process_image(ctx["path"])
+        except (OSError, SyntaxError, ValueError) as e:
+            raise PermanentError(f"Invalid image: {str(e)}")
+        if meta["format"] == "GIF":
+            ctx["span"] = meta["duration"] * 1000
+        ctx["width"], ctx["height"] = meta["width"], meta["height"]
+        if "url" in ctx and ctx["mid"]:
+            return
+        if "url" not in ctx:
+            ctx["url"], ctx["hash"] = await generate_url(meta["format"].lower()), meta["hash"]
+        ctx["mid"] = new_mid()
+        # Keep the generated url and mid so a resumed job stores the file where its Media row
+        # points and can tell whether that row was written
+        payload = {key: ctx.get(key) for key in ("title", "desc", "tags", "src", "collections", "is_nsfw", "url", "hash", "sha256")}
+        await update_job(db, ctx["jid"], payload=payload, mid=ctx["mid"])
+
+    async def dedup(self, db: AsyncSession, ctx: dict):
+        if ctx["persisted"]:
+            return
+        if await is_duplicate_image(db, ctx["hash"]):
+            raise PermanentError("Duplicate Image")
+
+    async def image_embed(self, ctx: dict):
+        if "img_embed" not in ctx:
+            # Jobs queued before the digest was recorded hash the file here
+            digest = ctx.get("sha256") or await file_sha256(ctx["path"])
+            ctx["img_embed"] = (await encoder.encode_images([(ctx["path"], digest)]))[0]
+        return ctx["img_embed"]
+
+    async def classify(self, db: AsyncSession, ctx: dict):
+        if not ctx["tags"] and not ctx["persisted"]:
+            ctx["tags"] = await classify_image(db, await self.image_embed(ctx))
+
+    async def embed(self, db: AsyncSession, ctx: dict):
+        if ctx["persisted"]:
+            return
+        text_input = ctx["title"] + (ctx["desc"] or "") + ' '.join(ctx["tags"])
+        _, (ctx["text_embed"],), (ctx["score"], ctx["color"]) = await asyncio.gather(
+            self.image_embed(ctx),
+            encoder.encode([text_input]),
+            analyse_image(ctx["path"])
+        )
+
+    async def store(self, db: AsyncSession, ctx: dict):
+        # The raw upload is already on disk; move it into place instead of rewriting it
+        path = os.path.join(STORAGE_DIR, ctx["url"])
+        if ctx["path"] == path:
+            return
+        await asyncio.to_thread(os.replace, ctx["path"], path)
+        ctx["path"] = path
+        await update_job(db, ctx["jid"], path=path)
+
+    async def persist(self, db: AsyncSession, ctx: dict):
+        # A retry after a commit whose outcome was lost finds the row already written
+        if ctx["persisted"] or ctx["mid"] in await get_existing_mids(db, [ctx["mid"]]):
+            ctx["persisted"] = True
+            return
+        kwargs = {
+            "mid": ctx["mid"],
+            "url": ctx["url"],
+            "title": ctx["title"],
+            "desc": ctx["desc"],
+            "hash": ctx["hash"],
+            "width": ctx["width"],
+            "height": ctx["height"],
+            "tags": ctx["tags"],
+            "collections": ctx["collections"],
+            "uid": ctx["uid"],
+            "score": ctx["score"],
+            "color": ctx["color"],
+            "image_embed": ctx["img_embed"],
+            "text_embed": ctx["text_embed"],
+        }
+        if ctx["is_nsfw"]:
+            kwargs["isNSFW"] = ctx["is_nsfw"]
+        if ctx.get("span"):
+            kwargs["span"] = ctx["span"]
+        if ctx["src"]:
+            kwargs["src"] = ctx["src"]
+        await add_media(db, **kwargs)
+        ctx["persisted"] = True
+        vector_outbox.notify()
+
+ingest_queue = IngestQueue(INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_MAX_RETRIES, INGEST_RETRY_DELAY, INGEST_LEASE)
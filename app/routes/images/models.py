@@ -1,5 +1,8 @@
 from ...common import *
 
+def new_mid() -> str:
+    return str(uuid4().int >> 64)
+
 class Media(Base):
     __tablename__ = "media"
     
@@ -12,9 +15,18 @@ class Media(Base):
     src = Column(String(255))
     score = Column(Integer, default=0)
     color = Column(String(255), nullable=True)
+    # Pixel size, so comparing resolutions never reopens the files
+    width = Column(Integer)
+    height = Column(Integer)
     isNSFW = Column(Boolean, default=False)
     uid = Column(String(255), ForeignKey('users.uid', ondelete='CASCADE'), nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    # Maintained by Postgres; deferred so loading media never carries it
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(\"desc\", '')), 'B')",
+        persisted=True
+    )))
 
     owner = relationship("Users", backref=backref("media", lazy="dynamic"))
     tags = relationship("Tags", secondary="media_tags", back_populates="media")
@@ -22,11 +34,20 @@ class Media(Base):
     likes = relationship("Preferences", primaryjoin="and_(Preferences.mid==Media.mid, Preferences.attr=='like')")
     dislikes = relationship("Preferences", primaryjoin="and_(Preferences.mid==Media.mid, Preferences.attr=='dislike')")
 
-    __table_args__ = (Index('idx_user_id', 'uid'),)
+    __table_args__ = (
+        Index('idx_user_id', 'uid'),
+        # Keyset pagination order
+        Index('idx_media_created', 'created_at', 'mid'),
+        # A user's uploads in keyset order, for feeds pulled from large accounts
+        Index('idx_media_user_created', 'uid', 'created_at', 'mid'),
+        Index('idx_media_search', 'search_vector', postgresql_using='gin'),
+    )
 
     def __init__(self, **kwargs):
         super(Media, self).__init__(**kwargs)
-        self.mid = str(uuid4().int >> 64) 
+        # Callers may reserve the id up front, e.g. to record it before the row is written
+        if self.mid is None:
+            self.mid = new_mid()
 
 class Tags(Base):
     __tablename__ = "tags"
@@ -52,12 +73,23 @@ class Collections(Base):
     scope = Column(Enum('public', 'private', name='scope_enum'), default='public')
     uid = Column(String(255), ForeignKey('users.uid', ondelete='CASCADE'), nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(\"desc\", '')), 'B')",
+        persisted=True
+    )))
 
     media = relationship("Media", secondary="collection_media", back_populates="collections")
     tags = relationship("Tags", secondary="collection_tags", back_populates="collections")
     access_list = relationship("Users", secondary="collection_access_list", back_populates="collections")
     owner = relationship("Users", back_populates="owned_collections")
 
+    __table_args__ = (
+        Index('idx_collections_created', 'created_at', 'cid'),
+        Index('idx_collections_search', 'search_vector', postgresql_using='gin'),
+        Index('idx_collections_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+
 class CollectionTags(Base):
     __tablename__ = "collection_tags"
     
@@ -113,3 +145,108 @@ class Activity(Base):
     viewed_at = Column(DateTime, server_default=func.now())
 
     __table_args__ = (UniqueConstraint('uid', 'mid', name='unique_user_media_view'),)
+
+class IngestJobs(Base):
+    __tablename__ = "ingest_jobs"
+
+    jid = Column(String(32), primary_key=True, index=True)
+    uid = Column(String(255), ForeignKey('users.uid', ondelete='CASCADE'), nullable=False)
+    status = Column(Enum('queued', 'running', 'done', 'failed', name='ingest_status_enum'), default='queued', nullable=False)
+    stage = Column(String(32))
+    attempts = Column(Integer, default=0)
+    error = Column(Text)
+    payload = Column(JSONB, nullable=False)
+    path = Column(String(255), nullable=False)
+    mid = Column(String(255))
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (Index('idx_ingest_status', 'status', 'created_at'),)
+
+
+class VectorOutbox(Base):
+    __tablename__ = "vector_outbox"
+
+    # Written in the same transaction as the media change it mirrors, so the vector
+    # store can be brought up to date later without losing or resurrecting a row
+    oid = Column(BigInteger, primary_key=True, autoincrement=True)
+    mid = Column(String(255), nullable=False)
+    op = Column(Enum('upsert', 'delete', name='outbox_op_enum'), nullable=False)
+    image_embed = Column(LargeBinary)
+    text_embed = Column(LargeBinary)
+    attempts = Column(Integer, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+
+    __table_args__ = (Index('idx_outbox_mid', 'mid'),)
+
+class BackfillJobs(Base):
+    __tablename__ = "backfill_jobs"
+
+    # Named after the shadow collection (or directory) being filled
+    bid = Column(String(64), primary_key=True)
+    model_id = Column(String(255), nullable=False)
+    dimension = Column(Integer, nullable=False)
+    status = Column(Enum('running', 'done', 'swapped', 'failed', name='backfill_status_enum'), default='running', nullable=False)
+    # Keyset checkpoint: the last (created_at, mid) written to the shadow
+    cursor_created_at = Column(DateTime)
+    cursor_mid = Column(String(255))
+    processed = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class BackfillChanges(Base):
+    __tablename__ = "backfill_changes"
+
+    # Media flushed to the live store while a backfill was pending; the shadow copied their
+    # scalars earlier, so they are refreshed when it is promoted. No media FK: a deleted
+    # item must be refreshed (and so removed) too
+    bid = Column(String(64), ForeignKey('backfill_jobs.bid', ondelete='CASCADE'), primary_key=True)
+    mid = Column(String(255), primary_key=True)
+
+class MediaNeighbours(Base):
+    __tablename__ = "media_neighbours"
+
+    mid = Column(String(255), ForeignKey('media.mid', ondelete='CASCADE'), primary_key=True)
+    # [[mid, score], ...] by descending image similarity, unfiltered; NULL while the vector is missing
+    neighbours = Column(JSONB)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (Index('idx_neighbours_updated', 'updated_at'),)
+
+class MediaScores(Base):
+    __tablename__ = "media_scores"
+
+    mid = Column(String(255), ForeignKey('media.mid', ondelete='CASCADE'), primary_key=True)
+    # Trending score decayed to scored_at, shared by every process: each adds the weight of
+    # the events it recorded since its last snapshot
+    score = Column(Float, nullable=False)
+    scored_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (Index('idx_media_scores_scored_at', 'scored_at'),)
+
+class UserTastes(Base):
+    __tablename__ = "user_tastes"
+
+    uid = Column(String(255), ForeignKey('users.uid', ondelete='CASCADE'), primary_key=True)
+    # float32 sums of the image embeddings of liked and disliked media, under model_id;
+    # a placeholder with an empty model_id until the profile is first built
+    model_id = Column(String(255), nullable=False)
+    like_sum = Column(LargeBinary)
+    dislike_sum = Column(LargeBinary)
+    likes = Column(Integer, nullable=False, default=0)
+    dislikes = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class FeedItems(Base):
+    __tablename__ = "feed_items"
+
+    # Uploads pushed into a follower's home timeline, trimmed to the newest FEED_MAX_ITEMS
+    uid = Column(String(255), ForeignKey('users.uid', ondelete='CASCADE'), primary_key=True)
+    mid = Column(String(255), ForeignKey('media.mid', ondelete='CASCADE'), primary_key=True)
+    author = Column(String(255), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (Index('idx_feed_uid_created', 'uid', 'created_at', 'mid'),)
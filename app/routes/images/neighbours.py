@@ -0,0 +1,158 @@
+from ...common import *
+from ...database import SessionLocal
+from .crud import get_neighbours, get_unlisted_mids, get_stale_neighbour_mids, lock_neighbours, get_vector_attrs
+from .models import MediaNeighbours
+
+NEIGHBOUR_K = int(os.getenv("NEIGHBOUR_K", 64))
+NEIGHBOUR_DEPTH = int(os.getenv("NEIGHBOUR_DEPTH", 2))
+NEIGHBOUR_BATCH = int(os.getenv("NEIGHBOUR_BATCH", 64))
+NEIGHBOUR_INTERVAL = float(os.getenv("NEIGHBOUR_INTERVAL", 30))
+NEIGHBOUR_TTL = float(os.getenv("NEIGHBOUR_TTL", 7 * 24 * 60 * 60))
+NEIGHBOUR_RETRY = float(os.getenv("NEIGHBOUR_RETRY", 5 * 60))
+
+def merge(neighbours: list, candidates: list, k: int) -> list:
+    best = {mid: score for mid, score in neighbours}
+    best.update({mid: score for mid, score in candidates})
+    return [[mid, score] for mid, score in sorted(best.items(), key=lambda item: -item[1])[:k]]
+
+class NeighbourLists:
+    ''' Precomputed "more like this" lists: the top `k` image neighbours of every media item.
+
+    Lists are stored unfiltered in `media_neighbours`, so visual search by media id is a
+    key lookup plus the usual scalar filter, applied to the cached candidates instead of
+    inside an ANN query. They are filled in the background, newest media first, once the
+    outbox has flushed a vector. Each new item is searched `depth` times deeper than it
+    keeps, and those hits double as a reverse check: any existing list the new item now
+    beats is updated in place. Lists older than `ttl` seconds are recomputed in full,
+    which also catches neighbours the reverse check cannot see. An item whose vector is
+    not in the store yet gets an empty marker, retried every `retry` seconds. '''
+
+    def __init__(self, k: int, depth: int, batch_size: int, interval: float, ttl: float, retry: float):
+        self.k = k
+        self.depth = depth
+        self.batch_size = batch_size
+        self.interval = interval
+        self.ttl = ttl
+        self.retry = retry
+        self.wake = asyncio.Event()
+        self.task = None
+        self.built = 0
+        self.updated = 0
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+    def notify(self):
+        # Called after the outbox has written new vectors
+        self.wake.set()
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run(), name="Neighbour Lists")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            async with SessionLocal() as db:
+                try:
+                    while await self.build(db) == self.batch_size:
+                        pass
+                except Exception as e:
+                    await db.rollback()
+                    self.last_error = str(e)
+                    print(f"Neighbour list update failed: {str(e)}")
+
+    async def search(self, mid: str, image_embed) -> tuple[str, list]:
+        hits = await milvus_client.search(image_embed=image_embed, limit=self.k * self.depth, exclude=[mid])
+        return mid, [[hit["id"], float(hit["distance"])] for hit in hits]
+
+    async def build(self, db: AsyncSession) -> int:
+        new = await get_unlisted_mids(db, self.batch_size)
+        if new:
+            mids = new
+        else:
+            now = datetime.datetime.now()
+            before, retry_before = now - datetime.timedelta(seconds=self.ttl), now - datetime.timedelta(seconds=self.retry)
+            mids = await get_stale_neighbour_mids(db, before, retry_before, self.batch_size)
+        if not mids:
+            return 0
+
+        vectors = await milvus_client.get_vectors(mids)
+        found = dict(await asyncio.gather(
+            *(self.search(mid, vectors[mid]["image_embed"]) for mid in mids if mid in vectors)
+        ))
+
+        # New items' hits are also the lists they may belong in; every row is locked in one go
+        candidates = self.candidates({mid: found[mid] for mid in new if mid in found})
+        rows = await lock_neighbours(db, list(set(mids) | set(candidates)))
+        for mid in mids:
+            row = rows.get(mid)
+            if row is None:
+                row = MediaNeighbours(mid=mid)
+                db.add(row)
+            # SQL NULL rather than JSON null, so the retry query can find the marker
+            row.neighbours = found[mid][:self.k] if mid in found else null()
+            row.updated_at = func.now()
+        self.reverse(rows, candidates)
+        await db.commit()
+        self.built += len(mids)
+        return len(mids)
+
+    def candidates(self, found: dict) -> dict:
+        ''' New items by the existing list they may now belong in '''
+        candidates = {}
+        for mid, hits in found.items():
+            for nid, score in hits:
+                candidates.setdefault(nid, []).append([mid, score])
+        return candidates
+
+    def reverse(self, rows: dict, candidates: dict):
+        ''' Adds new items to the existing lists they now belong in '''
+        for nid, row in rows.items():
+            if nid not in candidates or not isinstance(row.neighbours, list):
+                continue
+            kth = row.neighbours[-1][1] if len(row.neighbours) >= self.k else float("-inf")
+            better = [candidate for candidate in candidates[nid] if candidate[1] > kth]
+            if better:
+                row.neighbours = merge(row.neighbours, better, self.k)
+                self.updated += 1
+
+    async def lookup(self, db: AsyncSession, mid: str, limit: int, offset: int, filter: SearchFilter = None) -> list[dict] | None:
+        ''' Cached hits for `mid` in search() format, or None when a live search is needed '''
+        if offset + limit > self.k:
+            return None
+        neighbours = await get_neighbours(db, mid)
+        if not neighbours:
+            self.misses += 1
+            return None
+        attrs = await get_vector_attrs(db, [nid for nid, _ in neighbours])
+        hits = [
+            {"id": nid, "distance": score} for nid, score in neighbours
+            if nid in attrs and (filter is None or filter.matches(attrs[nid]))
+        ]
+        if len(hits) < offset + limit and len(neighbours) >= self.k:
+            # The filter (or deletions) left too few candidates; a live search goes deeper
+            self.misses += 1
+            return None
+        self.hits += 1
+        return hits[offset:offset + limit]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "built": self.built,
+            "updated": self.updated,
+            "last_error": self.last_error,
+        }
+
+neighbour_lists = NeighbourLists(NEIGHBOUR_K, NEIGHBOUR_DEPTH, NEIGHBOUR_BATCH, NEIGHBOUR_INTERVAL, NEIGHBOUR_TTL, NEIGHBOUR_RETRY)
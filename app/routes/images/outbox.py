@@ -0,0 +1,211 @@
+from ...common import *
+from ...database import SessionLocal
+from .crud import get_outbox_batch, retry_outbox, requeue_outbox, get_outbox_stats, get_outbox_mids, get_all_mids, get_media_by_mids, enqueue_vectors, get_vector_attrs, get_backfill, record_backfill_changes
+from .models import VectorOutbox
+from .neighbours import neighbour_lists
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 256))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", 1.0))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", 60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_RECONCILE_INTERVAL = float(os.getenv("OUTBOX_RECONCILE_INTERVAL", 6 * 60 * 60))
+
+class OutboxFlusher:
+    ''' Drains `vector_outbox` into the vector store in the background.
+
+    Media writes add their vectors to the outbox in the same transaction, so the request
+    never waits on Milvus and a Milvus outage can't leave a Media row without its vector.
+    A batch is flushed once `batch_size` entries are waiting or `interval` seconds have
+    passed, whichever comes first. Failed batches stay in the table and are retried with
+    exponential backoff; entries that keep failing are parked after `max_attempts` until
+    the next reconciliation. Reconciliation compares media ids with the vector store ids
+    and queues whatever is missing on either side. '''
+
+    def __init__(self, batch_size: int, interval: float, max_backoff: float, max_attempts: int, reconcile_interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.reconcile_interval = reconcile_interval
+        self.wake = asyncio.Event()
+        self.waiting = 0
+        self.failures = 0
+        self.flushed = 0
+        self.last_error = None
+        self.last_reconcile = None
+        self.tasks = []
+
+    def notify(self, n: int = 1):
+        # Called after a commit that added outbox entries; a full batch is flushed right away
+        self.waiting += n
+        if self.waiting >= self.batch_size:
+            self.wake.set()
+
+    async def start(self):
+        self.tasks = [
+            asyncio.create_task(self.run(), name="Vector Outbox Flusher"),
+            asyncio.create_task(self.reconcile_loop(), name="Vector Reconciliation"),
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        try:
+            await self.drain()
+        except Exception as e:
+            print(f"Failed to drain vector outbox: {str(e)}")
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            self.waiting = 0
+            try:
+                await self.drain()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Vector outbox flush failed: {str(e)}")
+                await asyncio.sleep(min(self.max_backoff, self.interval * 2 ** self.failures))
+
+    async def drain(self):
+        async with SessionLocal() as db:
+            while await self.flush(db) == self.batch_size:
+                pass
+
+    async def flush(self, db: AsyncSession) -> int:
+        rows = await get_outbox_batch(db, self.batch_size, self.max_attempts)
+        if not rows:
+            await db.commit()
+            return 0
+
+        # Entries are in commit order, so the last one per media id decides its state
+        latest = {}
+        for row in rows:
+            latest[row.mid] = row
+        deletes = [mid for mid, row in latest.items() if row.op == 'delete']
+        # Scalars are read at flush time so the store always gets the current values
+        attrs = await get_vector_attrs(db, [mid for mid, row in latest.items() if row.op == 'upsert'])
+
+        oids = [row.oid for row in rows]
+        try:
+            # An upsert without vectors only refreshes the scalars of a stored row
+            refresh = [mid for mid in attrs if latest[mid].image_embed is None]
+            stored = await milvus_client.get_vectors(refresh) if refresh else {}
+            upserts = []
+            for mid, attr in attrs.items():
+                row = latest[mid]
+                if row.image_embed is not None:
+                    vectors = {
+                        "image_embed": np.frombuffer(row.image_embed, dtype=np.float32).tolist(),
+                        "text_embed": np.frombuffer(row.text_embed, dtype=np.float32).tolist(),
+                    }
+                elif mid in stored:
+                    vectors = {field: list(stored[mid][field]) for field in ("image_embed", "text_embed")}
+                else:
+                    # Nothing to refresh; reconciliation re-embeds it as missing
+                    continue
+                upserts.append({"id": mid, **vectors, **attr})
+            # Media deleted since the upsert was queued must not come back
+            deletes += [mid for mid, row in latest.items() if row.op == 'upsert' and mid not in attrs]
+
+            if deletes:
+                await milvus_client.delete(deletes)
+            if upserts:
+                await milvus_client.upsert_batch(upserts)
+        except Exception as e:
+            await db.rollback()
+            await retry_outbox(db, oids, str(e))
+            raise
+
+        # A pending backfill copied these scalars earlier and refreshes them when promoted
+        backfill = await get_backfill(db, ['running', 'done'])
+        if backfill:
+            await record_backfill_changes(db, backfill.bid, list(latest))
+        await db.execute(delete(VectorOutbox).where(VectorOutbox.oid.in_(oids)).execution_options(synchronize_session=False))
+        await db.commit()
+        self.flushed += len(rows)
+        if upserts:
+            neighbour_lists.notify()
+        return len(rows)
+
+    async def reconcile_loop(self):
+        while True:
+            async with SessionLocal() as db:
+                try:
+                    await self.reconcile(db)
+                except Exception as e:
+                    await db.rollback()
+                    print(f"Vector reconciliation failed: {str(e)}")
+            await asyncio.sleep(self.reconcile_interval)
+
+    async def reconcile(self, db: AsyncSession) -> dict:
+        ''' Queues vectors for media the store lacks and deletes for ids it has without media '''
+        # Read the store first: anything committed afterwards is covered by the outbox or media reads
+        stored = await milvus_client.list_ids()
+        # Give parked entries another round now that some time has passed
+        await requeue_outbox(db, self.max_attempts)
+        pending = await get_outbox_mids(db)
+        mids = await get_all_mids(db)
+
+        orphans = list(stored - mids - pending)
+        missing = list(mids - stored - pending)
+        # Rows indexed before filtered search existed get their scalars filled in
+        stale = list((await milvus_client.list_stale_ids() & mids) - pending)
+        reindexed = 0
+        for i in range(0, len(missing), self.batch_size):
+            upserts = await self.reembed(db, missing[i:i + self.batch_size])
+            await enqueue_vectors(db, upserts, [])
+            reindexed += len(upserts)
+        if orphans or stale:
+            await enqueue_vectors(db, [], orphans, stale)
+        self.notify(reindexed + len(orphans) + len(stale))
+
+        self.last_reconcile = {
+            "at": datetime.datetime.now().isoformat(),
+            "missing": len(missing),
+            "reindexed": reindexed,
+            "orphans": len(orphans),
+            "stale": len(stale),
+        }
+        print(f"Vector reconciliation: {len(missing)} missing, {reindexed} re-embedded, {len(orphans)} orphaned, {len(stale)} stale")
+        return self.last_reconcile
+
+    async def reembed(self, db: AsyncSession, mids: list) -> list[tuple]:
+        # Vectors aren't kept in Postgres, so missing ones are recomputed from the stored files
+        medias = await get_media_by_mids(db, mids)
+        encoded = await asyncio.gather(
+            *(encode_image_file(os.path.join(STORAGE_DIR, media.url)) for media in medias),
+            return_exceptions=True
+        )
+        found = []
+        for media, image in zip(medias, encoded):
+            if isinstance(image, Exception):
+                print(f"Cannot re-embed {media.mid}: {str(image)}")
+                continue
+            found.append((media, image))
+        if not found:
+            return []
+        texts = [media.title + (media.desc or "") + ' '.join(tag.name for tag in media.tags) for media, _ in found]
+        embeddings = await encoder.encode([image for _, image in found] + texts)
+        img_embeds, text_embeds = embeddings[:len(found)], embeddings[len(found):]
+        return [(media.mid, img_embed, text_embed) for (media, _), img_embed, text_embed in zip(found, img_embeds, text_embeds)]
+
+    async def stats(self) -> dict:
+        async with SessionLocal() as db:
+            stats = await get_outbox_stats(db, self.max_attempts)
+        stats.update({
+            "flushed": self.flushed,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_reconcile": self.last_reconcile,
+        })
+        return stats
+
+vector_outbox = OutboxFlusher(OUTBOX_BATCH_SIZE, OUTBOX_FLUSH_INTERVAL, OUTBOX_MAX_BACKOFF, OUTBOX_MAX_ATTEMPTS, OUTBOX_RECONCILE_INTERVAL)
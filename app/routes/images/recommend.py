@@ -0,0 +1,224 @@
+from collections import OrderedDict
+
+from ...common import *
+from ...vectorstore import normalize
+from .crud import get_user_taste, lock_user_tastes, get_user_preferences, get_preference_attrs, get_seen_mids
+from .models import UserTastes
+
+RECOMMEND_CANDIDATES = int(os.getenv("RECOMMEND_CANDIDATES", 256))
+RECOMMEND_DISLIKE_WEIGHT = float(os.getenv("RECOMMEND_DISLIKE_WEIGHT", 0.5))
+RECOMMEND_DIVERSITY = float(os.getenv("RECOMMEND_DIVERSITY", 0.3))
+RECOMMEND_CACHE_TTL = float(os.getenv("RECOMMEND_CACHE_TTL", 5 * 60))
+RECOMMEND_CACHE_SIZE = int(os.getenv("RECOMMEND_CACHE_SIZE", 10_000))
+# Milvus caps topk at 16384
+RECOMMEND_MAX_DEPTH = 16384
+
+def unpack(blob: bytes | None) -> np.ndarray | None:
+    return None if blob is None else np.frombuffer(blob, dtype=np.float32)
+
+def taste_vector(row: UserTastes, dislike_weight: float) -> np.ndarray | None:
+    ''' Mean liked embedding minus `dislike_weight` times the mean disliked one, unit length '''
+    if not row or not row.likes:
+        return None
+    taste = unpack(row.like_sum) / row.likes
+    if row.dislikes:
+        taste = taste - dislike_weight * unpack(row.dislike_sum) / row.dislikes
+    return normalize(taste)
+
+def diversify(relevance: np.ndarray, vectors: np.ndarray, diversity: float) -> np.ndarray:
+    ''' Maximal marginal relevance order: each pick maximizes (1 - diversity) * relevance minus
+    diversity * similarity to the closest item already picked '''
+    similarity = vectors @ vectors.T
+    closest = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    order = np.empty(len(relevance), dtype=np.int64)
+    for i in range(len(relevance)):
+        score = np.where(available, (1 - diversity) * relevance - diversity * closest, -np.inf)
+        pick = int(np.argmax(score))
+        order[i] = pick
+        available[pick] = False
+        np.maximum(closest, similarity[pick], out=closest)
+    return order
+
+class TTLCache:
+    ''' Bounded LRU map whose entries expire after `ttl` seconds '''
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < asyncio.get_running_loop().time():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.items[key] = (asyncio.get_running_loop().time() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
+
+class Recommender:
+    ''' Personal recommendations from a taste vector per user.
+
+    The taste is kept as running sums of the image embeddings a user liked and disliked
+    (`user_tastes`), so a new preference is one vector added or subtracted, in the same
+    transaction that writes it. Profiles are built from the preferences table on first
+    use, or again once the catalog has been re-embedded with another model. Both hold the
+    user's row lock, so a preference is counted exactly once whichever runs first. A recommendation is a single ANN query for the taste,
+    minus what the user has seen, ranked by similarity and reordered for diversity with
+    MMR. The ranking is cached per user for `ttl` seconds, or until their next
+    preference; the seen set is cached alongside it and updated as events arrive. '''
+
+    def __init__(self, candidates: int, dislike_weight: float, diversity: float, ttl: float, cache_size: int):
+        self.candidates = candidates
+        self.dislike_weight = dislike_weight
+        self.diversity = diversity
+        self.rankings = TTLCache(ttl, cache_size)
+        self.seen = TTLCache(ttl, cache_size)
+        self.built = 0
+        self.updated = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def build(self, db: AsyncSession, uid: str) -> UserTastes:
+        # Vectors are fetched before the lock; only preferences added meanwhile are fetched under it
+        fetched = {mid for mid, _ in await get_user_preferences(db, uid)}
+        vectors = await milvus_client.get_vectors(list(fetched))
+        row = (await lock_user_tastes(db, [uid]))[uid]
+        if row.model_id == clip_backend.model_id:
+            # Built by a concurrent request while this one waited
+            await db.commit()
+            return row
+        preferences = await get_user_preferences(db, uid)
+        missing = [mid for mid, _ in preferences if mid not in fetched]
+        if missing:
+            vectors.update(await milvus_client.get_vectors(missing))
+        sums = {"like": None, "dislike": None}
+        counts = {"like": 0, "dislike": 0}
+        for mid, attr in preferences:
+            if mid in vectors:
+                vector = np.asarray(vectors[mid]["image_embed"], dtype=np.float32)
+                sums[attr] = vector if sums[attr] is None else sums[attr] + vector
+                counts[attr] += 1
+        row.model_id = clip_backend.model_id
+        row.like_sum = None if sums["like"] is None else sums["like"].tobytes()
+        row.dislike_sum = None if sums["dislike"] is None else sums["dislike"].tobytes()
+        row.likes, row.dislikes = counts["like"], counts["dislike"]
+        await db.commit()
+        self.built += 1
+        return row
+
+    async def taste(self, db: AsyncSession, uid: str) -> np.ndarray | None:
+        row = await get_user_taste(db, uid)
+        if row is None or row.model_id != clip_backend.model_id:
+            row = await self.build(db, uid)
+        return taste_vector(row, self.dislike_weight)
+
+    async def seen_mids(self, db: AsyncSession, uid: str) -> set:
+        seen = self.seen.get(uid)
+        if seen is None:
+            seen = await get_seen_mids(db, uid)
+            self.seen.set(uid, seen)
+        return seen
+
+    async def recommend(self, db: AsyncSession, uid: str, limit: int, offset: int = 0, nsfw: bool = False) -> list[tuple[str, float]] | None:
+        ''' (mid, similarity) pairs, or None when the user has no likes to go on '''
+        seen = await self.seen_mids(db, uid)
+        ranked = self.rankings.get((uid, nsfw))
+        if ranked is None:
+            self.misses += 1
+            taste = await self.taste(db, uid)
+            if taste is None:
+                return None
+            hits = await milvus_client.search(
+                image_embed=taste.tolist(), limit=min(self.candidates + len(seen), RECOMMEND_MAX_DEPTH), filter=SearchFilter(uid=uid, nsfw=nsfw)
+            )
+            ids = [hit["id"] for hit in hits if hit["id"] not in seen][:self.candidates]
+            vectors = await milvus_client.get_vectors(ids)
+            ids = [mid for mid in ids if mid in vectors]
+            ranked = []
+            if ids:
+                matrix = normalize([vectors[mid]["image_embed"] for mid in ids])
+                relevance = matrix @ taste
+                ranked = [(ids[i], float(relevance[i])) for i in diversify(relevance, matrix, self.diversity)]
+            self.rankings.set((uid, nsfw), ranked)
+        else:
+            self.hits += 1
+        # Items seen since the ranking was cached drop out without recomputing it
+        return [item for item in ranked if item[0] not in seen][offset:offset + limit]
+
+    async def vectors(self, preferences: dict) -> dict:
+        ''' Vectors of the rated media, fetched before update() takes any row lock '''
+        if not preferences:
+            return {}
+        try:
+            return await milvus_client.get_vectors(list({mid for _, mid in preferences}))
+        except Exception as e:
+            # The preferences are still written; the profiles catch up when next rebuilt
+            print(f"Failed to fetch vectors for taste profiles: {str(e)}")
+            return {}
+
+    async def update(self, db: AsyncSession, preferences: dict, vectors: dict) -> dict:
+        ''' Moves the taste profiles by a batch of preferences about to be written in the same
+        transaction, and returns the preferences it replaces, read under the row locks.
+        Not committed. '''
+        if not preferences:
+            return {}
+        rows = await lock_user_tastes(db, [uid for uid, _ in preferences])
+        previous = await get_preference_attrs(db, list(preferences))
+        for (uid, mid), attr in preferences.items():
+            row = rows.get(uid)
+            # Unbuilt or outdated profiles are built from scratch when first used
+            if previous.get((uid, mid)) == attr or row is None or mid not in vectors or row.model_id != clip_backend.model_id:
+                continue
+            vector = np.asarray(vectors[mid]["image_embed"], dtype=np.float32)
+            old = previous.get((uid, mid))
+            if old is not None:
+                self.apply(row, old, vector, -1)
+            self.apply(row, attr, vector, 1)
+            self.updated += 1
+        return previous
+
+    def record(self, views: dict, preferences: dict, previous: dict):
+        ''' Updates the caches for a committed EventBuffer batch '''
+        for uid, mid in [*views, *preferences]:
+            seen = self.seen.get(uid)
+            if seen is not None:
+                seen.add(mid)
+        for (uid, mid), attr in preferences.items():
+            if previous.get((uid, mid)) != attr:
+                self.rankings.pop((uid, False))
+                self.rankings.pop((uid, True))
+
+    def apply(self, row: UserTastes, attr: str, vector: np.ndarray, step: int):
+        column, count = ("like_sum", "likes") if attr == "like" else ("dislike_sum", "dislikes")
+        total = unpack(getattr(row, column))
+        n = getattr(row, count) + step
+        setattr(row, count, n)
+        # Emptied sums restart from nothing instead of carrying float32 residue
+        setattr(row, column, None if n <= 0 else (step * vector if total is None else total + step * vector).tobytes())
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "built": self.built,
+            "updated": self.updated,
+            "cached": len(self.rankings),
+        }
+
+recommender = Recommender(RECOMMEND_CANDIDATES, RECOMMEND_DISLIKE_WEIGHT, RECOMMEND_DIVERSITY, RECOMMEND_CACHE_TTL, RECOMMEND_CACHE_SIZE)
@@ -1,14 +1,57 @@
 from ...common import *
 from . import schemas
-from .utils import generate_url, hash_image, get_db, save_image, analyse_image
-from .crud import add_media, get_image_by_mid, add_preference, add_view, recommend_media, get_tags, is_duplicate_image, add_tags, classify_image, add_collection, get_collection_images, get_collections, get_collections_by_user, grant_access, request_access, get_collection_info, get_images
+from .utils import generate_url, get_db, save_image, analyse_image, upload_batch, media_area
+from .ingest import ingest_queue
+from .outbox import vector_outbox
+from .neighbours import neighbour_lists
+from .events import event_buffer
+from .trending import trending
+from .recommend import recommender
+from .feed import timelines, encode_feed_cursor, decode_feed_cursor, interleave, FEED_RECOMMEND_EVERY
+from .tagcache import tag_cache
+from ...imaging import process_image
+from .crud import add_media, get_image_by_mid, get_tags, is_duplicate_image, add_tags, classify_image, add_collection, get_collection_images, get_collection_cards, grant_access, request_access, get_collection_info, get_media_cards, get_media_cards_by_mids, get_job, get_near_duplicates, get_images_by_mids, get_tag_ids, rank_text
 
 router = APIRouter(prefix='/api')
 
+MAX_BATCH_UPLOAD = int(os.getenv("MAX_BATCH_UPLOAD", 256))
+IDENTICAL_SCORE = float(os.getenv("IDENTICAL_SCORE", 0.99))
+HYBRID_METHOD = os.getenv("HYBRID_METHOD", "rrf")  # rrf or weighted
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+HYBRID_DEPTH = int(os.getenv("HYBRID_DEPTH", 4))
+HYBRID_IMAGE_WEIGHT = float(os.getenv("HYBRID_IMAGE_WEIGHT", 1.0))
+HYBRID_TEXT_WEIGHT = float(os.getenv("HYBRID_TEXT_WEIGHT", 1.0))
+HYBRID_FULLTEXT_WEIGHT = float(os.getenv("HYBRID_FULLTEXT_WEIGHT", 0.5))
+
+async def build_search_filter(db: AsyncSession, uid: str, tags: str, nsfw: bool) -> SearchFilter:
+    tids = await get_tag_ids(db, [name.strip() for name in tags.split(',')]) if tags else None
+    if tags and not tids:
+        # None of the tags exist; an empty tag list would otherwise mean no tag filter at all
+        tids = [0]
+    return SearchFilter(uid=uid, nsfw=nsfw, tids=tids)
+
+async def hybrid_hits(db: AsyncSession, embedding, limit: int, offset: int, search_filter: SearchFilter,
+                      exclude: list = None, query: str = None) -> list[dict]:
+    ''' Fused image_embed + text_embed ranking, optionally re-fused with the Postgres full-text rank of `query` '''
+    options = {
+        "filter": search_filter,
+        "exclude": exclude,
+        "weights": (HYBRID_IMAGE_WEIGHT, HYBRID_TEXT_WEIGHT),
+        "method": HYBRID_METHOD,
+        "depth": HYBRID_DEPTH,
+        "rrf_k": HYBRID_RRF_K,
+    }
+    if not query:
+        return await milvus_client.hybrid_search(embedding, limit=limit, offset=offset, **options)
+    # Full-text only reorders the vector candidates, so it costs one indexed lookup on their ids
+    hits = await milvus_client.hybrid_search(embedding, limit=HYBRID_DEPTH * (offset + limit), **options)
+    ranks = await rank_text(db, query, [hit["id"] for hit in hits])
+    return fuse([hits, ranks], (1.0, HYBRID_FULLTEXT_WEIGHT), "rrf", HYBRID_RRF_K)[offset:offset + limit]
+
 # Media Route
 @router.post("/upload", status_code=201, tags=['Media'])
 async def create_image(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     image: UploadFile = File(...),
     title: str = Form(...),
     desc: str = Form(None),
@@ -18,16 +61,15 @@ async def create_image(
     is_nsfw: bool = Form(False),
     uid: str = Depends(validate_user)
 ): 
+    upload = await spool_upload(image)
     try:
-        contents = await image.read()
-        fp = Image.open(BytesIO(contents))
-        
-        # Run independent operations concurrently
-        url, hash, encoded = await asyncio.gather(
-            generate_url(fp.format.lower()),
-            hash_image(fp),
-            encode_image(contents)
+        # Decode and hash in the image engine while the image is embedded; a cached
+        # upload is never downscaled
+        meta, image_embed = await asyncio.gather(
+            process_image(upload.path),
+            encoder.encode_images([(upload.path, upload.sha256)])
         )
+        url, hash = await generate_url(meta["format"].lower()), meta["hash"]
         
         # Check for duplicate early
         if await is_duplicate_image(db, hash):
@@ -37,12 +79,12 @@ async def create_image(
         collections = [name.strip() for name in collections.split(',')]
         
         # Process tags and get embeddings concurrently
-        tags = tags.split(',') if tags else await classify_image(db, contents)
+        tags = tags.split(',') if tags else await classify_image(db, image_embed[0])
         text_input = title + (desc or "") + ' '.join(tags)
         
         embedding_tasks = asyncio.gather(
-            clip.aencode([encoded, text_input]),
-            analyse_image(contents)
+            encoder.encode([text_input]),
+            analyse_image(upload.path)
         )
         
         # Prepare kwargs while waiting for embeddings
@@ -54,122 +96,376 @@ async def create_image(
             "tags": tags,
             "collections": collections,
             "uid": uid,
+            "width": meta["width"],
+            "height": meta["height"],
         }
         
         if is_nsfw:
             kwargs["isNSFW"] = is_nsfw
-        if fp.format == "GIF":
-            kwargs["span"] = fp.info.get("duration") * 1000
+        if meta["format"] == "GIF":
+            kwargs["span"] = meta["duration"] * 1000
         if src:
             kwargs["src"] = src
 
         # Get results from embedding tasks
-        (img_embed, text_embed), (score, color) = await embedding_tasks
-        kwargs.update({"score": score, "color": color})
+        (text_embed,), (score, color) = await embedding_tasks
+        kwargs.update({"score": score, "color": color, "image_embed": image_embed[0], "text_embed": text_embed})
 
-        # Database operations
-        mid = await add_media(db, **kwargs)
-        
-        # Run storage operations concurrently
-        await asyncio.gather(
-            milvus_client.insert_data(mid, img_embed, text_embed),
-            save_image(contents, os.path.join(STORAGE_DIR, url))
-        )
+        # Move the file into place first so a committed row never points at a missing file
+        path = os.path.join(STORAGE_DIR, url)
+        await upload.move_to(path)
+        try:
+            # The vectors are queued in the same transaction and indexed in the background
+            mid = await add_media(db, **kwargs)
+        except Exception:
+            os.remove(path)
+            raise
+        vector_outbox.notify()
         
         return {"message": "Upload successful", "media_id": mid}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        upload.discard()
+
+@router.post("/upload/batch", status_code=207, tags=['Media'])
+async def create_images(
+    db: AsyncSession = Depends(get_db),
+    images: List[UploadFile] = File(...),
+    metadata: str = Form(None),
+    tags: str = Form(None),
+    src: str = Form(None),
+    collections: str = Form(...),
+    is_nsfw: bool = Form(False),
+    uid: str = Depends(validate_user)
+):
+    ''' metadata: optional JSON list aligned with images, each entry may override
+    title, desc, tags, src, collections and is_nsfw. Title defaults to the file name. '''
+    try:
+        if len(images) > MAX_BATCH_UPLOAD:
+            raise Exception(f"At most {MAX_BATCH_UPLOAD} images per batch")
+        metadata = json.loads(metadata) if metadata else []
+        if not isinstance(metadata, list):
+            raise Exception("Invalid metadata")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    items = []
+    try:
+        for i, image in enumerate(images):
+            meta = metadata[i] if i < len(metadata) else {}
+            item_tags = meta.get("tags", tags)
+            item_collections = meta.get("collections", collections)
+            if isinstance(item_tags, str):
+                item_tags = item_tags.split(',')
+            if isinstance(item_collections, str):
+                item_collections = item_collections.split(',')
+            items.append({
+                "filename": image.filename,
+                "upload": await spool_upload(image),
+                "title": meta.get("title") or Path(image.filename or "").stem,
+                "desc": meta.get("desc"),
+                "tags": item_tags or [],
+                "src": meta.get("src", src),
+                "collections": [name.strip() for name in item_collections],
+                "is_nsfw": meta.get("is_nsfw", is_nsfw),
+            })
+    except Exception as e:
+        for item in items:
+            item["upload"].discard()
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        results = await upload_batch(db, uid, items)
+    finally:
+        for item in items:
+            item["upload"].discard()
+    return {"results": results}
+
+@router.post("/upload/async", status_code=202, tags=['Media'])
+async def queue_image(
+    db: AsyncSession = Depends(get_db),
+    image: UploadFile = File(...),
+    title: str = Form(...),
+    desc: str = Form(None),
+    tags: str = Form(None),
+    src: str = Form(None),
+    collections: str = Form(...),
+    is_nsfw: bool = Form(False),
+    uid: str = Depends(validate_user)
+):
+    payload = {
+        "title": title,
+        "desc": desc,
+        "tags": tags.split(',') if tags else [],
+        "src": src,
+        "collections": [name.strip() for name in collections.split(',')],
+        "is_nsfw": is_nsfw,
+    }
+    try:
+        jid = await ingest_queue.submit(db, uid, image, payload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": jid, "status": "queued"}
+
+@router.get("/upload/jobs/{jid}", tags=['Media'])
+async def get_upload_job(jid: str, uid: str = Depends(validate_user), db: AsyncSession = Depends(get_db)):
+    job = await get_job(db, jid)
+    if job is None or job.uid != uid:
+        raise HTTPException(status_code=404, detail="Job Not Found")
+    return {
+        "job_id": job.jid,
+        "status": job.status,
+        "stage": job.stage,
+        "attempts": job.attempts,
+        "error": job.error,
+        # Reserved before the row is written; only reported once it exists
+        "media_id": job.mid if job.status == 'done' else None,
+    }
 
 @router.get("/media", tags=['Media'])
-async def list_dbimages(db: Session = Depends(get_db)):
-    images = await get_images(db)
-    return images
+async def list_dbimages(
+    limit: int = 50,
+    cursor: str = None,
+    user_id: str = None,
+    nsfw: bool = False,
+    uid: str = Depends(get_uid),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Grid cards, newest first; pass next_cursor back as cursor for the following page '''
+    try:
+        return await get_media_cards(db, limit, cursor, uid, user_id, nsfw)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/trending", tags=['Media'])
+async def list_trending(
+    limit: int = 50,
+    offset: int = 0,
+    tag: str = None,
+    collection: int = None,
+    nsfw: bool = False,
+    uid: str = Depends(get_uid),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Grid cards by decayed popularity, overall or within a tag or collection '''
+    try:
+        tid = None
+        if tag:
+            tid = (await tag_cache.resolve(db, [tag])).get(tag)
+            if tid is None:
+                return {"items": []}
+        # Offsets count items this viewer may see, so walk the board a chunk at a time
+        # and stop hydrating once the page is filled
+        end = offset + page_size(limit)
+        chunk = 2 * end
+        items, start = [], 0
+        while len(items) < end:
+            ranked = trending.top(chunk, start, tid, collection)
+            cards = await get_media_cards_by_mids(db, [mid for mid, _ in ranked], uid, nsfw)
+            items.extend({**cards[mid], "score": score} for mid, score in ranked if mid in cards)
+            if len(ranked) < chunk:
+                break
+            start += chunk
+        return {"items": items[offset:end]}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/media/{mid}", tags=['Media'])
 async def get_dbimage(
     mid: str, 
     uid: str = Depends(get_uid), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     image = await get_image_by_mid(db, mid, uid)
     if image is None:
         raise HTTPException(status_code=404, detail="Image Not Found")
     return image
 
-@router.post("/preference", tags=['Media'])
+@router.get("/media/{mid}/larger", tags=['Media'])
+async def get_larger_copies(
+    mid: str,
+    k: int = 8,
+    uid: str = Depends(get_uid),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Near-duplicates of a media item stored at a higher resolution '''
+    image = await get_image_by_mid(db, mid, uid)
+    matches = await get_near_duplicates(db, mid, k)
+    if not image or matches is None:
+        raise HTTPException(status_code=404, detail="Image Not Found")
+
+    candidates = await get_images_by_mids(db, [match for match, _ in matches], uid)
+    # Rows from before sizes were stored fall back to reading their headers, all at once
+    area, *areas = await asyncio.gather(*(media_area(item) for item in [image, *candidates]))
+    larger = [(candidate_area, candidate) for candidate_area, candidate in zip(areas, candidates) if candidate_area > area]
+    larger.sort(key=lambda item: item[0], reverse=True)
+    return [candidate for _, candidate in larger]
+
+@router.post("/preference", status_code=202, tags=['Media'])
 async def post_preference(
-    mid: int = Form(...),
+    mid: str = Form(...),
     attr: str = Form(...),
     uid: str = Depends(validate_user),
-    db: Session = Depends(get_db)
 ):
     if attr not in ["like", "dislike"]:
         raise HTTPException(400, "Invalid preference value")
-    
-    try:
-        await add_preference(db, uid, mid, attr)
-    except Exception as e:
-        raise HTTPException(400, str(e))
+    # Buffered and written in the next batch
+    if not event_buffer.preference(uid, mid, attr):
+        raise HTTPException(503, "Event buffer is full, retry later")
 
-@router.post("/view", tags=['Media'])
+@router.post("/view", status_code=202, tags=['Media'])
 async def post_view(
-    mid: int = Form(...),
+    mid: str = Form(...),
     uid: str = Depends(validate_user),
-    db: Session = Depends(get_db)
 ):
+    if not event_buffer.view(uid, mid):
+        raise HTTPException(503, "Event buffer is full, retry later")
+    
+@router.get("/feed", tags=['Recommendations'])
+async def get_feed(
+    limit: int = 30,
+    cursor: str = None,
+    nsfw: bool = False,
+    uid: str = Depends(validate_user),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Uploads from followed accounts, newest first, with a recommendation after every
+    FEED_RECOMMEND_EVERY of them; recommendations fill the page once the timeline runs out '''
     try:
-        await add_view(db, uid, mid)
+        limit = page_size(limit)
+        timeline_cursor, done, offset = decode_feed_cursor(cursor)
+        timeline = {"items": [], "next_cursor": None}
+        if not done:
+            timeline = await timelines.page(db, uid, limit - limit // (FEED_RECOMMEND_EVERY + 1), timeline_cursor)
+        followed = [item["mid"] for item in timeline["items"]]
+        wanted = limit - len(followed)
+        recommended = await recommender.recommend(db, uid, wanted, offset, nsfw) or []
+        offset += len(recommended)
+        exhausted = len(recommended) < wanted
+        recommended = [item for item in recommended if item[0] not in set(followed)]
+        cards = await get_media_cards_by_mids(db, followed + [mid for mid, _ in recommended], uid, nsfw)
+        items = interleave(
+            [{**cards[mid], "source": "following"} for mid in followed if mid in cards],
+            [{**cards[mid], "source": "recommended", "score": score} for mid, score in recommended if mid in cards],
+            FEED_RECOMMEND_EVERY,
+        )
+        done = timeline["next_cursor"] is None
+        more = not done or not exhausted
+        return {"items": items, "next_cursor": encode_feed_cursor(timeline["next_cursor"], done, offset) if more else None}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(400, e)
-    
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Search and Recommendations Route
-@router.get("/recommend", response_model=List[schemas.Image], tags=['Recommendations'])
-async def get_recommendations(db: Session = Depends(get_db), uid: str = Depends(validate_user)):
+@router.get("/recommend", tags=['Recommendations'])
+async def get_recommendations(
+    limit: int = 20,
+    offset: int = 0,
+    nsfw: bool = False,
+    uid: str = Depends(validate_user),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Grid cards close to the user's likes and away from their dislikes, unseen only '''
     try:
-        results = await recommend_media(db, uid)
-        if not results:
-            raise Exception("No recommendations found")
-        return results
+        ranked = await recommender.recommend(db, uid, page_size(limit), offset, nsfw) or []
+        cards = await get_media_cards_by_mids(db, [mid for mid, _ in ranked], uid, nsfw)
     except Exception as e:
-        raise HTTPException(status_code=404, detail=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+    if not ranked:
+        raise HTTPException(status_code=404, detail="No recommendations found")
+    return {"items": [{**cards[mid], "score": score} for mid, score in ranked if mid in cards]}
 
 @router.post("/search", tags=['Search'])
-async def query_dbimages(query: str, db: Session = Depends(get_db), uid: str = Depends(get_uid)):
-    ''' future plans: compare with text_embeddings of Image title, description, tags '''
-    query_embed = await clip.aencode([query])
-    result = await milvus_client.search(text_embed=query_embed[0])
-    return [await get_image_by_mid(db, mid, uid) for mid in result['similar']]
+async def query_dbimages(
+    query: str,
+    limit: int = 20,
+    offset: int = 0,
+    tags: str = None,
+    nsfw: bool = False,
+    mode: str = "text",
+    fulltext: bool = False,
+    db: AsyncSession = Depends(get_db),
+    uid: str = Depends(get_uid)
+):
+    ''' mode: "text" matches the query against text_embed; "hybrid" also matches it against
+    image_embed and fuses both rankings, blending in the Postgres full-text rank when fulltext is set '''
+    if mode not in ("text", "hybrid"):
+        raise HTTPException(status_code=400, detail="Invalid search mode")
+    query_embed = await encoder.encode([query])
+    search_filter = await build_search_filter(db, uid, tags, nsfw)
+    if mode == "hybrid":
+        hits = await hybrid_hits(db, query_embed[0], limit, offset, search_filter, query=query if fulltext else None)
+    else:
+        hits = await milvus_client.search(text_embed=query_embed[0], limit=limit, offset=offset, filter=search_filter)
+    return await get_images_by_mids(db, [hit["id"] for hit in hits], uid)
     
 @router.post("/visual-search", tags=['Search'])
-async def visual_search(image: UploadFile|int = File(None), db: Session = Depends(get_db), uid: str = Depends(get_uid)):
+async def visual_search(
+    image: UploadFile|int = File(None),
+    limit: int = 20,
+    offset: int = 0,
+    tags: str = None,
+    nsfw: bool = False,
+    mode: str = "image",
+    db: AsyncSession = Depends(get_db),
+    uid: str = Depends(get_uid)
+):
+    ''' mode: "image" matches against image_embed; "hybrid" fuses it with text_embed matches.
+    Fused scores are not similarities, so "identical" is only filled in image mode.
+    Image mode by media id is served from the precomputed neighbour list when it covers the page. '''
     try:
+        if mode not in ("image", "hybrid"):
+            raise Exception("Invalid search mode")
+        search_filter = await build_search_filter(db, uid, tags, nsfw)
+        exclude, hits = None, None
         if isinstance(image, int):
             mid = image
             image = await get_image_by_mid(db, mid)
             if image is None:
                 raise Exception("Image not found")
-            image_embed = await milvus_client.get_embedding(mid) # do it
+            if mode == "image":
+                hits = await neighbour_lists.lookup(db, str(mid), limit, offset, search_filter)
+            if hits is None:
+                image_embed = [await milvus_client.get_embedding(mid)]
+                # The query image would otherwise come back as its own best match
+                exclude = [mid]
+        else:
+            upload = await spool_upload(image)
+            try:
+                image_embed = await encoder.encode_images([(upload.path, upload.sha256)])
+            finally:
+                upload.discard()
+        if mode == "hybrid":
+            hits = await hybrid_hits(db, image_embed[0], limit, offset, search_filter, exclude)
+            identical = set()
         else:
-            contents = await image.read()
-            encoded = await encode_image(contents)
-            image_embed = await clip.aencode([encoded])
-        result = await milvus_client.search(image_embed=image_embed[0])
-        result['identical'] = [await get_image_by_mid(db, mid, uid) for mid in result['identical']]
-        result['similar'] = [await get_image_by_mid(db, mid, uid) for mid in result['similar']]
-        return result
+            if hits is None:
+                hits = await milvus_client.search(image_embed=image_embed[0], limit=limit, offset=offset, filter=search_filter, exclude=exclude)
+            identical = {hit["id"] for hit in hits if hit["distance"] >= IDENTICAL_SCORE}
+        images = await get_images_by_mids(db, [hit["id"] for hit in hits], uid)
+        return {
+            "identical": [image for image in images if image.mid in identical],
+            "similar": [image for image in images if image.mid not in identical],
+        }
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     
 
 # Tags Route
 @router.get("/tags", response_model=List[schemas.Tags], tags=['tags'])
-async def list_tags(db: Session = Depends(get_db)):
+async def list_tags(db: AsyncSession = Depends(get_db)):
     # future plan send tags with count
     tags = await get_tags(db)
     return tags
 
 @router.post("/tags" , tags=['tags'])
-async def add_new_tags(tags: str, db: Session = Depends(get_db)):
+async def add_new_tags(tags: str, db: AsyncSession = Depends(get_db)):
     try:
         if '[' in tags or ']' in tags:
             raise Exception("Invalid tags")
@@ -179,24 +475,38 @@ async def add_new_tags(tags: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail=str(e))
     
 @router.post("/classify", tags=['tags'], response_model=dict)
-async def get_classifications(image: UploadFile = File(...), db: Session = Depends(get_db)):
-    contents = await image.read()
-    tags = await classify_image(db, contents)
+async def get_classifications(
+    image: UploadFile = File(...),
+    k: int = None,
+    min_score: float = None,
+    db: AsyncSession = Depends(get_db)
+):
+    upload = await spool_upload(image)
+    try:
+        image_embed = await encoder.encode_images([(upload.path, upload.sha256)])
+    finally:
+        upload.discard()
+    tags = await classify_image(db, image_embed[0], k, min_score)
     return {"tags": tags}
 
 
 # Collections Route
 @router.get("/collections", tags=['Collections'])
-async def get_all_collections(user_id:str|None=None, db: Session = Depends(get_db)):
-    ''' future plan: add pagination and ranking'''
-    if user_id is None:
-        collections = await get_collections(db)
-    else:
-        collections = await get_collections_by_user(db, user_id)
-    return collections
+async def get_all_collections(
+    user_id: str|None = None,
+    limit: int = 50,
+    cursor: str = None,
+    uid: str = Depends(get_uid),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' future plan: add ranking'''
+    try:
+        return await get_collection_cards(db, limit, cursor, uid, user_id)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/collections/{cid}", tags=['Collections'])
-async def get_collection(cid: int, db: Session = Depends(get_db), uid: str = Depends(get_uid)):
+async def get_collection(cid: int, db: AsyncSession = Depends(get_db), uid: str = Depends(get_uid)):
     collection = await get_collection_images(db, cid)
     if collection is None:
         raise HTTPException(status_code=404, detail="Collection Not Found")
@@ -207,7 +517,7 @@ async def add_collection_access(
     cid: int = Form(...),
     uids: str = Form(...),
     auth_uid: str = Depends(validate_user), #arthur
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         collection_info = await get_collection_info(db, cid)
@@ -226,7 +536,7 @@ async def add_collection_access(
 async def request_collection_access(
     cid: int = Form(...),
     uid: str = Depends(validate_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         collection_info = await get_collection_info(db, cid)
@@ -245,7 +555,7 @@ async def create_collection(
     tags: str = Form(...),
     scope: str = Form(None),
     uid: str = Depends(validate_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         tags = [tag.strip() for tag in tags.split(',')]
@@ -0,0 +1,39 @@
+from ...common import *
+from .models import Tags
+
+class TagCache:
+    ''' In-memory tag name -> tid map, so tagging costs no lookups per name.
+
+    Only committed rows ever enter it: the full table at startup, names read back on a
+    miss, and tags created by a write once that write has committed. A rolled-back insert
+    therefore can't leave a dangling id behind. Tags created by other workers are picked
+    up on their first miss.
+
+    The cache is write-through via `add` and never invalidated: tags are only ever created,
+    never renamed or deleted, so a cached id stays valid. A path that renames or deletes
+    tags has to drop the affected names here. '''
+
+    def __init__(self):
+        self.tids: dict[str, int] = {}
+        self.loaded = False
+
+    async def load(self, db: AsyncSession):
+        self.tids = dict((await db.execute(select(Tags.name, Tags.tid))).all())
+        self.loaded = True
+        print(f"Loaded {len(self.tids)} tags into the tag cache")
+
+    async def resolve(self, db: AsyncSession, names: list) -> dict[str, int]:
+        ''' tids of the names that exist, with at most one query for the ones not cached '''
+        missing = [name for name in dict.fromkeys(names) if name not in self.tids]
+        if missing:
+            self.tids.update((await db.execute(select(Tags.name, Tags.tid).where(Tags.name.in_(missing)))).all())
+        return {name: self.tids[name] for name in names if name in self.tids}
+
+    def add(self, tids: dict[str, int]):
+        # Call after the transaction that created them has committed
+        self.tids.update(tids)
+
+    def __len__(self):
+        return len(self.tids)
+
+tag_cache = TagCache()
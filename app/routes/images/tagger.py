@@ -0,0 +1,90 @@
+from ...common import *
+from ...database import SessionLocal
+from .models import Tags
+
+TAG_EMBEDDINGS_PATH = os.getenv("TAG_EMBEDDINGS_PATH", os.path.join(STORAGE_DIR, "cache", "tag_embeddings.npz"))
+TAG_ENCODE_BATCH = int(os.getenv("TAG_ENCODE_BATCH", 256))
+TAG_TOP_K = int(os.getenv("TAG_TOP_K", 7))
+TAG_MIN_SCORE = float(os.getenv("TAG_MIN_SCORE")) if os.getenv("TAG_MIN_SCORE") else None
+
+class TagEmbeddingStore:
+    ''' Every tag name encoded once by CLIP and kept as rows of a normalised float32 matrix.
+
+    Classifying an image is then one image encode plus one matrix-vector product instead
+    of re-ranking the whole vocabulary on the CLIP server. The matrix is persisted next to
+    the other caches in STORAGE_DIR and extended whenever tags are added. '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.names: list[str] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def load(self):
+        if os.path.exists(self.path):
+            data = np.load(self.path, allow_pickle=False)
+            # A matrix from another CLIP model is re-encoded from scratch
+            if "model_id" in data.files and str(data["model_id"]) == clip_backend.model_id:
+                self.names = data["names"].tolist()
+                self.matrix = data["matrix"]
+        self.loaded = True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp.npz"
+        np.savez(tmp, names=np.array(self.names, dtype=str), matrix=self.matrix, model_id=clip_backend.model_id)
+        os.replace(tmp, self.path)
+
+    async def sync(self, db: AsyncSession):
+        ''' Brings the matrix in line with the tags table, encoding only what is missing '''
+        if not self.loaded:
+            await asyncio.to_thread(self.load)
+        names = (await db.scalars(select(Tags.name))).all()
+        current = set(names)
+        async with self.lock:
+            if any(name not in current for name in self.names):
+                keep = [i for i, name in enumerate(self.names) if name in current]
+                self.names = [self.names[i] for i in keep]
+                self.matrix = self.matrix[keep]
+                await asyncio.to_thread(self.save)
+        await self.add(names)
+
+    async def add(self, names: list[str]):
+        async with self.lock:
+            known = set(self.names)
+            missing = list(dict.fromkeys(name for name in names if name not in known))
+            if not missing:
+                return
+            vectors = []
+            for i in range(0, len(missing), TAG_ENCODE_BATCH):
+                vectors.append(np.asarray(await encoder.encode(missing[i:i + TAG_ENCODE_BATCH]), dtype=np.float32))
+            vectors = np.vstack(vectors)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            self.matrix = vectors if not self.names else np.vstack([self.matrix, vectors])
+            self.names.extend(missing)
+            await asyncio.to_thread(self.save)
+
+    def classify(self, image_embed, k: int = TAG_TOP_K, min_score: float | None = TAG_MIN_SCORE) -> list[str]:
+        if not self.names:
+            return []
+        query = np.asarray(image_embed, dtype=np.float32)
+        scores = self.matrix @ (query / np.linalg.norm(query))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if min_score is not None:
+            top = top[scores[top] >= min_score]
+        return [self.names[i] for i in top]
+
+    async def refresh(self):
+        async with SessionLocal() as db:
+            try:
+                await self.sync(db)
+            except Exception as e:
+                print(f"Failed to sync tag embeddings: {str(e)}")
+
+    def __len__(self):
+        return len(self.names)
+
+tag_store = TagEmbeddingStore(TAG_EMBEDDINGS_PATH)
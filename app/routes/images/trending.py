@@ -0,0 +1,175 @@
+import time
+
+from ...common import *
+from ...database import SessionLocal
+from ...ranking import Trending, ALL
+from .crud import get_media_groups, get_media_scores, add_media_scores, delete_media_scores, get_existing_mids
+
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", 24 * 60 * 60))
+TRENDING_CAPACITY = int(os.getenv("TRENDING_CAPACITY", 500))
+TRENDING_SNAPSHOT_INTERVAL = float(os.getenv("TRENDING_SNAPSHOT_INTERVAL", 5 * 60))
+TRENDING_REFRESH_INTERVAL = float(os.getenv("TRENDING_REFRESH_INTERVAL", 60 * 60))
+TRENDING_WEIGHTS = {
+    "view": float(os.getenv("TRENDING_VIEW_WEIGHT", 1)),
+    "like": float(os.getenv("TRENDING_LIKE_WEIGHT", 4)),
+    "dislike": float(os.getenv("TRENDING_DISLIKE_WEIGHT", -2)),
+}
+TRENDING_CHUNK = 5000
+
+class TrendingRanker:
+    ''' Keeps the Trending scores of media current from the event stream.
+
+    EventBuffer hands over every batch it has committed, so scores move with each view
+    and preference without rescanning activity. The tags and collections of a media item
+    are looked up once, on its first event, and refreshed every `refresh_interval` along
+    with a rebase that drops faded items.
+
+    `media_scores` holds the scores of all processes. Every `snapshot_interval` seconds,
+    and on shutdown, each process adds the weight it recorded since its last snapshot to
+    the stored scores, then merges back the rows anyone wrote since its previous sync, so
+    workers never overwrite each other and all rank on the same totals. '''
+
+    def __init__(self, half_life: float, capacity: int, weights: dict, snapshot_interval: float, refresh_interval: float):
+        self.engine = Trending(half_life, capacity, time.time())
+        self.weights = weights
+        self.snapshot_interval = snapshot_interval
+        self.refresh_interval = refresh_interval
+        self.wake = asyncio.Event()
+        self.task = None
+        self.running = False
+        self.last_refresh = time.time()
+        self.synced_at = None
+        self.last_error = None
+
+    async def load(self, db: AsyncSession):
+        self.synced_at = datetime.datetime.now(datetime.timezone.utc)
+        rows = [row async for row in await get_media_scores(db)]
+        groups = await self.groups(db, [row.mid for row in rows])
+        for row in rows:
+            self.engine.load(row.mid, row.score, row.scored_at.timestamp(), groups.get(row.mid, ()))
+        self.engine.rebuild()
+        print(f"Loaded {len(rows)} trending scores")
+
+    async def groups(self, db: AsyncSession, mids: list) -> dict:
+        groups = {}
+        for i in range(0, len(mids), TRENDING_CHUNK):
+            groups.update(await get_media_groups(db, mids[i:i + TRENDING_CHUNK]))
+        return groups
+
+    async def record(self, db: AsyncSession, views: dict, preferences: dict, previous: dict):
+        ''' Adds a committed EventBuffer batch: views as {(uid, mid): viewed_at}, preferences as
+        {(uid, mid): attr} and `previous` as the preferences they replaced '''
+        await self.add_groups(db, {mid for _, mid in [*views, *preferences]})
+        for (_, mid), viewed_at in views.items():
+            self.engine.add(mid, self.weights["view"], viewed_at.timestamp())
+        now = time.time()
+        for key, attr in preferences.items():
+            old = previous.get(key)
+            if old != attr:
+                # A changed preference swaps its weight rather than counting twice
+                self.engine.add(key[1], self.weights[attr] - (self.weights[old] if old else 0.0), now)
+
+    async def add_groups(self, db: AsyncSession, mids: set):
+        # The groups of media seen for the first time
+        unknown = list(mids - self.engine.groups.keys())
+        if unknown:
+            for mid, groups in (await self.groups(db, unknown)).items():
+                self.engine.set_groups(mid, groups)
+
+    def top(self, limit: int, offset: int = 0, tid: int = None, cid: int = None) -> list[tuple[str, float]]:
+        group = f"tag:{tid}" if tid is not None else f"collection:{cid}" if cid is not None else ALL
+        return self.engine.top(limit, time.time(), group, offset)
+
+    async def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self.run(), name="Trending Snapshots")
+
+    async def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.task:
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        try:
+            async with SessionLocal() as db:
+                await self.snapshot(db)
+        except Exception as e:
+            print(f"Failed to snapshot trending scores: {str(e)}")
+
+    async def run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.snapshot_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self.running:
+                return
+            async with SessionLocal() as db:
+                try:
+                    if time.time() - self.last_refresh >= self.refresh_interval:
+                        await self.refresh(db)
+                    await self.snapshot(db)
+                except Exception as e:
+                    await db.rollback()
+                    self.last_error = str(e)
+                    print(f"Trending snapshot failed: {str(e)}")
+
+    async def snapshot(self, db: AsyncSession):
+        now = time.time()
+        # Sorted, so concurrent snapshots lock shared rows in the same order
+        rows = sorted(self.engine.snapshot(now))
+        scored_at = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+        try:
+            try:
+                await self.write(db, rows, scored_at)
+            except IntegrityError:
+                # Media deleted since its last event; forget it and write the rest
+                await db.rollback()
+                existing = await get_existing_mids(db, [mid for mid, _ in rows])
+                for mid, _ in rows:
+                    if mid not in existing:
+                        self.engine.remove(mid)
+                rows = [(mid, score) for mid, score in rows if mid in existing]
+                await self.write(db, rows, scored_at)
+        except Exception:
+            # Added with the next snapshot
+            self.engine.restore(rows, now)
+            raise
+        await self.sync(db, scored_at)
+
+    async def write(self, db: AsyncSession, rows: list, scored_at: datetime.datetime):
+        for i in range(0, len(rows), TRENDING_CHUNK):
+            await add_media_scores(db, [
+                {"mid": mid, "score": score, "scored_at": scored_at} for mid, score in rows[i:i + TRENDING_CHUNK]
+            ], self.engine.half_life)
+        await db.commit()
+
+    async def sync(self, db: AsyncSession, now: datetime.datetime):
+        ''' Merges the shared scores written since the previous sync, by this process or others.
+        The window reaches one interval further back to cover commits that landed late and
+        clock skew between hosts; merging a row twice is harmless. '''
+        since = self.synced_at - datetime.timedelta(seconds=self.snapshot_interval)
+        rows = [row async for row in await get_media_scores(db, since)]
+        await self.add_groups(db, {row.mid for row in rows})
+        for row in rows:
+            self.engine.merge(row.mid, row.score, row.scored_at.timestamp())
+        self.synced_at = now
+
+    async def refresh(self, db: AsyncSession):
+        ''' Picks up tag and collection changes, then rebases and drops faded items '''
+        mids = list(self.engine.scores)
+        for i in range(0, len(mids), TRENDING_CHUNK):
+            for mid, groups in (await get_media_groups(db, mids[i:i + TRENDING_CHUNK])).items():
+                self.engine.set_groups(mid, groups)
+        now = time.time()
+        dropped = self.engine.rebase(now)
+        at = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+        for i in range(0, len(dropped), TRENDING_CHUNK):
+            await delete_media_scores(db, dropped[i:i + TRENDING_CHUNK], at, self.engine.half_life, self.engine.floor)
+        await db.commit()
+        self.last_refresh = time.time()
+
+    def stats(self) -> dict:
+        return {**self.engine.stats(), "last_error": self.last_error}
+
+trending = TrendingRanker(TRENDING_HALF_LIFE, TRENDING_CAPACITY, TRENDING_WEIGHTS, TRENDING_SNAPSHOT_INTERVAL, TRENDING_REFRESH_INTERVAL)
@@ -1,5 +1,7 @@
 from ...common import *
-from .crud import add_media
+from ...imaging import process_image
+from .crud import add_media, add_media_batch, get_duplicate_hashes, classify_image
+from .outbox import vector_outbox
 
 
 async def generate_url(format: str):
@@ -7,29 +9,154 @@ async def generate_url(format: str):
         return f"gifs/{uuid4().time}.{format}"
     return f"images/{uuid4().time}.{format}"
     
-async def hash_image(image: Image):
-    if image.format == 'GIF':
-        frames = list(ImageSequence.Iterator(image))
-        if len(frames) > 1:
-            first_frame_hash = await asyncio.to_thread(phash, frames[0].convert("RGB"))
-            last_frame_hash = await asyncio.to_thread(phash, frames[-1].convert("RGB"))
-            combined_hash = f"{first_frame_hash}{last_frame_hash}"
-        else:
-            frame_hash = await asyncio.to_thread(phash, frames[0].convert("RGB"))
-            combined_hash = f"{frame_hash}{frame_hash}"
-        return str(combined_hash)
-    else:
-        image_hash = await asyncio.to_thread(phash, image)
-        return str(image_hash)
-    
 async def save_image(contents: bytes, path: str = None):
     async with aiofile.async_open(path, "wb") as outfile:
             await outfile.write(contents)
 
-async def analyse_image(contents: bytes):
+async def get_image_area(url: str) -> int:
+    def area():
+        # Only the header is read to get the size
+        with Image.open(os.path.join(STORAGE_DIR, url)) as image:
+            return image.width * image.height
+    return await asyncio.to_thread(area)
+
+async def media_area(media) -> int:
+    if media.width and media.height:
+        return media.width * media.height
+    return await get_image_area(media.url)
+
+async def analyse_image(path: str):
     return 0.5, "#FFFFFF"
 
-async def sync_dir( db: Session, dir: str):
+async def prepare_image(upload: SpooledUpload):
+    meta = await process_image(upload.path)
+    url = await generate_url(meta["format"].lower())
+    return meta, url, meta["hash"]
+
+async def upload_batch(db: AsyncSession, uid: str, items: list[dict]) -> list[dict]:
+    ''' Ingests many uploads with one CLIP call for the images, one for the texts and one
+    transaction, vectors included.
+    Every item gets its own status; a failing item never fails the rest of the batch. '''
+    results = [{"index": i, "filename": item["filename"]} for i, item in enumerate(items)]
+
+    def fail(i, detail):
+        results[i].update({"status": "failed", "detail": str(detail)})
+
+    # Decode and hash every image concurrently
+    prepared = await asyncio.gather(
+        *(prepare_image(item["upload"]) for item in items),
+        return_exceptions=True
+    )
+    pending, seen = [], set()
+    for i, prep in enumerate(prepared):
+        if isinstance(prep, Exception):
+            fail(i, prep)
+            continue
+        meta, url, hash = prep
+        if hash in seen:
+            fail(i, "Duplicate Image")
+            continue
+        seen.add(hash)
+        items[i].update({"meta": meta, "url": url, "hash": hash})
+        pending.append(i)
+
+    duplicates = await get_duplicate_hashes(db, [items[i]["hash"] for i in pending])
+    for i in [i for i in pending if items[i]["hash"] in duplicates]:
+        fail(i, "Duplicate Image")
+    pending = [i for i in pending if items[i]["hash"] not in duplicates]
+
+    # Only uploads missing from the embedding cache are downscaled and sent
+    img_embeds = await encoder.encode_images([(items[i]["upload"].path, items[i]["upload"].sha256) for i in pending])
+    for i, image_embed in zip(pending, img_embeds):
+        items[i]["image_embed"] = image_embed
+
+    untagged = [i for i in pending if not items[i]["tags"]]
+    classified = await asyncio.gather(
+        *(classify_image(db, items[i]["image_embed"]) for i in untagged),
+        return_exceptions=True
+    )
+    for i, tags in zip(untagged, classified):
+        if isinstance(tags, Exception):
+            fail(i, tags)
+        else:
+            items[i]["tags"] = tags
+    pending = [i for i in pending if "status" not in results[i]]
+    if not pending:
+        return results
+
+    # One CLIP round-trip for all texts of the batch
+    texts = [items[i]["title"] + (items[i]["desc"] or "") + ' '.join(items[i]["tags"]) for i in pending]
+    (text_embeds, analyses) = await asyncio.gather(
+        encoder.encode(texts),
+        asyncio.gather(*(analyse_image(items[i]["upload"].path) for i in pending))
+    )
+
+    records = []
+    for n, (i, (score, color)) in enumerate(zip(pending, analyses)):
+        item = items[i]
+        kwargs = {
+            "url": item["url"],
+            "title": item["title"],
+            "desc": item["desc"],
+            "hash": item["hash"],
+            "tags": item["tags"],
+            "collections": item["collections"],
+            "width": item["meta"]["width"],
+            "height": item["meta"]["height"],
+            "score": score,
+            "color": color,
+            "image_embed": item["image_embed"],
+            "text_embed": text_embeds[n],
+        }
+        if item["is_nsfw"]:
+            kwargs["isNSFW"] = item["is_nsfw"]
+        if item["meta"]["format"] == "GIF":
+            kwargs["span"] = item["meta"]["duration"] * 1000
+        if item["src"]:
+            kwargs["src"] = item["src"]
+        records.append(kwargs)
+
+    # Move files into place first so a committed row never points at a missing file
+    saved = await asyncio.gather(
+        *(items[i]["upload"].move_to(os.path.join(STORAGE_DIR, items[i]["url"])) for i in pending),
+        return_exceptions=True
+    )
+
+    def discard(indices):
+        for i in indices:
+            path = items[i]["upload"].path
+            if items[i]["upload"].moved and os.path.exists(path):
+                os.remove(path)
+
+    stored = []
+    for n, (i, result) in enumerate(zip(pending, saved)):
+        if isinstance(result, Exception):
+            fail(i, result)
+        else:
+            stored.append(n)
+
+    try:
+        mids = await add_media_batch(db, uid, [records[n] for n in stored])
+    except Exception as e:
+        discard([pending[n] for n in stored])
+        for n in stored:
+            fail(pending[n], e)
+        return results
+
+    inserted = 0
+    for n, mid in zip(stored, mids):
+        i = pending[n]
+        if isinstance(mid, Exception):
+            discard([i])
+            fail(i, mid)
+            continue
+        results[i].update({"status": "success", "media_id": mid})
+        inserted += 1
+    # The vectors were queued with the rows; wake the flusher for the whole batch at once
+    vector_outbox.notify(inserted)
+    return results
+
+async def sync_dir( db: AsyncSession, dir: str):
     data = json.loads(open('dir/data.json').read())
     for root, _, files in os.walk(dir):
         for file in files:
@@ -37,10 +164,10 @@ async def sync_dir( db: Session, dir: str):
             if path.endswith(('.jpg', '.jpeg', '.png', '.gif')):
                 with open(path, "rb") as f:
                     contents = f.read()
-                    fp = Image.open(BytesIO(contents))
-                    url = await generate_url(fp.format.lower())
-                    hash = await hash_image(fp)
-                    tags = await analyse_image(contents)
+                    meta = await process_image(path)
+                    url = await generate_url(meta["format"].lower())
+                    hash = meta["hash"]
+                    tags = await analyse_image(path)
                     kwargs = {
                         "url": url,
                         "title": data['title'],
@@ -51,8 +178,8 @@ async def sync_dir( db: Session, dir: str):
                     }
                     if await detect_nsfw(contents):
                         kwargs["isNSFW"] = True
-                    if fp.format == "GIF":
-                        kwargs["span"] = fp.info.get("duration") * 1000
+                    if meta["format"] == "GIF":
+                        kwargs["span"] = meta["duration"] * 1000
                     await add_media(db, 1, **kwargs)
                     path = os.path.join(STORAGE_DIR, url)
                     await save_image(contents, path)
@@ -0,0 +1,52 @@
+from ...common import *
+from ..images.models import Media, Collections, CollectionMedia
+from ..users.models import Users
+
+def prefix_pattern(query: str) -> str:
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+async def match_media(db: AsyncSession, query: str, limit: int, uid: str = None, nsfw: bool = False) -> list[dict]:
+    ''' Media visible to `uid` whose title or description matches `query`, as hits by
+    descending ts_rank_cd; titles weigh more than descriptions '''
+    tsquery = func.websearch_to_tsquery('english', query)
+    rank = func.ts_rank_cd(Media.search_vector, tsquery).label('rank')
+    public = select(CollectionMedia.mid).join(Collections, Collections.cid == CollectionMedia.cid).where(
+        CollectionMedia.mid == Media.mid, Collections.scope == 'public'
+    ).exists()
+    stmt = select(Media.mid, rank).where(
+        Media.search_vector.op('@@')(tsquery), or_(public, Media.uid == uid) if uid else public
+    )
+    if not nsfw:
+        stmt = stmt.where(Media.isNSFW.isnot(True))
+    rows = await db.execute(stmt.order_by(rank.desc(), Media.mid).limit(limit))
+    return [{"id": row.mid, "distance": float(row.rank)} for row in rows]
+
+async def match_users(db: AsyncSession, query: str, limit: int, offset: int = 0) -> list[dict]:
+    ''' Usernames starting with `query` first, then the closest by trigram similarity '''
+    prefix = Users.username.ilike(prefix_pattern(query))
+    score = func.similarity(Users.username, query).label('score')
+    rows = await db.execute(
+        select(Users.uid, Users.username, Users.avatar, score)
+        .where(or_(prefix, Users.username.op('%')(query)))
+        .order_by(prefix.desc(), score.desc(), Users.uid)
+        .offset(offset).limit(limit)
+    )
+    return [dict(row._mapping) for row in rows]
+
+async def match_collections(db: AsyncSession, query: str, limit: int, offset: int = 0, uid: str = None) -> list[dict]:
+    ''' Collections visible to `uid` matching `query` by full text or a near name, best first '''
+    tsquery = func.websearch_to_tsquery('english', query)
+    score = func.greatest(
+        func.ts_rank_cd(Collections.search_vector, tsquery), func.similarity(Collections.name, query)
+    ).label('score')
+    visible = Collections.scope == 'public'
+    if uid:
+        visible = or_(visible, Collections.uid == uid)
+    rows = await db.execute(
+        select(Collections.cid, Collections.name, Collections.desc, Collections.uid, Collections.created_at, score)
+        .where(visible, or_(Collections.search_vector.op('@@')(tsquery), Collections.name.op('%')(query)))
+        .order_by(score.desc(), Collections.cid)
+        .offset(offset).limit(limit)
+    )
+    return [dict(row._mapping) for row in rows]
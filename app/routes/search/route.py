@@ -0,0 +1,89 @@
+from ...common import *
+from ..users.utils import get_db
+from ..images.crud import get_media_cards_by_mids
+from .crud import match_media, match_users, match_collections
+
+router = APIRouter(prefix='/api', tags=['Search'])
+
+SEARCH_TYPES = ("media", "users", "collections")
+SEARCH_DEPTH = int(os.getenv("SEARCH_DEPTH", 4))
+SEARCH_RRF_K = int(os.getenv("SEARCH_RRF_K", 60))
+SEARCH_CLIP_WEIGHT = float(os.getenv("SEARCH_CLIP_WEIGHT", 1.0))
+SEARCH_FULLTEXT_WEIGHT = float(os.getenv("SEARCH_FULLTEXT_WEIGHT", 1.0))
+# Milvus caps topk at 16384; media pages end there
+SEARCH_MAX_DEPTH = 16384
+
+async def clip_hits(query: str, limit: int, search_filter: SearchFilter) -> list[dict]:
+    query_embed = await encoder.encode([query])
+    return await milvus_client.search(text_embed=query_embed[0], limit=limit, filter=search_filter)
+
+async def search_media(db: AsyncSession, query: str, limit: int, offset: int, uid: str, nsfw: bool, semantic: bool) -> dict:
+    ''' Full-text matches, fused by reciprocal rank with CLIP matches when `semantic` is set.
+    Each side returns SEARCH_DEPTH times the page, up to SEARCH_MAX_DEPTH, so items found by
+    only one still rank. If the vector store fails, the full-text matches are served alone. '''
+    window = min(SEARCH_DEPTH * (offset + limit + 1), SEARCH_MAX_DEPTH)
+    if semantic:
+        # Only the full-text side uses the session, so both run at once
+        text_hits, vector_hits = await asyncio.gather(
+            match_media(db, query, window, uid, nsfw),
+            clip_hits(query, window, SearchFilter(uid=uid, nsfw=nsfw)),
+            return_exceptions=True,
+        )
+        if isinstance(text_hits, Exception):
+            raise text_hits
+        if isinstance(vector_hits, Exception):
+            print(f"Semantic search failed, serving full-text matches only: {str(vector_hits)}")
+            hits = text_hits
+        else:
+            hits = fuse([vector_hits, text_hits], (SEARCH_CLIP_WEIGHT, SEARCH_FULLTEXT_WEIGHT), "rrf", SEARCH_RRF_K)
+    else:
+        hits = await match_media(db, query, window, uid, nsfw)
+    ranked = hits[offset:offset + limit]
+    cards = await get_media_cards_by_mids(db, [hit["id"] for hit in ranked], uid, nsfw)
+    more = len(hits) > offset + limit and offset + 2 * limit < SEARCH_MAX_DEPTH
+    return {
+        "items": [{**cards[hit["id"]], "score": hit["distance"]} for hit in ranked if hit["id"] in cards],
+        "next_offset": offset + limit if more else None,
+    }
+
+def section(rows: list, limit: int, offset: int) -> dict:
+    # One extra row was fetched to tell whether another page follows
+    return {"items": rows[:limit], "next_offset": offset + limit if len(rows) > limit else None}
+
+@router.get("/search/all")
+async def search_all(
+    q: str,
+    types: str = None,
+    limit: int = 20,
+    offset: int = 0,
+    semantic: bool = True,
+    nsfw: bool = False,
+    uid: str = Depends(get_uid),
+    db: AsyncSession = Depends(get_db)
+):
+    ''' Media, people and collections matching `q`, each ranked and paged on its own.
+    types: comma-separated subset of media, users and collections; all by default.
+    Media is ranked by Postgres full text, fused with CLIP similarity when semantic is set;
+    usernames and collection names also match with typos through trigram similarity. '''
+    query = q.strip()
+    wanted = [name.strip() for name in types.split(',')] if types else list(SEARCH_TYPES)
+    if not query:
+        raise HTTPException(status_code=400, detail="Empty query")
+    if any(name not in SEARCH_TYPES for name in wanted):
+        raise HTTPException(status_code=400, detail="Invalid search type")
+    limit = page_size(limit)
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid offset")
+    if "media" in wanted and offset + limit >= SEARCH_MAX_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Media results end at {SEARCH_MAX_DEPTH}; narrow the query")
+    try:
+        results = {}
+        if "media" in wanted:
+            results["media"] = await search_media(db, query, limit, offset, uid, nsfw, semantic)
+        if "users" in wanted:
+            results["users"] = section(await match_users(db, query, limit + 1, offset), limit, offset)
+        if "collections" in wanted:
+            results["collections"] = section(await match_collections(db, query, limit + 1, offset, uid), limit, offset)
+        return results
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,7 +1,13 @@
 from ...common import *
+from ...database import SessionLocal
 from .models import Users, UserFollows
+from ..images.feed import timelines
 
-async def create_dbuser(db: Session, username, password, about, avatar, favourite_tags) -> None:
+FOLLOW_RECONCILE_HOUR = int(os.getenv("FOLLOW_RECONCILE_HOUR", 3))  # local time
+# Transaction-level advisory lock key, so one worker reconciles when several wake together
+FOLLOW_RECONCILE_LOCK = 0x666f6c6c
+
+async def create_dbuser(db: AsyncSession, username, password, about, avatar, favourite_tags) -> None:
     db_user = Users(
         username=username, 
         password=password, 
@@ -10,26 +16,116 @@ async def create_dbuser(db: Session, username, password, about, avatar, favourit
         favourite_tags=favourite_tags
     )
     db.add(db_user)
-    db.commit()
+    await db.commit()
+
+async def get_user_cards(db: AsyncSession, limit: int, cursor: str = None) -> dict:
+    limit = page_size(limit)
+    query = select(Users.uid, Users.username, Users.avatar, Users.created_at)
+    rows = (await db.execute(keyset(query, Users.created_at, Users.uid, cursor, limit))).all()
+    return page(rows, limit, 'created_at', 'uid')
 
-async def get_all_users(db: Session) -> List[Users]:
-    return db.query(Users).all()
+async def get_user_by_id(db: AsyncSession, uid: str) -> Users:
+    return await db.scalar(select(Users).where(Users.uid == uid))
 
-async def get_user_by_id(db: Session, uid: str) -> Users:
-    return db.query(Users).filter(Users.uid == uid).first()
+async def get_user_by_name(db: AsyncSession, username: str) -> Users:
+    return await db.scalar(select(Users).where(Users.username == username))
 
-async def get_user_by_name(db: Session, username: str) -> Users:
-    return db.query(Users).filter(Users.username == username).first()
+async def bump_follow_counts(db: AsyncSession, uid: str, fid: str, step: int) -> None:
+    # Rows are locked in uid order, so two users following each other at once can't deadlock
+    for key in sorted((uid, fid)):
+        column = Users.following_count if key == uid else Users.follower_count
+        await db.execute(update(Users).where(Users.uid == key).values({column: column + step}))
 
-async def add_follow(db: Session, uid: str, fid: str) -> None:
-    db_follow = UserFollows(uid=uid, fid=fid)
-    db.add(db_follow)
-    db.commit()
+async def add_follow(db: AsyncSession, uid: str, fid: str) -> None:
+    if uid == fid:
+        raise ValueError("Cannot follow yourself")
+    # The counters move in the same transaction as the row, and only if the row is new
+    added = await db.scalar(
+        pg_insert(UserFollows).values(uid=uid, fid=fid)
+        .on_conflict_do_nothing()
+        .returning(UserFollows.fid)
+    )
+    if added is not None:
+        await bump_follow_counts(db, uid, fid, 1)
+        await timelines.follow(db, uid, fid)
+    await db.commit()
 
-async def get_follows_for_uid(db: Session, uid: str) -> Dict[str, List[str]]:
-    user = await get_user_by_id(db, uid)
-    if user is None:
+async def remove_follow(db: AsyncSession, uid: str, fid: str) -> None:
+    removed = await db.scalar(
+        delete(UserFollows)
+        .where(UserFollows.uid == uid, UserFollows.fid == fid)
+        .returning(UserFollows.fid)
+    )
+    if removed is not None:
+        await bump_follow_counts(db, uid, fid, -1)
+        await timelines.unfollow(db, uid, fid)
+    await db.commit()
+
+async def get_follow_counts(db: AsyncSession, uid: str) -> Dict[str, int]:
+    row = (await db.execute(
+        select(Users.follower_count, Users.following_count).where(Users.uid == uid)
+    )).first()
+    if row is None:
         raise Exception("User not found")
-    followers = [follower.uid for follower in user.followers]
-    following = [followed.fid for followed in user.following]
-    return {"followers": followers, "following": following}
\ No newline at end of file
+    return {"followers": row.follower_count, "following": row.following_count}
+
+async def get_followers(db: AsyncSession, uid: str, limit: int, cursor: str = None) -> dict:
+    ''' Users following `uid`, most recent first '''
+    limit = page_size(limit)
+    query = (
+        select(Users.uid, Users.username, Users.avatar, UserFollows.created_at)
+        .join(Users, Users.uid == UserFollows.uid)
+        .where(UserFollows.fid == uid)
+    )
+    rows = (await db.execute(keyset(query, UserFollows.created_at, UserFollows.uid, cursor, limit))).all()
+    return page(rows, limit, 'created_at', 'uid')
+
+async def get_following(db: AsyncSession, uid: str, limit: int, cursor: str = None) -> dict:
+    ''' Users `uid` follows, most recently followed first '''
+    limit = page_size(limit)
+    query = (
+        select(Users.uid, Users.username, Users.avatar, UserFollows.created_at)
+        .join(Users, Users.uid == UserFollows.fid)
+        .where(UserFollows.uid == uid)
+    )
+    rows = (await db.execute(keyset(query, UserFollows.created_at, UserFollows.fid, cursor, limit))).all()
+    return page(rows, limit, 'created_at', 'uid')
+
+async def reconcile_follow_counts(db: AsyncSession) -> int | None:
+    ''' Recounts both counters from user_follows and fixes the users that drifted, e.g.
+    through a follower deleted by cascade. Returns the number of users corrected, or None
+    when another worker is already reconciling. '''
+    if not await db.scalar(select(func.pg_try_advisory_xact_lock(FOLLOW_RECONCILE_LOCK))):
+        await db.rollback()
+        return None
+    followers = select(func.count()).where(UserFollows.fid == Users.uid).scalar_subquery()
+    following = select(func.count()).where(UserFollows.uid == Users.uid).scalar_subquery()
+    result = await db.execute(
+        update(Users)
+        .where(or_(Users.follower_count != followers, Users.following_count != following))
+        .values(follower_count=followers, following_count=following)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+def seconds_until(hour: int) -> float:
+    now = datetime.datetime.now()
+    at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if at <= now:
+        at += datetime.timedelta(days=1)
+    return (at - now).total_seconds()
+
+async def update_follow_counts(hour: int = FOLLOW_RECONCILE_HOUR) -> None:
+    ''' Nightly at `hour`, not at startup: every worker wakes at the same wall-clock time
+    and the advisory lock lets one of them through '''
+    while True:
+        await asyncio.sleep(seconds_until(hour))
+        async with SessionLocal() as db:
+            try:
+                fixed = await reconcile_follow_counts(db)
+                if fixed:
+                    print(f"Reconciled follow counts of {fixed} users")
+            except Exception as e:
+                await db.rollback()
+                print(f"Follow count reconciliation failed: {str(e)}")
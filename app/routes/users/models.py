@@ -10,6 +10,9 @@ class Users(Base):
     avatar = Column(String(255))
     favourite_tags = Column(ARRAY(String), default=[])
     is_private = Column(Boolean, default=False)
+    # Kept in step by add_follow/remove_follow and reconciled nightly
+    follower_count = Column(Integer, nullable=False, default=0, server_default='0')
+    following_count = Column(Integer, nullable=False, default=0, server_default='0')
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Bidirectional relationships for followers and following
@@ -29,6 +32,12 @@ class Users(Base):
     owned_collections = relationship("Collections", back_populates="owner")
     collections = relationship("Collections", secondary="collection_access_list", back_populates="access_list")
 
+    __table_args__ = (
+        Index('idx_users_created', 'created_at', 'uid'),
+        # Typo-tolerant username search
+        Index('idx_users_username_trgm', 'username', postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}),
+    )
+
     def __init__(self, **kwargs):
         super(Users, self).__init__(**kwargs)
         self.uid = uuid4().hex[:20]  # Generating a 16-char hex UUID
@@ -46,5 +55,8 @@ class UserFollows(Base):
 
     __table_args__ = (
         Index('idx_following_user', 'uid', 'fid'),  # Composite index for fast follower lookups
+        # Keyset pagination of follower and following lists
+        Index('idx_follows_fid_created', 'fid', 'created_at', 'uid'),
+        Index('idx_follows_uid_created', 'uid', 'created_at', 'fid'),
     )
     
\ No newline at end of file
@@ -1,12 +1,12 @@
 from ...common import *
 from . import schemas
-from .crud import create_dbuser, get_user_by_id, get_all_users, get_user_by_name, add_follow, get_follows_for_uid
+from .crud import create_dbuser, get_user_by_id, get_user_cards, get_user_by_name, add_follow, remove_follow, get_follow_counts, get_followers, get_following
 from .utils import encrypt_password, verify_password, generate_names, save_avatar, get_token, get_db, validate_name
 
 router = APIRouter(prefix='/api', tags=['Users'])
 
 @router.get("/check_available", response_model=dict)
-async def check_username(username: str, db: Session = Depends(get_db)):
+async def check_username(username: str, db: AsyncSession = Depends(get_db)):
     try:
         if not await validate_name(username):
             return {"available": False}
@@ -23,16 +23,17 @@ async def generate_username():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/users", response_model=List[schemas.User])
-async def get_users(db: Session = Depends(get_db)):
+@router.get("/users", response_model=schemas.UserPage)
+async def get_users(limit: int = 50, cursor: str = None, db: AsyncSession = Depends(get_db)):
     try:
-        users = await get_all_users(db)
-        return users
+        return await get_user_cards(db, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/users", status_code=201)
-async def create_user(db: Session = Depends(get_db),
+async def create_user(db: AsyncSession = Depends(get_db),
     username: str = Form(...), 
     password: str = Form(...),
     about: str = Form(...),
@@ -51,7 +52,7 @@ async def create_user(db: Session = Depends(get_db),
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.get("/users/{username}", response_model=schemas.User)
-async def get_user(username: str, db: Session = Depends(get_db)):
+async def get_user(username: str, db: AsyncSession = Depends(get_db)):
     try:
         user = await get_user_by_name(db, username)
         if not user:
@@ -62,7 +63,7 @@ async def get_user(username: str, db: Session = Depends(get_db)):
 
 
 @router.get("/session", response_model=schemas.User)
-async def get_session(uid: str = Depends(validate_user), db: Session = Depends(get_db)):
+async def get_session(uid: str = Depends(validate_user), db: AsyncSession = Depends(get_db)):
     try:
         print(uid)
         user = await get_user_by_id(db, uid)
@@ -74,7 +75,7 @@ async def get_session(uid: str = Depends(validate_user), db: Session = Depends(g
 
 @router.post("/auth", response_model=schemas.token)
 async def auth_user(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     username: str = Form(...),
     password: str = Form(...)
 ):
@@ -97,23 +98,58 @@ async def auth_user(
 async def follow_user(
     fid: str = Form(...),
     uid: str = Depends(validate_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     try:
         await add_follow(db, uid, fid)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+@router.delete("/follows", status_code=204)
+async def unfollow_user(
+    fid: str = Form(...),
+    uid: str = Depends(validate_user),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        await remove_follow(db, uid, fid)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/follows", response_model=schemas.Follows)
-async def get_follows(count:bool = False, uid: str = Form(...),  db: Session = Depends(get_db)):
+async def get_follows(
+    uid: Optional[str] = None,
+    count: bool = True,
+    form_uid: Optional[str] = Form(None, alias="uid"),
+    db: AsyncSession = Depends(get_db),
+):
+    ''' Follower and following counts; the lists themselves are paged below.
+    uid used to be a form field and is still accepted as one; `count` is accepted and
+    ignored, the response is always the counts '''
+    uid = uid or form_uid
+    if not uid:
+        raise HTTPException(status_code=422, detail="uid is required")
+    try:
+        return await get_follow_counts(db, uid)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/follows/{uid}/followers", response_model=schemas.UserPage)
+async def list_followers(uid: str, limit: int = 50, cursor: str = None, db: AsyncSession = Depends(get_db)):
+    try:
+        return await get_followers(db, uid, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/follows/{uid}/following", response_model=schemas.UserPage)
+async def list_following(uid: str, limit: int = 50, cursor: str = None, db: AsyncSession = Depends(get_db)):
     try:
-        result = await get_follows_for_uid(db, uid)
-        print(count)
-        if count:
-            new_result = {}
-            for key, value in result.items():
-                new_result[key] = len(value)
-            return new_result
-        return result
+        return await get_following(db, uid, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
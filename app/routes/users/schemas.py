@@ -10,10 +10,19 @@ class User(BaseModel):
     class Config:
         form_attributes = True
 
+class UserCard(BaseModel):
+    uid: str
+    username: str
+    avatar: Optional[str] = None
+
+class UserPage(BaseModel):
+    items: List[UserCard]
+    next_cursor: Optional[str] = None
+
 class token(BaseModel):
     token: str
     token_type: str
 
 class Follows(BaseModel):
-    followers: Union[int, List[str]]
-    following: Union[int, List[str]]
\ No newline at end of file
+    followers: int
+    following: int
\ No newline at end of file
@@ -20,12 +20,14 @@ async def generate_names(limit: int = 5) -> List[str]:
     return arr
 
 async def save_avatar(uploadImage: UploadFile) -> str:
-    image = await uploadImage.read()
-    format = Image.open(BytesIO(image)).format.lower()
-    path = f"{STORAGE_DIR}/avatar/{uuid4().hex}.{format}"
-
-    async with aiofile.async_open(path, "wb") as f:
-        await f.write(image)
+    upload = await spool_upload(uploadImage)
+    try:
+        with upload.open_image() as image:
+            format = image.format.lower()
+        path = f"{STORAGE_DIR}/avatar/{uuid4().hex}.{format}"
+        await upload.move_to(path)
+    finally:
+        upload.discard()
     return path
 
 async def validate_name(name: str) -> bool:
@@ -0,0 +1,74 @@
+import os
+import asyncio
+import hashlib
+from uuid import uuid4
+from dataclasses import dataclass
+
+import aiofile
+from PIL import Image
+from fastapi import UploadFile, HTTPException
+
+from .imaging import image_engine, thumbnail_data_uri
+
+STORAGE_DIR = os.getenv("STORAGE_DIR")
+TMP_DIR = os.path.join(STORAGE_DIR, "tmp")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1 << 20))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 64 << 20))
+CLIP_INPUT_SIZE = int(os.getenv("CLIP_INPUT_SIZE", 448))
+
+@dataclass
+class SpooledUpload:
+    path: str
+    sha256: str
+    size: int
+    moved: bool = False
+
+    def open_image(self) -> Image.Image:
+        # Pillow reads lazily from the file, so only the header is parsed here
+        return Image.open(self.path)
+
+    async def move_to(self, dest: str):
+        # Same filesystem as STORAGE_DIR, so this is an atomic rename rather than a copy
+        await asyncio.to_thread(os.replace, self.path, dest)
+        self.path = dest
+        self.moved = True
+
+    def discard(self):
+        # No-op once the file has been moved into place
+        if not self.moved and os.path.exists(self.path):
+            os.remove(self.path)
+
+async def spool_upload(upload: UploadFile, directory: str = TMP_DIR, max_size: int = MAX_UPLOAD_SIZE) -> SpooledUpload:
+    ''' Copies an upload to disk chunk by chunk, hashing as it goes and rejecting it once it exceeds max_size. '''
+    if upload.size is not None and upload.size > max_size:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    path = os.path.join(directory, f"{uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofile.async_open(path, "wb") as outfile:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                await outfile.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return SpooledUpload(path=path, sha256=digest.hexdigest(), size=size)
+
+async def file_sha256(path: str) -> str:
+    def digest():
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+    return await asyncio.to_thread(digest)
+
+async def encode_image_file(path: str, size: int = CLIP_INPUT_SIZE) -> str:
+    ''' Returns a CLIP-ready data URI of a downscaled copy, never the full-size file. '''
+    return await image_engine.run(thumbnail_data_uri, path, size)
@@ -0,0 +1,516 @@
+import os
+import json
+import asyncio
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+FIELDS = ("image_embed", "text_embed")
+MAX_TAGS = 32
+
+@dataclass
+class SearchFilter:
+    ''' Scalar conditions applied inside the ANN query.
+
+    A row matches when it is public or owned by `uid`, is not NSFW unless `nsfw` is set,
+    and carries at least one of `tids` when given. Rows written before the scalars existed
+    carry none of them and never match a filter. '''
+    uid: str | None = None
+    nsfw: bool = False
+    tids: list[int] | None = None
+
+    def expression(self) -> str:
+        # Milvus boolean expression
+        terms = [f'(is_public == true or uid == {json.dumps(self.uid)})' if self.uid else 'is_public == true']
+        if not self.nsfw:
+            terms.append('is_nsfw == false')
+        if self.tids:
+            terms.append(f'array_contains_any(tids, {json.dumps([int(tid) for tid in self.tids])})')
+        return ' and '.join(terms)
+
+    def matches(self, row: dict) -> bool:
+        # The same conditions checked in Python against one row's scalars
+        if not (row.get("is_public") or (self.uid and row.get("uid") == self.uid)):
+            return False
+        if not self.nsfw and row.get("is_nsfw", True):
+            return False
+        return not self.tids or bool(set(self.tids) & set(row.get("tids") or []))
+
+class VectorStore:
+    ''' Operations every vector backend provides. Scores are cosine similarities. '''
+
+    def setup_collection(self):
+        pass
+
+    async def insert_data(self, id: int, image_embed: list, text_embed: list):
+        await self.insert_batch([{
+            "id": id,
+            "image_embed": image_embed,
+            "text_embed": text_embed
+        }])
+
+    async def insert_batch(self, data: list[dict]):
+        raise NotImplementedError
+
+    async def upsert_batch(self, data: list[dict]):
+        # Safe to replay: writing the same id twice leaves a single row
+        await self.insert_batch(data)
+
+    async def search(self, image_embed: list=None, text_embed: list=None, limit: int = 128, offset: int = 0,
+                     filter: SearchFilter = None, exclude: list = None) -> list[dict]:
+        ''' Hits as {"id", "distance"} by descending similarity, skipping the first `offset` '''
+        raise NotImplementedError
+
+    async def hybrid_search(self, embedding: list, limit: int = 128, offset: int = 0, filter: SearchFilter = None,
+                            exclude: list = None, weights: tuple = (1.0, 1.0), method: str = "rrf",
+                            depth: int = 4, rrf_k: int = 60) -> list[dict]:
+        ''' Queries image_embed and text_embed with the same CLIP vector concurrently and fuses
+        the two rankings. Each side returns `depth` times the page so items ranked well on
+        only one side can still make it into the fused page. '''
+        window = depth * (offset + limit)
+        image_hits, text_hits = await asyncio.gather(
+            self.search(image_embed=embedding, limit=window, filter=filter, exclude=exclude),
+            self.search(text_embed=embedding, limit=window, filter=filter, exclude=exclude)
+        )
+        return fuse([image_hits, text_hits], weights, method, rrf_k)[offset:offset + limit]
+
+    async def get_embedding(self, id: int):
+        raise NotImplementedError
+
+    async def get_vectors(self, ids: list) -> dict:
+        ''' Stored rows by id, vectors plus any scalars; ids that are not stored are left out '''
+        raise NotImplementedError
+
+    async def delete(self, ids: list):
+        raise NotImplementedError
+
+    async def list_ids(self) -> set[str]:
+        raise NotImplementedError
+
+    async def list_stale_ids(self) -> set[str]:
+        ''' Ids stored without the scalar fields used by SearchFilter '''
+        raise NotImplementedError
+
+    def shadow(self, name: str, dimension: int) -> "VectorStore":
+        ''' A separate, empty store of the same kind to rebuild the catalog into '''
+        raise NotImplementedError
+
+    def promote(self, shadow: "VectorStore"):
+        ''' Makes `shadow` the store that reads and writes go to '''
+        raise NotImplementedError
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def fuse(rankings: list[list[dict]], weights, method: str = "rrf", rrf_k: int = 60) -> list[dict]:
+    ''' Merges ranked hit lists into one. "rrf" sums weight / (rrf_k + rank), which needs no
+    score calibration between lists; "weighted" sums weight * similarity. '''
+    scores = {}
+    for hits, weight in zip(rankings, weights):
+        for rank, hit in enumerate(hits):
+            score = weight / (rrf_k + rank + 1) if method == "rrf" else weight * hit["distance"]
+            scores[hit["id"]] = scores.get(hit["id"], 0.0) + score
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [{"id": id, "distance": score} for id, score in fused]
+
+class IVFIndex:
+    ''' Inverted file over spherical k-means centroids; inner product on unit vectors is cosine '''
+
+    def __init__(self, nlist: int):
+        self.nlist = nlist
+        self.centroids: np.ndarray | None = None
+        self.lists: list[np.ndarray] = []
+        self.pending: list[list[int]] = []
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def assign(self, vectors: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+            out[start:start + chunk] = np.argmax(block @ self.centroids.T, axis=1)
+        return out
+
+    def train(self, sample: np.ndarray, iterations: int = 10, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=self.nlist) == 0
+            # Re-seed empty clusters from random points so every list stays useful
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            centroids = normalize(sums)
+        self.centroids = centroids.astype(np.float32)
+
+    def build(self, assignments: np.ndarray, rows: np.ndarray):
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(self.nlist + 1))
+        self.lists = [rows[order[bounds[c]:bounds[c + 1]]] for c in range(self.nlist)]
+        self.pending = [[] for _ in range(self.nlist)]
+
+    def add(self, rows: np.ndarray, assignments: np.ndarray):
+        for row, c in zip(rows, assignments):
+            self.pending[c].append(int(row))
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        lists = top_k(self.centroids @ query, nprobe)
+        for c in lists:
+            if self.pending[c]:
+                self.lists[c] = np.concatenate([self.lists[c], np.asarray(self.pending[c], dtype=np.int64)])
+                self.pending[c] = []
+        return np.concatenate([self.lists[c] for c in lists]) if len(lists) else np.empty(0, dtype=np.int64)
+
+class LocalVectorStore(VectorStore):
+    ''' Embedded replacement for Milvus with the same operations.
+
+    Rows live in memory-mapped files under `directory`: ids.bin (fixed-width ids),
+    deleted.bin (tombstones), owner.bin, flags.bin and tids.bin (the SearchFilter
+    scalars) and one <field>.bin matrix per vector field, stored as unit vectors in
+    float16, float32 or int8. Each field gets an IVF index. It is trained
+    once there are enough rows and retrained when the collection doubles; until then
+    searches are exact. Inserts and deletes are applied in place, and manifest.json,
+    which records the row count, is replaced atomically only after the data files are
+    flushed. After a crash, rows past the recorded count are ignored. '''
+
+    ID_WIDTH = 64
+    HAS_ATTRS, PUBLIC, NSFW = 1, 2, 4  # flags.bin bits
+    INITIAL_CAPACITY = 4096
+    TRAIN_FACTOR = 39  # rows per list needed before k-means is worth it
+    SAMPLE_FACTOR = 256
+
+    def __init__(self, directory: str, dimension: int = 1024, dtype: str = "float16", nlist: int = 128, nprobe: int = 32,
+                 root: str = None):
+        self.directory = directory
+        # Shadow stores and the current.json pointer naming the live one live under root
+        self.root = root or directory
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        # int8 rows hold unit vectors scaled to [-127, 127]
+        self.scale = 127.0 if self.dtype.kind == "i" else 1.0
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.lock = threading.RLock()
+        self.count = 0
+        self.capacity = 0
+        self.trained_count = 0
+        self.rows: dict[str, int] = {}
+        self.indexes = {field: IVFIndex(nlist) for field in FIELDS}
+        self.ids = self.deleted = None
+        self.owners = self.flags = self.tids = None
+        self.vectors: dict[str, np.memmap] = {}
+        self.assignments: dict[str, np.memmap] = {}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def setup_collection(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["dim"] != self.dimension or manifest["dtype"] != self.dtype.name:
+                raise ValueError(f"Vector store at {self.directory} was built with dim={manifest['dim']} dtype={manifest['dtype']}")
+            self.count = manifest["count"]
+            self.trained_count = manifest["trained_count"]
+            self.open(manifest["capacity"])
+            self.load()
+            print(f"Loaded local vector store with {len(self.rows)} vectors")
+        else:
+            self.open(self.INITIAL_CAPACITY)
+            self.write_manifest()
+            print(f"Created local vector store at {self.directory}")
+
+    def open(self, capacity: int):
+        files = [
+            ("ids.bin", np.dtype(f"S{self.ID_WIDTH}"), ()),
+            ("deleted.bin", np.dtype(np.uint8), ()),
+            ("owner.bin", np.dtype(f"S{self.ID_WIDTH}"), ()),
+            ("flags.bin", np.dtype(np.uint8), ()),
+            # Tag ids padded with 0, which no tag uses
+            ("tids.bin", np.dtype(np.int32), (MAX_TAGS,)),
+        ]
+        for field in FIELDS:
+            files.append((f"{field}.bin", self.dtype, (self.dimension,)))
+            files.append((f"{field}.assign.bin", np.dtype(np.int32), ()))
+
+        maps = {}
+        for name, dtype, shape in files:
+            path = self.path(name)
+            size = capacity * dtype.itemsize * int(np.prod(shape or (1,)))
+            with open(path, "ab"):
+                pass
+            if os.path.getsize(path) < size:
+                os.truncate(path, size)
+            maps[name] = np.memmap(path, dtype=dtype, mode="r+", shape=(capacity, *shape))
+
+        self.ids, self.deleted = maps["ids.bin"], maps["deleted.bin"]
+        self.owners, self.flags, self.tids = maps["owner.bin"], maps["flags.bin"], maps["tids.bin"]
+        self.vectors = {field: maps[f"{field}.bin"] for field in FIELDS}
+        self.assignments = {field: maps[f"{field}.assign.bin"] for field in FIELDS}
+        self.capacity = capacity
+
+    def load(self):
+        live = np.flatnonzero(self.deleted[:self.count] == 0)
+        self.rows = {self.ids[row].decode(): int(row) for row in live}
+        if not self.trained_count:
+            return
+        for field, index in self.indexes.items():
+            index.centroids = np.load(self.path(f"{field}.centroids.npy"))
+            index.build(np.asarray(self.assignments[field][:self.count]), np.arange(self.count))
+
+    def write_manifest(self):
+        manifest = {
+            "dim": self.dimension,
+            "dtype": self.dtype.name,
+            "capacity": self.capacity,
+            "count": self.count,
+            "nlist": self.nlist,
+            "trained_count": self.trained_count,
+        }
+        tmp = f"{self.manifest_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def flush(self):
+        for scalars in (self.ids, self.deleted, self.owners, self.flags, self.tids):
+            scalars.flush()
+        for field in FIELDS:
+            self.vectors[field].flush()
+            self.assignments[field].flush()
+
+    def _insert(self, data: list[dict]):
+        with self.lock:
+            n = len(data)
+            if self.count + n > self.capacity:
+                capacity = self.capacity
+                while self.count + n > capacity:
+                    capacity *= 2
+                self.open(capacity)
+
+            ids = [str(row["id"]) for row in data]
+            start, end = self.count, self.count + n
+            rows = np.arange(start, end)
+            for field in FIELDS:
+                vectors = normalize([row[field] for row in data])
+                self.vectors[field][start:end] = self.encode(vectors)
+                index = self.indexes[field]
+                if index.trained:
+                    assignments = index.assign(vectors)
+                    self.assignments[field][start:end] = assignments
+                    index.add(rows, assignments)
+            self.ids[start:end] = [id.encode() for id in ids]
+            self.deleted[start:end] = 0
+            self.write_attrs(start, data)
+            self.flush()
+
+            self.count = end
+            self.write_manifest()
+            # Same id again behaves as an upsert; the old row is retired only once the new one is durable
+            replaced = [self.rows[id] for id in ids if id in self.rows]
+            if replaced:
+                self.deleted[replaced] = 1
+                self.deleted.flush()
+            self.rows.update(zip(ids, rows.tolist()))
+
+            live = len(self.rows)
+            if live >= self.TRAIN_FACTOR * self.nlist and live >= 2 * self.trained_count:
+                self._train()
+
+    def _train(self):
+        live = np.fromiter(self.rows.values(), dtype=np.int64)
+        rng = np.random.default_rng(len(live))
+        sample = np.sort(rng.choice(live, min(len(live), self.SAMPLE_FACTOR * self.nlist), replace=False))
+        for field, index in self.indexes.items():
+            index.train(self.decode(self.vectors[field][sample]))
+            assignments = index.assign(self.vectors[field][:self.count])
+            self.assignments[field][:self.count] = assignments
+            index.build(assignments, np.arange(self.count))
+            tmp = self.path(f"{field}.centroids.tmp.npy")
+            np.save(tmp, index.centroids)
+            os.replace(tmp, self.path(f"{field}.centroids.npy"))
+        self.flush()
+        self.trained_count = len(live)
+        self.write_manifest()
+        print(f"Trained local IVF index on {len(live)} vectors")
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype.kind == "i":
+            return np.clip(np.round(vectors * self.scale), -127, 127).astype(self.dtype)
+        return vectors.astype(self.dtype)
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(rows, dtype=np.float32) / self.scale
+
+    def write_attrs(self, start: int, data: list[dict]):
+        flags = np.zeros(len(data), dtype=np.uint8)
+        tids = np.zeros((len(data), MAX_TAGS), dtype=np.int32)
+        owners = []
+        for n, row in enumerate(data):
+            owners.append(str(row.get("uid") or "").encode())
+            if "uid" not in row:
+                continue
+            flags[n] = self.HAS_ATTRS | self.PUBLIC * bool(row.get("is_public")) | self.NSFW * bool(row.get("is_nsfw"))
+            row_tids = list(row.get("tids") or [])[:MAX_TAGS]
+            tids[n, :len(row_tids)] = row_tids
+        end = start + len(data)
+        self.owners[start:end] = owners
+        self.flags[start:end] = flags
+        self.tids[start:end] = tids
+
+    def matches(self, rows, filter: SearchFilter | None, exclude: list | None) -> np.ndarray:
+        # Boolean mask over `rows` (an index array or a slice) for live rows passing the filter
+        keep = self.deleted[rows] == 0
+        if exclude:
+            keep &= ~np.isin(self.ids[rows], [str(id).encode() for id in exclude])
+        if filter is None:
+            return keep
+        flags = self.flags[rows]
+        visible = (flags & self.PUBLIC) != 0
+        if filter.uid:
+            visible |= ((flags & self.HAS_ATTRS) != 0) & (self.owners[rows] == str(filter.uid).encode())
+        keep &= visible
+        if not filter.nsfw:
+            keep &= (flags & self.NSFW) == 0
+        if filter.tids:
+            keep &= np.isin(self.tids[rows], filter.tids).any(axis=1)
+        return keep
+
+    def _search(self, query, field: str, limit: int, filter: SearchFilter = None, exclude: list = None,
+                nprobe: int | None = None) -> list[dict]:
+        query = normalize(query)
+        # Only probing (which merges pending appends) and the snapshot need the lock. Files
+        # only grow, so rows below the snapshot count stay valid while inserts go on, and
+        # concurrent searches score in parallel since numpy releases the GIL.
+        with self.lock:
+            index = self.indexes[field]
+            count, vectors = self.count, self.vectors[field]
+            candidates = np.sort(index.probe(query, nprobe or self.nprobe)) if index.trained else None
+        if candidates is not None:
+            # Filter before scoring so only matching candidates pay for the vector reads
+            candidates = candidates[self.matches(candidates, filter, exclude)]
+            scores = self.decode(vectors[candidates]) @ query
+        else:
+            candidates, scores = self._scan(query, vectors, count, limit, filter, exclude)
+        best = top_k(scores, limit)
+        return [{"id": self.ids[candidates[i]].decode(), "distance": float(scores[i])} for i in best]
+
+    def _scan(self, query, vectors: np.ndarray, count: int, limit: int, filter: SearchFilter = None,
+              exclude: list = None, chunk: int = 65536):
+        # Exact search over every live row, chunked so memory stays bounded
+        rows, scores = [], []
+        for start in range(0, count, chunk):
+            end = min(start + chunk, count)
+            block = self.decode(vectors[start:end]) @ query
+            block[~self.matches(slice(start, end), filter, exclude)] = -np.inf
+            keep = top_k(block, limit)
+            rows.append(keep + start)
+            scores.append(block[keep])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        live = np.isfinite(scores)
+        return rows[live], scores[live]
+
+    def _delete(self, ids: list):
+        with self.lock:
+            for id in ids:
+                row = self.rows.pop(str(id), None)
+                if row is not None:
+                    self.deleted[row] = 1
+            self.deleted.flush()
+
+    def _get(self, id) -> dict | None:
+        with self.lock:
+            row = self.rows.get(str(id))
+            if row is None:
+                return None
+            entity = {field: self.decode(self.vectors[field][row]) for field in FIELDS}
+            flags = int(self.flags[row])
+            if flags & self.HAS_ATTRS:
+                entity.update({
+                    "uid": self.owners[row].decode(),
+                    "is_public": bool(flags & self.PUBLIC),
+                    "is_nsfw": bool(flags & self.NSFW),
+                    "tids": [int(tid) for tid in self.tids[row] if tid],
+                })
+            return entity
+
+    async def insert_batch(self, data: list[dict]):
+        await asyncio.to_thread(self._insert, data)
+
+    async def search(self, image_embed: list=None, text_embed: list=None, limit: int = 128, offset: int = 0,
+                     filter: SearchFilter = None, exclude: list = None) -> list[dict]:
+        if image_embed is not None:
+            embedding, field = image_embed, "image_embed"
+        else:
+            embedding, field = text_embed, "text_embed"
+        hits = await asyncio.to_thread(self._search, embedding, field, offset + limit, filter, exclude)
+        return hits[offset:]
+
+    async def get_embedding(self, id: int):
+        entity = await asyncio.to_thread(self._get, id)
+        if entity is None:
+            raise KeyError(f"No embedding for {id}")
+        return entity["image_embed"]
+
+    async def get_vectors(self, ids: list) -> dict:
+        def get():
+            entities = {str(id): self._get(id) for id in ids}
+            return {id: entity for id, entity in entities.items() if entity is not None}
+        return await asyncio.to_thread(get)
+
+    async def delete(self, ids: list):
+        await asyncio.to_thread(self._delete, ids)
+
+    async def list_ids(self) -> set[str]:
+        with self.lock:
+            return set(self.rows)
+
+    async def list_stale_ids(self) -> set[str]:
+        with self.lock:
+            return {id for id, row in self.rows.items() if not self.flags[row] & self.HAS_ATTRS}
+
+    @staticmethod
+    def current(root: str) -> str:
+        pointer = os.path.join(root, "current.json")
+        if not os.path.exists(pointer):
+            return root
+        with open(pointer) as f:
+            return os.path.join(root, json.load(f)["directory"])
+
+    def shadow(self, name: str, dimension: int) -> "LocalVectorStore":
+        return LocalVectorStore(os.path.join(self.root, name), dimension, self.dtype.name, self.nlist, self.nprobe, root=self.root)
+
+    def promote(self, shadow: "LocalVectorStore"):
+        # This instance reopens on the shadow; other processes pick the switch up on restart
+        pointer = os.path.join(self.root, "current.json")
+        tmp = f"{pointer}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"directory": os.path.relpath(shadow.directory, self.root)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, pointer)
+        print(f"Local vector store now served from {shadow.directory} (was {self.directory}, kept for rollback)")
+        with self.lock:
+            self.__init__(shadow.directory, shadow.dimension, self.dtype.name, self.nlist, self.nprobe, root=self.root)
+            self.setup_collection()
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,74 @@
+''' Recall and latency of the compact tier (PCA codes + re-ranking) against full vectors.
+
+Uses two local stores, so it runs without Milvus. Data has low intrinsic dimension like
+real CLIP embeddings: clustered points in a random subspace plus isotropic noise.
+
+    python -m benchmarks.bench_compact --rows 50000 --dim 1024 --compact-dim 128 256 --rerank 1 4 8
+'''
+import time
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+
+from app.vectorstore import LocalVectorStore, normalize, top_k
+from app.compact import CompactTier
+
+def embeddings(rng, rows: int, dim: int, rank: int, clusters: int, noise: float) -> np.ndarray:
+    basis = np.linalg.qr(rng.standard_normal((dim, rank)))[0].T
+    centers = rng.standard_normal((clusters, rank))
+    latent = centers[rng.integers(0, clusters, rows)] + 0.5 * rng.standard_normal((rows, rank))
+    return normalize(latent @ basis + noise * rng.standard_normal((rows, dim)) / np.sqrt(dim))
+
+async def measure(search, queries, truth, k: int):
+    start = time.perf_counter()
+    results = [await search(q) for q in queries]
+    elapsed = (time.perf_counter() - start) / len(queries)
+    recall = np.mean([len({hit["id"] for hit in hits} & expected) / k for hits, expected in zip(results, truth)])
+    return recall, elapsed
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    data = embeddings(rng, args.rows + args.queries, args.dim, args.rank, args.clusters, args.noise)
+    data, queries = data[:args.rows], data[args.rows:]
+    truth = [{str(i) for i in top_k(data @ q, args.k)} for q in queries]
+
+    with tempfile.TemporaryDirectory() as directory:
+        primary = LocalVectorStore(f"{directory}/primary", dimension=args.dim, dtype="float32", nlist=args.nlist)
+        primary.setup_collection()
+        for offset in range(0, args.rows, args.batch):
+            await primary.insert_batch([
+                {"id": offset + i, "image_embed": vector, "text_embed": vector}
+                for i, vector in enumerate(data[offset:offset + args.batch])
+            ])
+
+        recall, elapsed = await measure(lambda q: primary.search(image_embed=q, limit=args.k), queries, truth, args.k)
+        print(f"{'full ' + str(args.dim) + ' float32':<26} recall@{args.k} {recall:.3f}  {1000 * elapsed:7.2f} ms/query")
+
+        for dtype in args.dtype:
+            for dim in args.compact_dim:
+                tier = CompactTier(primary, f"{directory}/compact-{dtype}-{dim}", dimension=dim, dtype=dtype, nlist=args.nlist)
+                tier.setup_collection()
+                report = await tier.refit(force=True)
+                for rerank in args.rerank:
+                    tier.rerank = rerank
+                    recall, elapsed = await measure(lambda q: tier.search(image_embed=q, limit=args.k), queries, truth, args.k)
+                    name = f"{dim} {dtype} rerank={rerank}"
+                    print(f"{name:<26} recall@{args.k} {recall:.3f}  {1000 * elapsed:7.2f} ms/query  (explained {report['explained_variance']:.2f})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--rank", type=int, default=96)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=4.0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--nlist", type=int, default=128)
+    parser.add_argument("--compact-dim", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--dtype", nargs="+", default=["int8", "float16"])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--k", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+''' Request concurrency of the blocking Session used before vs the asyncpg pool.
+
+Every simulated request opens a session and reads a page of the newest rows, the shape
+of most list endpoints. "sync" calls a psycopg2 Session from inside a coroutine, as the
+CRUD helpers did, so each query stalls the event loop; "async" awaits the same query on
+the pooled asyncpg engine. --latency-ms adds a server-side pg_sleep to each query to
+stand in for the network round trip to a remote database. Loop lag is how late a 5 ms
+timer fires while requests run, i.e. what every other request on the worker waits.
+
+Runs against DATABASE_URL in a scratch table, without the app's other services;
+the sync run needs psycopg2 installed.
+
+    python -m benchmarks.bench_db --requests 2000 --concurrency 1 16 64 --latency-ms 2
+'''
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import time
+import asyncio
+import argparse
+
+import numpy as np
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+PAGE = text("SELECT mid, title FROM bench_media, pg_sleep(:latency) ORDER BY created_at DESC LIMIT 20")
+
+def with_driver(url: str, driver: str) -> str:
+    # Importing app.database would also connect to the vector store, so the URL is rewritten here
+    scheme, rest = url.split("://", 1)
+    return f"postgresql+{driver}://{rest}"
+
+async def monitor(stop: asyncio.Event, lags: list, tick: float = 0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(tick)
+        lags.append(loop.time() - start - tick)
+
+async def run(request, requests: int, concurrency: int) -> dict:
+    latencies, lags = [], []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(monitor(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag
+    return {
+        "rps": requests / elapsed,
+        "p50": 1000 * np.percentile(latencies, 50),
+        "p99": 1000 * np.percentile(latencies, 99),
+        "lag": 1000 * max(lags, default=0.0),
+    }
+
+async def main(args):
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        raise SystemExit("DATABASE_URL is not set")
+    latency = args.latency_ms / 1000
+
+    sync_engine = create_engine(with_driver(url, "psycopg2"), pool_size=args.pool, max_overflow=0)
+    with sync_engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_media"))
+        conn.execute(text("CREATE TABLE bench_media (mid text PRIMARY KEY, title text, created_at timestamp)"))
+        conn.execute(text(
+            "INSERT INTO bench_media SELECT g::text, 'title ' || g, now() - g * interval '1 second' "
+            "FROM generate_series(1, :rows) g"
+        ), {"rows": args.rows})
+        conn.execute(text("CREATE INDEX ON bench_media (created_at)"))
+    SyncSession = sessionmaker(bind=sync_engine)
+
+    async_engine = create_async_engine(with_driver(url, "asyncpg"), pool_size=args.pool, max_overflow=0)
+    AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def sync_request():
+        # Blocks the loop for the whole round trip, as the CRUD helpers used to
+        with SyncSession() as db:
+            db.execute(PAGE, {"latency": latency}).all()
+
+    async def async_request():
+        async with AsyncSession() as db:
+            (await db.execute(PAGE, {"latency": latency})).all()
+
+    try:
+        for name, request in (("sync", sync_request), ("async", async_request)):
+            # Warm the pool so connection setup isn't timed
+            await run(request, args.pool, args.pool)
+            for concurrency in args.concurrency:
+                result = await run(request, args.requests, concurrency)
+                print(f"{name:<6} concurrency={concurrency:<4} {result['rps']:8.0f} req/s  "
+                      f"p50 {result['p50']:6.2f} ms  p99 {result['p99']:6.2f} ms  max loop lag {result['lag']:7.2f} ms")
+    finally:
+        with sync_engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS bench_media"))
+        sync_engine.dispose()
+        await async_engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--pool", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    asyncio.run(main(parser.parse_args()))
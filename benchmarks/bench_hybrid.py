@@ -0,0 +1,76 @@
+''' Recall of single-field vs fused image + text search on synthetic CLIP-like data.
+
+Every item has a latent concept; its image and text embeddings are two independently
+noisy views of it, and queries are noisy views of a target concept. The relevant set for
+a query is its k nearest items by concept, which neither embedding sees exactly.
+
+    python -m benchmarks.bench_hybrid --rows 50000 --dim 512 --queries 200
+'''
+import time
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+
+from app.vectorstore import LocalVectorStore, normalize, top_k
+
+def noisy(rng, concepts: np.ndarray, scale: float) -> np.ndarray:
+    return normalize(concepts + scale * rng.standard_normal(concepts.shape) / np.sqrt(concepts.shape[1]))
+
+async def run(store, queries, truth, k: int, **options):
+    start = time.perf_counter()
+    results = [await store_search(store, q, k, **options) for q in queries]
+    elapsed = (time.perf_counter() - start) / len(queries)
+    recall = np.mean([len({hit["id"] for hit in hits} & expected) / k for hits, expected in zip(results, truth)])
+    return recall, elapsed
+
+async def store_search(store, query, k: int, mode: str, **options):
+    if mode == "hybrid":
+        return await store.hybrid_search(query, limit=k, **options)
+    return await store.search(**{mode: query}, limit=k)
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    centers = normalize(rng.standard_normal((args.clusters, args.dim)))
+    concepts = noisy(rng, centers[rng.integers(0, args.clusters, args.rows)], 0.6)
+    images = noisy(rng, concepts, args.image_noise)
+    texts = noisy(rng, concepts, args.text_noise)
+    targets = concepts[rng.choice(args.rows, args.queries, replace=False)]
+    queries = noisy(rng, targets, args.query_noise)
+    truth = [{str(i) for i in top_k(concepts @ target, args.k)} for target in targets]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = LocalVectorStore(directory, dimension=args.dim, dtype=args.dtype, nlist=args.nlist)
+        store.setup_collection()
+        for offset in range(0, args.rows, args.batch):
+            await store.insert_batch([
+                {"id": offset + i, "image_embed": image, "text_embed": text}
+                for i, (image, text) in enumerate(zip(images[offset:offset + args.batch], texts[offset:offset + args.batch]))
+            ])
+
+        runs = [
+            ("image_embed", {"mode": "image_embed"}),
+            ("text_embed", {"mode": "text_embed"}),
+            ("hybrid rrf", {"mode": "hybrid", "method": "rrf", "depth": args.depth}),
+            ("hybrid weighted", {"mode": "hybrid", "method": "weighted", "depth": args.depth}),
+        ]
+        for name, options in runs:
+            recall, elapsed = await run(store, queries, truth, args.k, **options)
+            print(f"{name:<16} recall@{args.k} {recall:.3f}  {1000 * elapsed:7.2f} ms/query")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--nlist", type=int, default=128)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--image-noise", type=float, default=0.4)
+    parser.add_argument("--text-noise", type=float, default=0.5)
+    parser.add_argument("--query-noise", type=float, default=0.2)
+    parser.add_argument("--dtype", default="float16")
+    parser.add_argument("--k", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,74 @@
+''' Throughput of the image engine against the old thread-based hash path.
+
+    python -m benchmarks.bench_image_engine --images 200 --gifs 50 --concurrency 32
+'''
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from PIL import Image, ImageSequence
+from imagehash import phash
+
+from app.imaging import ImageEngine, inspect_image
+
+def make_fixtures(directory: str, images: int, gifs: int, size: int, frames: int) -> list[str]:
+    paths = []
+    for i in range(images):
+        path = os.path.join(directory, f"{i}.jpg")
+        Image.effect_noise((size, size), 64 + i % 64).convert("RGB").save(path, quality=90)
+        paths.append(path)
+    for i in range(gifs):
+        path = os.path.join(directory, f"{i}.gif")
+        sequence = [Image.effect_noise((size // 2, size // 2), 32 + n).convert("P") for n in range(frames)]
+        sequence[0].save(path, save_all=True, append_images=sequence[1:], duration=40, loop=0)
+        paths.append(path)
+    return paths
+
+async def legacy_hash(path: str) -> str:
+    # The pre-engine code path: decode on the event loop, materialise every GIF frame
+    image = Image.open(path)
+    if image.format == 'GIF':
+        frames = list(ImageSequence.Iterator(image))
+        first_frame_hash = await asyncio.to_thread(phash, frames[0].convert("RGB"))
+        last_frame_hash = await asyncio.to_thread(phash, frames[-1].convert("RGB"))
+        return f"{first_frame_hash}{last_frame_hash}"
+    return str(await asyncio.to_thread(phash, image))
+
+async def run(fn, paths: list[str], concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(path):
+        async with semaphore:
+            await fn(path)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(path) for path in paths))
+    return time.perf_counter() - start
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_fixtures(directory, args.images, args.gifs, args.size, args.frames)
+        print(f"{len(paths)} files, concurrency {args.concurrency}, {args.workers} workers")
+
+        elapsed = await run(legacy_hash, paths, args.concurrency)
+        print(f"{'legacy thread path':<22} {len(paths) / elapsed:8.1f} images/s")
+
+        for kind in ("thread", "process"):
+            engine = ImageEngine(kind, args.workers)
+            # Warm the pool up so process start-up is not counted
+            await engine.run(inspect_image, paths[0])
+            elapsed = await run(lambda path: engine.run(inspect_image, path), paths, args.concurrency)
+            engine.shutdown()
+            print(f"{'engine ' + kind:<22} {len(paths) / elapsed:8.1f} images/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--gifs", type=int, default=50)
+    parser.add_argument("--frames", type=int, default=40)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    asyncio.run(main(parser.parse_args()))
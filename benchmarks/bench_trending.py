@@ -0,0 +1,102 @@
+''' Incremental trending scores against recomputing them from the event log.
+
+Replays a synthetic stream of views, likes and dislikes over Zipf-distributed media, each
+with a few tags, through app.ranking.Trending, then compares:
+
+  - ingest: events per second added one at a time, boards included
+  - top-N: latency of reading the overall and per-tag boards
+  - scan: recomputing decayed scores from every event and taking the top N, which is
+    what ranking straight from the activity tables costs per request
+  - recall: overlap of the boards with the exact top N, since a falling score can leave
+    a stale member on a board until the next rebuild
+
+    python -m benchmarks.bench_trending --events 5000000 --media 200000 --tags 2000 --top 50
+'''
+import time
+import argparse
+
+import numpy as np
+
+from app.ranking import Trending, ALL
+
+WEIGHTS = np.array([1.0, 4.0, -2.0])  # view, like, dislike
+
+def stream(rng, events: int, media: int, span: float):
+    mids = np.minimum(rng.zipf(1.2, events), media) - 1
+    # Popularity drifts: a random slice of the catalog is hot in each half of the stream
+    shift = rng.integers(0, media)
+    mids[events // 2:] = (mids[events // 2:] + shift) % media
+    kinds = rng.choice(3, events, p=[0.9, 0.08, 0.02])
+    times = np.sort(rng.uniform(0, span, events))
+    return mids, kinds, times
+
+def exact_top(mids, kinds, times, now: float, half_life: float, media: int, n: int, members=None) -> set:
+    scores = np.bincount(mids, weights=WEIGHTS[kinds] * 2.0 ** ((times - now) / half_life), minlength=media)
+    if members is not None:
+        candidates = members
+    else:
+        candidates = np.arange(media)
+    order = candidates[np.argsort(-scores[candidates], kind="stable")[:n]]
+    return {str(mid) for mid in order if scores[mid] > 0}
+
+def main(args):
+    rng = np.random.default_rng(0)
+    mids, kinds, times = stream(rng, args.events, args.media, args.span_days * 86400)
+    tags = rng.integers(0, args.tags, (args.media, args.tags_per_media))
+    half_life = args.half_life_hours * 3600
+
+    engine = Trending(half_life, args.capacity, landmark=0.0)
+    for mid in range(args.media):
+        engine.set_groups(str(mid), [f"tag:{tid}" for tid in tags[mid]])
+    keys = [str(mid) for mid in range(args.media)]
+    weights = WEIGHTS[kinds].tolist()
+
+    start = time.perf_counter()
+    for mid, weight, at in zip(mids.tolist(), weights, times.tolist()):
+        engine.add(keys[mid], weight, at)
+    ingest = time.perf_counter() - start
+    now = float(times[-1])
+    print(f"ingest  {args.events:,} events in {ingest:6.2f} s  {args.events / ingest:10,.0f} events/s  "
+          f"({len(engine):,} media, {len(engine.boards):,} boards)")
+
+    probe = [f"tag:{tid}" for tid in rng.integers(0, args.tags, 100)]
+    start = time.perf_counter()
+    for _ in range(100):
+        engine.top(args.top, now)
+    overall = (time.perf_counter() - start) / 100
+    start = time.perf_counter()
+    for group in probe:
+        engine.top(args.top, now, group)
+    per_tag = (time.perf_counter() - start) / len(probe)
+    print(f"top-{args.top}  overall {1e6 * overall:8.1f} us   per tag {1e6 * per_tag:8.1f} us")
+
+    start = time.perf_counter()
+    truth = exact_top(mids, kinds, times, now, half_life, args.media, args.top)
+    scan = time.perf_counter() - start
+    print(f"scan    {1000 * scan:8.1f} ms per request ({scan / overall:,.0f}x the board read)")
+
+    recall = [len({key for key, _ in engine.top(args.top, now)} & truth) / max(1, len(truth))]
+    for group in probe[:20]:
+        tid = int(group.split(":")[1])
+        members = np.flatnonzero((tags == tid).any(axis=1))
+        expected = exact_top(mids, kinds, times, now, half_life, args.media, args.top, members)
+        recall.append(len({key for key, _ in engine.top(args.top, now, group)} & expected) / max(1, len(expected)))
+    print(f"recall  {np.mean(recall):.4f} before rebuild", end="  ")
+
+    start = time.perf_counter()
+    engine.rebase(now)
+    rebuild = time.perf_counter() - start
+    rebuilt = len({key for key, _ in engine.top(args.top, now)} & truth) / max(1, len(truth))
+    print(f"{rebuilt:.4f} overall after rebase + rebuild ({rebuild:.2f} s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2_000_000)
+    parser.add_argument("--media", type=int, default=200_000)
+    parser.add_argument("--tags", type=int, default=2000)
+    parser.add_argument("--tags-per-media", type=int, default=5)
+    parser.add_argument("--capacity", type=int, default=500)
+    parser.add_argument("--top", type=int, default=50)
+    parser.add_argument("--span-days", type=float, default=7)
+    parser.add_argument("--half-life-hours", type=float, default=24)
+    main(parser.parse_args())
@@ -0,0 +1,45 @@
+''' Re-embeds every media item into a shadow collection, resuming from the last checkpoint.
+
+The target model defaults to the configured CLIP backend; pass --backend/--model to
+rebuild for another one. The finished collection is swapped in by the next server
+that starts with that model configured (and VECTOR_DIMENSION set to its dimension);
+servers already running keep searching the current one until they are restarted.
+
+    python -m scripts.backfill_embeddings --backend local --model ViT-L/14 --rate 10
+'''
+from dotenv import load_dotenv
+load_dotenv()
+
+import asyncio
+import argparse
+
+from app.database import create_tables, engine, SessionLocal
+from app.encoding import RemoteClipBackend, LocalClipBackend, CLIP_BACKEND, CLIP_SERVER, CLIP_MODEL_ID, CLIP_LOCAL_MODEL
+from app.imaging import image_engine
+from app.routes.images.backfill import Backfill, BACKFILL_BATCH, BACKFILL_RATE
+
+async def main(args):
+    if args.backend == "local":
+        backend = LocalClipBackend(model_name=args.model or CLIP_LOCAL_MODEL)
+    else:
+        backend = RemoteClipBackend(server=args.server, model_id=args.model or CLIP_MODEL_ID)
+    await backend.warmup()
+
+    await create_tables()
+    try:
+        async with SessionLocal() as db:
+            job = await Backfill(backend, args.batch, args.rate).run(db, restart=args.restart)
+            print(f"Backfill {job.bid}: {job.status}, {job.processed} rows, {job.skipped} skipped")
+    finally:
+        image_engine.shutdown()
+        await engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["remote", "local"], default=CLIP_BACKEND)
+    parser.add_argument("--server", default=CLIP_SERVER)
+    parser.add_argument("--model", help="model id (remote) or openai CLIP model name (local)")
+    parser.add_argument("--batch", type=int, default=BACKFILL_BATCH)
+    parser.add_argument("--rate", type=float, default=BACKFILL_RATE, help="images per second")
+    parser.add_argument("--restart", action="store_true", help="abandon an unfinished job and start over")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,55 @@
+''' Refits the compact tier's projection on the live catalog and reports recall vs latency.
+
+Runs against the configured stores (VECTOR_COMPACT=true plus the usual .env), ideally
+while the server is stopped; a running server refits on its own schedule instead.
+Ground truth is the primary store's own ranking for stored image vectors used as queries.
+
+    python -m scripts.refit_compact --queries 200 --k 10 --rerank 1 2 4 8
+'''
+from dotenv import load_dotenv
+load_dotenv()
+
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+from app.database import milvus_client
+from app.compact import CompactTier
+
+async def report(tier: CompactTier, args):
+    ids = list(await tier.primary.list_ids())
+    sample = random.Random(0).sample(ids, min(len(ids), args.queries))
+    rows = await tier.primary.get_vectors(sample)
+    queries = [np.asarray(row["image_embed"], dtype=np.float32) for row in rows.values()]
+
+    start = time.perf_counter()
+    truth = [{hit["id"] for hit in await tier.primary.search(image_embed=q, limit=args.k)} for q in queries]
+    full = (time.perf_counter() - start) / len(queries)
+    print(f"{'primary':<12} recall@{args.k} 1.000  {1000 * full:7.2f} ms/query")
+
+    for rerank in args.rerank:
+        tier.rerank = rerank
+        start = time.perf_counter()
+        results = [await tier.search(image_embed=q, limit=args.k) for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries)
+        recall = np.mean([len({hit["id"] for hit in hits} & expected) / args.k for hits, expected in zip(results, truth)])
+        print(f"{'rerank=' + str(rerank):<12} recall@{args.k} {recall:.3f}  {1000 * elapsed:7.2f} ms/query")
+
+async def main(args):
+    if not isinstance(milvus_client, CompactTier):
+        raise SystemExit("VECTOR_COMPACT is not enabled")
+    if not args.report_only:
+        result = await milvus_client.refit(force=True)
+        print(f"explained variance {result['explained_variance']:.3f} over {result['rows']} rows in {result['seconds']:.1f}s")
+    await report(milvus_client, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--report-only", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# app.database builds its stores and engine at import time; point it at throwaway local ones
+os.environ.setdefault("VECTOR_BACKEND", "local")
+os.environ.setdefault("STORAGE_DIR", tempfile.mkdtemp(prefix="artengine-tests-"))
+os.environ.setdefault("DATABASE_URL", "postgresql://postgres@localhost/artengine_tests")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
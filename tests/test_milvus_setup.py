@@ -0,0 +1,125 @@
+import ast
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app.database import MilvusSetup, MilvusConfig
+from app.vectorstore import SearchFilter
+
+# Public methods of pymilvus.MilvusClient in the pinned release (requirements.txt: pymilvus==2.4.4)
+MILVUS_CLIENT_API = frozenset({
+    "alter_alias", "close", "create_alias", "create_collection", "create_index", "create_partition",
+    "create_role", "create_schema", "create_user", "delete", "describe_alias", "describe_collection",
+    "describe_index", "describe_role", "describe_user", "drop_alias", "drop_collection", "drop_index",
+    "drop_partition", "drop_role", "drop_user", "get", "get_collection_stats", "get_load_state",
+    "get_partition_stats", "grant_privilege", "grant_role", "has_collection", "has_partition", "insert",
+    "list_aliases", "list_collections", "list_indexes", "list_partitions", "list_roles", "list_users",
+    "load_collection", "load_partitions", "prepare_index_params", "query", "refresh_load",
+    "release_collection", "release_partitions", "rename_collection", "revoke_privilege", "revoke_role",
+    "search", "update_password", "upsert", "using_database",
+})
+
+ROWS = [
+    {"id": "1", "image_embed": [1.0, 0.0], "is_public": True},
+    {"id": "2", "image_embed": [0.0, 1.0], "is_public": True},
+    # Written before the scalar fields existed
+    {"id": "3", "image_embed": [0.6, 0.8]},
+]
+
+class StubClient:
+    ''' MilvusClient 2.4.4: anything outside its public surface is an AttributeError '''
+
+    def __init__(self, rows: list[dict]):
+        self.rows = {row["id"]: row for row in rows}
+        self.aliases = {"embeddings_live": "embeddings"}
+
+    def __getattr__(self, name):
+        if name in MILVUS_CLIENT_API:
+            raise NotImplementedError(f"StubClient.{name}")
+        raise AttributeError(f"'MilvusClient' object has no attribute '{name}'")
+
+    def get(self, collection_name: str, ids: list, output_fields: list = None, timeout: float = None, partition_names: list = None, **kwargs):
+        return [{"id": id, **{field: self.rows[id].get(field) for field in output_fields or []}} for id in ids if id in self.rows]
+
+    def describe_alias(self, alias: str, timeout: float = None, **kwargs):
+        return {"alias": alias, "collection_name": self.aliases[alias]}
+
+    def alter_alias(self, collection_name: str, alias: str, timeout: float = None, **kwargs):
+        self.aliases[alias] = collection_name
+
+class StubIterator:
+    def __init__(self, rows: list[dict], batch_size: int):
+        self.pages = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+        self.closed = False
+
+    def next(self):
+        return self.pages.pop(0) if self.pages else []
+
+    def close(self):
+        self.closed = True
+
+class StubCollection:
+    ''' pymilvus.orm.Collection 2.4.4 signatures, without **kwargs so a misspelt argument fails '''
+
+    def __init__(self, rows: list[dict]):
+        self.rows = rows
+        self.iterators = []
+        self.searches = []
+
+    def query_iterator(self, batch_size: int = 1000, limit: int = -1, expr: str = None, output_fields: list = None, partition_names: list = None, timeout: float = None):
+        iterator = StubIterator([{field: row.get(field) for field in output_fields} for row in self.rows], batch_size)
+        self.iterators.append(iterator)
+        return iterator
+
+    def hybrid_search(self, reqs: list, rerank, limit: int, partition_names: list = None, output_fields: list = None, timeout: float = None, round_decimal: int = -1):
+        self.searches.append((reqs, rerank, limit))
+        # Hits are read by attribute; 2.4.4 Hit objects are not subscriptable
+        return [[SimpleNamespace(id=row["id"], distance=1.0 / (i + 1)) for i, row in enumerate(self.rows[:limit])]]
+
+@pytest.fixture
+def store():
+    setup = MilvusSetup.__new__(MilvusSetup)
+    setup.uri = "http://milvus:19530"
+    setup.config = MilvusConfig(dimension=2)
+    setup.name = setup.config.alias
+    setup.using = f"orm-{setup.uri}"
+    setup.client = StubClient(ROWS)
+    setup._collection = StubCollection(ROWS)
+    return setup
+
+def test_client_calls_exist_in_pinned_pymilvus():
+    source = (Path(__file__).resolve().parents[1] / "app" / "database.py").read_text()
+    called = {
+        node.attr for node in ast.walk(ast.parse(source))
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Attribute)
+        and node.value.attr == "client" and isinstance(node.value.value, ast.Name) and node.value.value.id == "self"
+    }
+    assert called and called <= MILVUS_CLIENT_API, called - MILVUS_CLIENT_API
+
+def test_list_ids_pages_through_iterator(store):
+    assert asyncio.run(store.list_ids()) == {"1", "2", "3"}
+    assert all(iterator.closed for iterator in store._collection.iterators)
+
+def test_list_stale_ids(store):
+    assert asyncio.run(store.list_stale_ids()) == {"3"}
+
+def test_scan_uses_small_batches(store):
+    assert [row["id"] for row in store.scan(["id"], batch_size=1)] == ["1", "2", "3"]
+
+def test_get_embedding(store):
+    assert asyncio.run(store.get_embedding(2)) == [0.0, 1.0]
+    with pytest.raises(KeyError):
+        asyncio.run(store.get_embedding(4))
+
+def test_hybrid_search(store):
+    hits = asyncio.run(store.hybrid_search([1.0, 0.0], limit=1, offset=1, filter=SearchFilter(uid="u1")))
+    assert hits == [{"id": "2", "distance": 0.5}]
+    reqs, _, limit = store._collection.searches[0]
+    assert limit == 2 and len(reqs) == 2
+
+def test_promote_reopens_collection(store):
+    store.promote(SimpleNamespace(config=MilvusConfig(collection_name="embeddings_v2", alias=None)))
+    assert store.client.aliases["embeddings_live"] == "embeddings_v2"
+    assert store._collection is None
@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.routes.images import recommend
+from app.routes.images.models import UserTastes
+from app.vectorstore import normalize
+
+VECTORS = {
+    "a": [1.0, 0.0, 0.0],
+    "b": [0.9, 0.1, 0.0],
+    "c": [0.0, 1.0, 0.0],
+    "d": [0.0, 0.0, 1.0],
+}
+
+class StubStore:
+    ''' Exact cosine search over VECTORS '''
+
+    def __init__(self):
+        self.searches = 0
+
+    async def search(self, image_embed: list = None, text_embed: list = None, limit: int = 128, offset: int = 0, filter=None, exclude: list = None) -> list[dict]:
+        self.searches += 1
+        query = np.asarray(image_embed, dtype=np.float32)
+        scored = sorted(((float(query @ normalize(vector)), mid) for mid, vector in VECTORS.items()), key=lambda item: (-item[0], item[1]))
+        return [{"id": mid, "distance": score} for score, mid in scored[offset:offset + limit]]
+
+    async def get_vectors(self, ids: list) -> dict:
+        return {mid: {"id": mid, "image_embed": VECTORS[mid]} for mid in ids if mid in VECTORS}
+
+def taste_row(likes: list, dislikes: list = ()) -> UserTastes:
+    def total(mids):
+        return np.sum([VECTORS[mid] for mid in mids], axis=0, dtype=np.float32).tobytes() if mids else None
+    return UserTastes(
+        uid="u1", model_id="clip-test",
+        like_sum=total(likes), dislike_sum=total(dislikes), likes=len(likes), dislikes=len(dislikes)
+    )
+
+@pytest.fixture
+def setup(monkeypatch):
+    store = StubStore()
+    state = {"row": None, "seen": set()}
+
+    async def get_user_taste(db, uid):
+        return state["row"]
+
+    async def get_seen_mids(db, uid):
+        return set(state["seen"])
+
+    monkeypatch.setattr(recommend, "milvus_client", store)
+    monkeypatch.setattr(recommend, "clip_backend", SimpleNamespace(model_id="clip-test"))
+    monkeypatch.setattr(recommend, "get_user_taste", get_user_taste)
+    monkeypatch.setattr(recommend, "get_seen_mids", get_seen_mids)
+    # No diversity, so the order is plain similarity to the taste
+    recommender = recommend.Recommender(candidates=8, dislike_weight=0.5, diversity=0.0, ttl=60, cache_size=16)
+    return recommender, store, state
+
+def test_recommend_for_user_with_likes(setup):
+    recommender, store, state = setup
+    # Liked a, disliked d: b is closest, d is pushed to the end, a was already rated
+    state["row"] = taste_row(["a"], ["d"])
+    state["seen"] = {"a", "d"}
+    ranked = asyncio.run(recommender.recommend(None, "u1", limit=10))
+    assert [mid for mid, _ in ranked] == ["b", "c"]
+    assert ranked[0][1] == pytest.approx(0.9 / np.linalg.norm([0.9, 0.1]) / np.linalg.norm([1.0, -0.5]), rel=1e-5)
+
+    state["seen"] = {"a"}
+    recommender.seen.pop("u1")
+    recommender.rankings.pop(("u1", False))
+    ranked = asyncio.run(recommender.recommend(None, "u1", limit=10))
+    assert [mid for mid, _ in ranked] == ["b", "c", "d"]
+    assert store.searches == 2
+
+def test_recommend_pages_from_cache(setup):
+    recommender, store, state = setup
+    state["row"] = taste_row(["a"])
+    first = asyncio.run(recommender.recommend(None, "u1", limit=2))
+    rest = asyncio.run(recommender.recommend(None, "u1", limit=2, offset=2))
+    assert [mid for mid, _ in first + rest] == ["a", "b", "c", "d"]
+    assert store.searches == 1 and recommender.hits == 1
+
+def test_recommend_without_likes(setup):
+    recommender, store, state = setup
+    state["row"] = taste_row([], ["d"])
+    assert asyncio.run(recommender.recommend(None, "u1", limit=10)) is None
+    assert store.searches == 0
+
+def test_update_moves_built_profiles_only(setup, monkeypatch):
+    recommender, store, state = setup
+    rows = {"u1": taste_row(["a"]), "u2": UserTastes(uid="u2", model_id="", likes=0, dislikes=0)}
+
+    async def lock_user_tastes(db, uids):
+        return {uid: rows[uid] for uid in uids}
+
+    async def get_preference_attrs(db, pairs):
+        return {("u1", "a"): "like"}
+
+    monkeypatch.setattr(recommend, "lock_user_tastes", lock_user_tastes)
+    monkeypatch.setattr(recommend, "get_preference_attrs", get_preference_attrs)
+    # u1 turns a like into a dislike and likes c; u2's placeholder is left for build()
+    preferences = {("u1", "a"): "dislike", ("u1", "c"): "like", ("u2", "b"): "like"}
+    vectors = asyncio.run(recommender.vectors(preferences))
+    previous = asyncio.run(recommender.update(None, preferences, vectors))
+    assert previous == {("u1", "a"): "like"}
+    assert (rows["u1"].likes, rows["u1"].dislikes) == (1, 1)
+    assert np.frombuffer(rows["u1"].like_sum, dtype=np.float32).tolist() == VECTORS["c"]
+    assert np.frombuffer(rows["u1"].dislike_sum, dtype=np.float32).tolist() == VECTORS["a"]
+    assert rows["u2"].likes == 0 and rows["u2"].like_sum is None